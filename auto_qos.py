@@ -1,13 +1,18 @@
 import csv
-import subprocess
-from collections import defaultdict
+import json
+import os
+import sys
 import argparse
+import hostlist
+import node_packing
+import profiling
+import slurm_cache
+import throughput
+from collections import namedtuple
+from itertools import accumulate
+from node_snapshot import ClusterSnapshot, query_node, query_job_allocation
 
-partition_csv = "<your_path>/partitions.csv"
-result = subprocess.run(['sinfo'], stdout=subprocess.PIPE, check=True)
-output = result.stdout.decode('utf-8')
-lines = output.split('\n')
-partition_list = {} # {"<status>" : {"<partition>" : ["<node>", "<node>", ...]}}
+PARTITION_CSV = os.environ.get("AUTO_QOS_PARTITION_CSV", "<your_path>/partitions.csv")
 max_tres = 48
 PRICES = {
     "a100" : 1.89,
@@ -16,28 +21,31 @@ PRICES = {
     "3090" : 0.44
 }
 
-parser = argparse.ArgumentParser(description='Get idle partitions and recommend commands')
-parser.add_argument('--sbatch', action='store_true', help='Print sbatch instead of srun')
-parser.add_argument('--partition', type=str, help='Partition name to get info', default="")
-parser.add_argument("--max_tres", type=int, help="Maximum TRES", default=48)
-args = parser.parse_args()
+# one recommended allocation per partition, nodes x gpus_per_node = total_gpus
+# samples_per_second is the throughput model prediction, None for the gpus objective
+# price_per_hour is total_gpus x PRICES of the gpu type, score the value of the objective rank_plans ranked by
+# nodelist (compressed) / mem_per_gpu (MB) are the nodes node_packing placed the plan on, None without node resources
+AllocationPlan = namedtuple("AllocationPlan", ["partition", "nodes", "gpus_per_node", "cpus_per_gpu", "qos", "gres_name", "total_gpus",
+                                               "samples_per_second", "gpu_type", "price_per_hour", "score", "nodelist", "mem_per_gpu"],
+                            defaults=(None, None, None, None, None, None))
+OBJECTIVES = ["gpus", "throughput", "samples_per_dollar", "time_to_step"]
+LOWER_IS_BETTER = {"time_to_step"}
+AUTO_PARTITION = "auto" # partition name that lets rank_plans pick the partition
+RELEASED_STATES = ["alloc", "comp"] # sinfo states of the nodes of a released job, read like mix nodes
 
-max_tres = args.max_tres
+verbose = False # the CLI turns this on, library calls stay quiet
 
-if args.sbatch:
-    def printif(something):
-        pass
-else:
-    def printif(something):
+def printif(something):
+    if verbose:
         print(something)
 
 
-
 class NodeInfoParser:
-    def __init__(self, node_name:str):
+    def __init__(self, node_name:str, snapshot=None):
         self.node_name = node_name
         self.node_info = {}
-        self.output = ""
+        self.record = None
+        self.snapshot = snapshot # ClusterSnapshot, queries the node itself if not given
         self.device_name = ""
         self.total_device_count = 0
         self.partitions = ""
@@ -46,19 +54,21 @@ class NodeInfoParser:
     def get_command(self):
         return f"scontrol show node {self.node_name}".split()
 
+    def get_record(self):
+        if self.record is None and self.snapshot is not None:
+            self.record = self.snapshot.get(self.node_name)
+        if self.record is None:
+            # not in the snapshot (or no snapshot), ask scontrol for this node only
+            self.record = query_node(self.node_name)
+        return self.record
+
     def get_cpu_available_count(self):
-        stdout = self.output
-        cpu_alloc = stdout.split("CPUAlloc=")[1].split()[0]
-        cpu_tot = stdout.split("CPUTot=")[1].split()[0]
-        return int(cpu_tot) - int(cpu_alloc)
+        return int(self.record.cpu_tot) - int(self.record.cpu_alloc)
         
     def get_node_info(self):
-        result = subprocess.run(self.get_command(), stdout=subprocess.PIPE, check=True)
-        self.output = result.stdout.decode('utf-8')
+        record = self.get_record()
         # find Gres=<gres>
-        gres_start = self.output.index('Gres=') + len('Gres=')
-        gres_end = self.output.index('NodeAddr=') - 2
-        gres = self.output[gres_start:gres_end]
+        gres = record.gres
         # split by ":"
         gres_found = False
         if gres != "(null)": # no Gres
@@ -71,9 +81,7 @@ class NodeInfoParser:
             printif(f"No info from {gres}")
         # if not numeric self.total_device_count, check CfgTres=cpu=52,...
         if not self.total_device_count.isnumeric():
-            cfg_start = self.output.index('CfgTRES=') + len('CfgTRES=')
-            cfg_end = self.output.index('\n', cfg_start)
-            cfg_tres = self.output[cfg_start:cfg_end]
+            cfg_tres = record.cfg_tres
             #printif("cfg_tres", cfg_tres)
             # if gres/ in cfg_tres, use it
             if 'gres/' in cfg_tres:
@@ -86,16 +94,11 @@ class NodeInfoParser:
             self.available_device_count = self.total_device_count = self.node_info['gres'][self.device_name]
             assert self.available_device_count.isnumeric()
         # get AllocTRES
-        alloc_start = self.output.index('AllocTRES=') + len('AllocTRES=')
-        # until next \n
-        alloc_end = self.output.index('\n', alloc_start)
-        alloc_tres = self.output[alloc_start:alloc_end]
+        alloc_tres = record.alloc_tres
         if not alloc_tres or alloc_tres.isspace():
             # is idle
-            # parse CfgTRES instead, gres/gpu=6\n
-            cfg_start = self.output.index('CfgTRES=') + len('CfgTRES=')
-            cfg_end = self.output.index('\n', cfg_start)
-            cfg_tres = self.output[cfg_start:cfg_end]
+            # parse CfgTRES instead, gres/gpu=6
+            cfg_tres = record.cfg_tres
             self.node_info['gres'][self.device_name] = cfg_tres.split('=')[-1]
             self.gres_name = self.device_name
             self.available_device_count = int(self.total_device_count)
@@ -122,9 +125,7 @@ class NodeInfoParser:
                 else:
                     raise Exception(f"No Gres found in {self.node_name}! {alloc_tres_list}")
         # get Partitions
-        partition_start = self.output.index('Partitions=') + len('Partitions=')
-        partition_end = self.output.index('\n', partition_start)
-        partitions = self.output[partition_start:partition_end]
+        partitions = record.partitions
         self.cpu_count_per_gpu = self.get_cpu_available_count() // max(self.available_device_count,1)
         self.partitions = partitions
         return self.node_info
@@ -140,172 +141,458 @@ class StringNodeParser:
     # node01 -> node01
     # node[01,03-05,07] -> node01,node03,node04,node05,node07
     # anode[01-03],bnode[01-03] -> anode01,anode02,anode03,bnode01,bnode02,bnode03
-    # anode[01,03-05,07],bnode[01,03-05,07] -> anode01,anode03,anode04,anode05,anode07,bnode01,bnode03,bnode04,bnode05,bnode07
+    # rack[1-2]-gpu[01-02] -> rack1-gpu01,rack1-gpu02,rack2-gpu01,rack2-gpu02
+    # expansion is done by hostlist.expand, use hostlist.HostList directly to avoid building the list
     def __init__(self, node_string):
         self.node_string = node_string
-        self.node_list = []
-        self.parse()
-    def parse(self):
-        # get "," which is not inside []
-        comma_list = []
-        inside_bracket = False
-        for i, c in enumerate(self.node_string):
-            if c == '[':
-                inside_bracket = True
-            elif c == ']':
-                inside_bracket = False
-            elif c == ',' and not inside_bracket:
-                comma_list.append(i)
-        # split by ","
-        start = 0
-        for i in comma_list:
-            self.parse_node(self.node_string[start:i]) # anode[01-03] for example
-            start = i + 1
-        self.parse_node(self.node_string[start:])
-    def parse_node(self, node_string):
-        # if no bracket, just append
-        if '[' not in node_string:
-            self.node_list.append(node_string)
-            return
-        # parse bracket
-        bracket_start = node_string.index('[')
-        bracket_end = node_string.index(']')
-        prefix = node_string[:bracket_start]
-        # no suffix
-        # if singleton inside bracket (no comma), just append
-        if ',' not in node_string[bracket_start:bracket_end] and "-" not in node_string[bracket_start:bracket_end]:
-            self.node_list.append(prefix + node_string[bracket_start:bracket_end + 1])
-            return
-        # we can safely assume that there is no nested bracket so just split by comma
-        ranges = node_string[bracket_start + 1:bracket_end].split(',')
-        for r in ranges:
-            if '-' in r:
-                start, end = r.split('-')
-                for i in range(int(start), int(end) + 1):
-                    self.node_list.append(prefix + str(i).zfill(len(start)))
-            else:
-                self.node_list.append(prefix + r)
+        self.node_list = list(hostlist.expand(node_string))
     def get_node_list(self):
         return self.node_list
 
-for line in lines:
-    # PARTITION AVAIL  TIMELIMIT  NODES  STATE NODELIST
-    if line.startswith('PARTITION'):
-        continue
-    if line == '':
-        continue
-    partiition, avail, timelimit, nodes, state, nodelist = line.split()
-    # parse nodelist, nodename[01,03-05,07],... -> nodename01,nodename03,nodename04,nodename05,nodename07
-    # check singleton node
-    node_parser = StringNodeParser(nodelist)
-    node_list = node_parser.get_node_list()
-    #printif(node_list)
-    if state not in partition_list:
-        partition_list[state] = {}
-    partition_list[state][partiition] = node_list
-    
-# print partition_list
-# print list of idle partitions
-printif(f"Idle partitions: {list(partition_list.get('idle', {}).keys())} with nodes {list( partition_list.get('idle', {}).values())}")
-# csv contains Partition Name,Allowed QoS Names
-# read csv
-idle_commands = []
-mix_commands = []
-all_infos = []
-with open(partition_csv, 'r') as csvfile:
-    csvreader = csv.reader(csvfile)
-    empty_gpus = {}
-    for row in csvreader:
-        partition_name, qos_list, _ = row
-        if partition_name in ["test", "maintenance"]:
+def get_partition_list():
+    """
+    Runs sinfo and returns {"<status>" : {"<partition>" : ["<node>", "<node>", ...]}}
+    """
+    output = slurm_cache.run_cached(['sinfo'])
+    partition_list = {}
+    for line in output.split('\n'):
+        # PARTITION AVAIL  TIMELIMIT  NODES  STATE NODELIST
+        if line.startswith('PARTITION'):
+            continue
+        if line == '':
             continue
-        qos_list = qos_list.split('|')
-        if partition_name in partition_list.get('idle', {}):
-            #printif(f"Partition {partition_name} is idle with nodes {partition_list['idle'][partition_name]} and allowed QoS {qos_list}")
+        partiition, avail, timelimit, nodes, state, nodelist = line.split()
+        # parse nodelist, nodename[01,03-05,07],... -> nodename01,nodename03,nodename04,nodename05,nodename07
+        node_parser = StringNodeParser(nodelist)
+        node_list = node_parser.get_node_list()
+        if state not in partition_list:
+            partition_list[state] = {}
+        partition_list[state][partiition] = node_list
+    return partition_list
+
+def read_partition_csv(partition_csv=PARTITION_CSV):
+    """
+    csv contains Partition Name,Allowed QoS Names
+    returns [(partition_name, [qos, ...]), ...] without test / maintenance partitions
+    """
+    rows = []
+    with open(partition_csv, 'r') as csvfile:
+        for row in csv.reader(csvfile):
+            partition_name, qos_list, _ = row
+            if partition_name in ["test", "maintenance"]:
+                continue
+            rows.append((partition_name, qos_list.split('|')))
+    return rows
+
+def report_nodes(partition_list, partition_name, released_nodes=()):
+    """
+    (commands key, node) of the idle / mix nodes of partition_name, and of its allocated nodes in released_nodes
+    """
+    for state, commands_key in [('idle', "idle_commands"), ('mix', "mix_commands")] + [(state, "mix_commands") for state in RELEASED_STATES]:
+        for node in partition_list.get(state, {}).get(partition_name, []):
+            if state in RELEASED_STATES and node not in released_nodes:
+                continue
+            yield commands_key, node
+
+def collect_cluster_report(partition_csv=PARTITION_CSV, per_node=False, use_json=False, parallel=8, query_timeout=10.0, query_retries=2, released_job=None):
+    """
+    Reads every idle / mix node of the partitions in partition_csv
+    returns a dict with idle_commands, mix_commands, all_infos [(partitions, gpus, cpus per gpu)],
+    empty_gpus {partition : gpus}, unknown_nodes, qos / gres_name / gpu_type per planner partition name
+    and nodes {partition : [NodeResources]} for the node packing
+    released_job is a job about to end (the preempted job resubmitting itself), its gpus / cpus / memory count as free
+    """
+    released = None
+    if released_job:
+        with profiling.phase("released_job"):
+            released = query_job_allocation(released_job, timeout=query_timeout)
+        if released is None:
+            print(f"Job {released_job} holds no nodes, planning without it")
+    released_nodes = set(released.nodes) if released else set()
+    with profiling.phase("sinfo"):
+        partition_list = get_partition_list()
+    printif(f"Idle partitions: {list(partition_list.get('idle', {}).keys())} with nodes {[hostlist.compress(nodes) for nodes in partition_list.get('idle', {}).values()]}")
+    partition_rows = read_partition_csv(partition_csv)
+    with profiling.phase("scontrol"):
+        if per_node:
+            # scontrol per node, only for the idle / mix nodes of the partitions we care about
+            wanted_nodes = []
+            for partition_name, _ in partition_rows:
+                wanted_nodes.extend(node for _, node in report_nodes(partition_list, partition_name, released_nodes))
+            snapshot = ClusterSnapshot.from_nodes(wanted_nodes, parallelism=parallel, timeout=query_timeout, retries=query_retries)
+        else:
+            # one scontrol call for every node, NodeInfoParser reads from it
+            snapshot = ClusterSnapshot.from_scontrol(use_json=use_json)
+        if released is not None:
+            snapshot.release(released)
+    report = {
+        "idle_commands": [],
+        "mix_commands": [],
+        "all_infos": [],
+        "empty_gpus": {},
+        "unknown_nodes": [],
+        "qos": {}, # planner partition name -> qos
+        "gres_name": {}, # planner partition name -> gres name
+        "gpu_type": {}, # planner partition name -> gpu type (rtx3090, a100, ...) or None
+        "nodes": {}, # planner partition name -> [NodeResources] of the idle / mix nodes
+    }
+    with profiling.phase("parse"):
+        for partition_name, qos_list in partition_rows:
             # recommend srun --partition=suma_a100 --time=2:0 --nodes=1 --qos a100_qos --gres=gpu:1 --pty bash -i like command
-            #idle_commands.append(f"srun --partition={partition_name} --time=2:0 --nodes=1 --qos={qos_list[-1]} --gres=gpu:1 --pty bash -i")
-            for i in partition_list['idle'][partition_name]:
-                parser = NodeInfoParser(i)
-                idle_commands.append(parser.get_recommended_command(qos_list[-1]))
-                all_infos.append(parser.get_gpus_and_cpus_count())
-                if partition_name not in empty_gpus:
-                    empty_gpus[partition_name] = 0
-                empty_gpus[partition_name] += parser.available_device_count
-            #printif(NodeInfoParser(partition_list['idle'][partition_name][0]).get_recommended_command(qos_list[-1]))
-        if partition_name in partition_list["mix"]:
-            # get detailed info
-            for i in partition_list["mix"][partition_name]:
-                parser = NodeInfoParser(i)
-                mix_commands.append(parser.get_recommended_command(qos_list[-1]))
-                all_infos.append(parser.get_gpus_and_cpus_count())
-                if partition_name not in empty_gpus:
-                    empty_gpus[partition_name] = 0
-                empty_gpus[partition_name] += parser.available_device_count
-            #printif(NodeInfoParser(partition_list["mix"][partition_name][0]).get_recommended_command(qos_list[-1]))
-        # mix, get more detailed info
-from collections import defaultdict
+            for commands_key, i in report_nodes(partition_list, partition_name, released_nodes):
+                if snapshot.is_unknown(i):
+                    report["unknown_nodes"].append(i)
+                    continue
+                parser = NodeInfoParser(i, snapshot)
+                report[commands_key].append(parser.get_recommended_command(qos_list[-1]))
+                info = parser.get_gpus_and_cpus_count()
+                report["all_infos"].append(info)
+                report["qos"].setdefault(info[0], qos_list[-1].strip())
+                report["gres_name"].setdefault(info[0], parser.device_name)
+                report["gpu_type"].setdefault(info[0], throughput.gpu_type_of(parser.record.gres, info[0]))
+                report["nodes"].setdefault(info[0], []).append(node_packing.node_resources(
+                    parser.record, info[0], parser.available_device_count, parser.total_device_count, parser.get_cpu_available_count()))
+                if partition_name not in report["empty_gpus"]:
+                    report["empty_gpus"][partition_name] = 0
+                report["empty_gpus"][partition_name] += parser.available_device_count
+    for partition_name, gpus in report["empty_gpus"].items():
+        profiling.set_gauge("idle_gpus", gpus, partition=partition_name)
+    profiling.set_gauge("wasted_dollars_per_hour", get_wasted_price(report["empty_gpus"]))
+    return report
+
+def count_dominating(counts):
+    """
+    For every (gpus, cpus per gpu) key of counts returns how many entries have at least as many gpus and cpus
+    one sweep from the largest gpu count down, keeping a cumulative histogram over the cpu levels
+    """
+    cpu_levels = sorted({cpu_count for _, cpu_count in counts}, reverse=True)
+    cpu_index = {cpu_count: i for i, cpu_count in enumerate(cpu_levels)}
+    by_gpus = {}
+    for (gpus, cpu_count), count in counts.items():
+        by_gpus.setdefault(gpus, []).append((cpu_count, count))
+    histogram = [0] * len(cpu_levels)
+    dominating = {}
+    for gpus in sorted(by_gpus, reverse=True):
+        for cpu_count, count in by_gpus[gpus]:
+            histogram[cpu_index[cpu_count]] += count
+        cumulative = list(accumulate(histogram)) # entries with >= gpus and >= cpu level
+        for cpu_count, _ in by_gpus[gpus]:
+            dominating[(gpus, cpu_count)] = cumulative[cpu_index[cpu_count]]
+    return dominating
 
 # Function to compute the maximum node count * GPUs for a given minimal CPU count
-def max_nodes_x_gpus(data, cpu_min):
+def max_nodes_x_gpus(data, cpu_min, max_tres=max_tres, score=None):
+    """
+    data is [(partition, gpus, cpus per gpu)], one entry per node
+    returns {partition : (total gpus, gpus per node, nodes, cpus per gpu)}
+    without score the shape with the most gpus wins, score(partition, nodes, gpus per node) -> value
+    ranks every shape with up to the available nodes instead, ties go to fewer gpus
+    """
+    # group by partition and count identical (gpus, cpus) entries
+    # dict order keeps the first seen order, which the tie-break below depends on
+    groups = {}
+    for name, gpus, cpu_count in data:
+        # Filter out entries with a CPU count of zero and entries below the specified minimal CPU count
+        if cpu_count == 0 or cpu_count < cpu_min:
+            continue
+        counts = groups.setdefault(name, {})
+        counts[(gpus, cpu_count)] = counts.get((gpus, cpu_count), 0) + 1
+
     max_product = {}
+    best_score = {} # partition -> (score, -total gpus, cpus per gpu) with score
+    for name, counts in groups.items():
+        matches = count_dominating(counts)
+        for gpus, cpu_count in counts:
+            match_count = matches[(gpus, cpu_count)]
+            if gpus > 0:
+                # drop nodes until gpus * nodes fits in max_tres
+                match_count = min(match_count, max_tres // gpus)
+            product_num = gpus * match_count
+            if match_count == 0 or product_num == 0:
+                continue
+            if score is not None:
+                # fewer, fuller nodes may be faster than all of them
+                for nodes in range(1, match_count + 1):
+                    key = (score(name, nodes, gpus), -gpus * nodes, cpu_count)
+                    if name not in best_score or key > best_score[name]:
+                        best_score[name] = key
+                        max_product[name] = (gpus * nodes, gpus, nodes, cpu_count)
+                continue
+            if name not in max_product:
+                max_product[name] = (product_num, gpus, match_count, cpu_count)
+            elif product_num > max_product[name][0]: # smaller nodes are better
+                max_product[name] = (product_num, gpus, match_count, cpu_count)
+            elif product_num == max_product[name][0] and cpu_count > max_product[name][3] and max_product[name][2] >= match_count:
+                max_product[name] = (product_num, gpus, match_count, cpu_count)
+    return max_product
+
+def plans_from_report(report, max_tres=max_tres, cpu_min=5, objective="gpus", model=None, mem_per_gpu=None):
+    """
+    Runs the planner over a collect_cluster_report result, returns [AllocationPlan] sorted by partition
+    objective "gpus" takes the most gpus, "throughput" the best samples per second of model (ThroughputModel.load() by default)
+    each plan is pinned to its nodes by pin_plan, with fewer nodes when the memory of the nodes does not hold it
+    """
+    score = None
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective {objective}, expected one of {OBJECTIVES}")
+    if objective != "gpus":
+        # the fastest shape of each partition, rank_plans compares the partitions by the objective
+        model = model or throughput.ThroughputModel.load()
+        score = lambda name, nodes, gpus: model.samples_per_second(report.get("gpu_type", {}).get(name), nodes, gpus)
+    with profiling.phase("shapes"):
+        max_product_infos = max_nodes_x_gpus(report["all_infos"], cpu_min, max_tres, score)
+    plans = []
+    with profiling.phase("pack"):
+        for name in sorted(max_product_infos):
+            product_num, gpus, match_count, cpu_count = max_product_infos[name]
+            plan = pin_plan(report, build_plan(report, name, match_count, gpus, cpu_count, score(name, match_count, gpus) if score else None),
+                            mem_per_gpu, model)
+            if plan is not None:
+                plans.append(plan)
+    return plans
+
+def pin_plan(report, plan, mem_per_gpu=None, model=None):
+    """
+    plan with nodelist / mem_per_gpu set to the best-fit nodes of its partition, with fewer nodes if only fewer hold it,
+    None if no node does, plan unchanged if the report has no node resources
+    mem_per_gpu defaults to the smallest memory per gpu share of the partition's nodes
+    """
+    nodes = report.get("nodes", {}).get(plan.partition)
+    if not nodes:
+        return plan
+    mem_per_gpu = mem_per_gpu or node_packing.fair_mem_per_gpu(nodes)
+    names = node_packing.pack(nodes, plan.nodes, plan.gpus_per_node, plan.cpus_per_gpu, mem_per_gpu, plan.gpu_type)
+    if not names:
+        return None
+    if len(names) < plan.nodes:
+        samples_per_second = None
+        if plan.samples_per_second is not None:
+            model = model or throughput.ThroughputModel.load()
+            samples_per_second = model.samples_per_second(plan.gpu_type, len(names), plan.gpus_per_node)
+        plan = build_plan(report, plan.partition, len(names), plan.gpus_per_node, plan.cpus_per_gpu, samples_per_second)
+    return plan._replace(nodelist=hostlist.compress(names), mem_per_gpu=mem_per_gpu)
+
+def build_plan(report, name, nodes, gpus, cpu_count, samples_per_second=None):
+    price = price_per_gpu_hour(name)
+    return AllocationPlan(
+        partition=name.strip(),
+        nodes=nodes,
+        gpus_per_node=gpus,
+        cpus_per_gpu=cpu_count,
+        qos=report["qos"].get(name, ""),
+        gres_name=report["gres_name"].get(name) or "gpu",
+        total_gpus=nodes * gpus,
+        samples_per_second=samples_per_second,
+        gpu_type=report.get("gpu_type", {}).get(name),
+        price_per_hour=price * nodes * gpus if price is not None else None,
+    )
 
-    # Filter out entries with a CPU count of zero and entries below the specified minimal CPU count
-    filtered_data = [entry for entry in data if entry[2] != 0 and entry[2] >= cpu_min]
-
-    # Compute the maximum product of nodes and GPUs for each partition
-    for name, gpus, cpu_count in filtered_data:
-        matching_entries = [x for x in filtered_data if x[0] == name and x[1] >= gpus and x[2] >= cpu_count]
-        match_count = len(matching_entries)
-        product_num = gpus * match_count
-        if product_num > max_tres:
-            while product_num > max_tres:
-                product_num -= gpus
-                match_count -= 1
-        if match_count == 0 or product_num == 0:
+def candidate_shapes(data, cpu_min, max_tres=max_tres):
+    """
+    Every (partition, nodes, gpus per node, cpus per gpu) the nodes of data can hold with at most max_tres gpus,
+    the largest cpus per gpu is kept for each (partition, nodes, gpus per node)
+    """
+    groups = {}
+    for name, gpus, cpu_count in data:
+        if cpu_count == 0 or cpu_count < cpu_min or gpus <= 0:
             continue
-        if name not in max_product:
-            max_product[name] = (product_num, gpus, match_count, cpu_count)
-        elif product_num > max_product[name][0]: # smaller nodes are better
-            max_product[name] = (product_num, gpus, match_count, cpu_count)
-        elif product_num == max_product[name][0] and cpu_count > max_product[name][3] and max_product[name][2] >= match_count:
-            max_product[name] = (product_num, gpus, match_count, cpu_count)
-    return max_product
+        counts = groups.setdefault(name, {})
+        counts[(gpus, cpu_count)] = counts.get((gpus, cpu_count), 0) + 1
+    shapes = {}
+    for name, counts in groups.items():
+        matches = count_dominating(counts)
+        for gpus, cpu_count in counts:
+            for nodes in range(1, min(matches[(gpus, cpu_count)], max_tres // gpus) + 1):
+                key = (name, nodes, gpus)
+                shapes[key] = max(shapes.get(key, 0), cpu_count)
+    return [key + (cpu_count,) for key, cpu_count in shapes.items()]
+
+def candidate_plans(report, max_tres=max_tres, cpu_min=5, model=None, mem_per_gpu=None):
+    """
+    An AllocationPlan for every candidate shape the nodes hold, with the samples per second of model (ThroughputModel.load() by default)
+    each pinned to its nodes by pin_plan, shapes that only fit on fewer nodes are left out
+    """
+    model = model or throughput.ThroughputModel.load()
+    plans = []
+    with profiling.phase("pack"):
+        for name, nodes, gpus, cpu_count in candidate_shapes(report["all_infos"], cpu_min, max_tres):
+            plan = pin_plan(report, build_plan(report, name, nodes, gpus, cpu_count, model.samples_per_second(report.get("gpu_type", {}).get(name), nodes, gpus)),
+                            mem_per_gpu, model)
+            if plan is not None and plan.nodes == nodes:
+                plans.append(plan)
+    return plans
 
-# Example usage
-cpu_min = 5
-max_product_infos = max_nodes_x_gpus(all_infos, cpu_min)
-
-# Print the results for each partition name
-for name in sorted(max_product_infos):
-    # print name, total gpus, gpus per node, nodes, cpus per gpu
-    printif(f"{name.strip()}: total gpus {max_product_infos[name][0]}, gpus per node {max_product_infos[name][1]}, nodes {max_product_infos[name][2]}, cpus per gpu {max_product_infos[name][3]}")
-    if args.partition in name.strip() and args.sbatch:
-        # format
-        # SBATCH --partition=name
-        # SBATCH --time=72:0:0
-        # SBATCH --nodes={max_product_infos[name][2]}
-        # SBATCH --cpus-per-gpu={max_product_infos[name][3]}
-        # SBATCH --gres={gres_name}:{max_product_infos[name][1]}
-        print(f"#SBATCH --nodes={max_product_infos[name][2]}")
-        print(f"#SBATCH --cpus-per-gpu={max_product_infos[name][3]}")
-        print(f"#SBATCH --gres=gpu:{max_product_infos[name][1]}")
-printif("Idle commands:")
-for c in idle_commands:
-    if "gpu:0" in c:
-        continue
-    printif(c)
-printif("Mix commands:")
-for c in mix_commands:
-    if "gpu:0" in c:
-        continue
-    printif(c)
-
-# print empty gpus
-printif(f"Empty GPUs: {empty_gpus}")
-# get price that is being wasted
-price = 0
-for keys, values in empty_gpus.items():
+def get_allocation_plans(max_tres=max_tres, cpu_min=5, partition_csv=PARTITION_CSV, objective="gpus", mem_per_gpu=None, **report_kwargs):
+    """
+    Library entry point, returns [AllocationPlan] sorted by partition
+    report_kwargs are passed to collect_cluster_report (per_node, use_json, parallel, ...)
+    """
+    return plans_from_report(collect_cluster_report(partition_csv, **report_kwargs), max_tres, cpu_min, objective, mem_per_gpu=mem_per_gpu)
+
+def price_per_gpu_hour(partition):
+    # PRICES keys are matched against the partition name like get_wasted_price, None if no key matches
     for key in PRICES:
-        if key in keys:
-            price += values * PRICES[key]
-printif(f"{price:1f}$/hour is being wasted!")
+        if key in partition:
+            return PRICES[key]
+    return None
+
+def objective_value(plan, objective, model=None, target_steps=1, global_batch=None):
+    """
+    gpus: total gpus, throughput: samples per second, samples_per_dollar: samples per $ at the PRICES rate,
+    time_to_step: seconds for target_steps steps, of global_batch samples each when set (elastic) or of the model step otherwise
+    """
+    if objective == "gpus":
+        return plan.total_gpus
+    samples_per_second = plan.samples_per_second or 0.0
+    if objective == "throughput":
+        return samples_per_second
+    if objective == "samples_per_dollar":
+        # unknown prices rank last
+        return samples_per_second * 3600 / plan.price_per_hour if plan.price_per_hour else 0.0
+    if objective == "time_to_step":
+        if samples_per_second <= 0:
+            return float("inf")
+        if global_batch:
+            return target_steps * global_batch / samples_per_second
+        model = model or throughput.ThroughputModel.load()
+        return target_steps * model.step_seconds(plan.gpu_type, plan.nodes, plan.gpus_per_node)
+    raise ValueError(f"Unknown objective {objective}, expected one of {OBJECTIVES}")
+
+def rank_plans(plans, objective, model=None, target_steps=1, global_batch=None):
+    """
+    Plans of every partition best first by objective, with score set to the objective value
+    """
+    scored = [plan._replace(score=objective_value(plan, objective, model, target_steps, global_batch)) for plan in plans]
+    return sorted(scored, key=lambda plan: plan.score, reverse=objective not in LOWER_IS_BETTER)
+
+def select_plan(plans, partition_name, objective="gpus", **rank_kwargs):
+    """
+    Returns the plan of partition_name, or else the first plan whose partition contains it, None if there is none
+    partition_name "auto" returns the best plan of any partition by objective, rank_kwargs are passed to rank_plans
+    """
+    if partition_name == AUTO_PARTITION:
+        ranked = rank_plans(plans, objective, **rank_kwargs)
+        return ranked[0] if ranked else None
+    for plan in plans:
+        if plan.partition == partition_name:
+            return plan
+    for plan in plans:
+        if partition_name in plan.partition:
+            return plan
+    return None
+
+def format_sbatch_lines(plan):
+    """
+    #SBATCH lines for --nodes, --cpus-per-gpu, --gres, --partition and --qos, in this order,
+    then --nodelist and --mem-per-gpu of a pinned plan
+    """
+    lines = [
+        f"#SBATCH --nodes={plan.nodes}",
+        f"#SBATCH --cpus-per-gpu={plan.cpus_per_gpu}",
+        f"#SBATCH --gres={plan.gres_name}:{plan.gpus_per_node}",
+        f"#SBATCH --partition={plan.partition}",
+    ]
+    if plan.qos:
+        lines.append(f"#SBATCH --qos={plan.qos}")
+    if plan.nodelist:
+        lines.append(f"#SBATCH --nodelist={plan.nodelist}")
+    if plan.mem_per_gpu:
+        lines.append(f"#SBATCH --mem-per-gpu={plan.mem_per_gpu}M")
+    return lines
+
+def get_wasted_price(empty_gpus):
+    # get price that is being wasted
+    price = 0
+    for keys, values in empty_gpus.items():
+        for key in PRICES:
+            if key in keys:
+                price += values * PRICES[key]
+    return price
+
+def main(argv=None):
+    global verbose
+    parser = argparse.ArgumentParser(description='Get idle partitions and recommend commands')
+    parser.add_argument('--sbatch', action='store_true', help='Print sbatch instead of srun')
+    parser.add_argument('--json', action='store_true', help='Print the allocation plans as json')
+    parser.add_argument('--partition', type=str, help='Partition name to get info', default="")
+    parser.add_argument('--partition_csv', type=str, help='Partition Name,Allowed QoS Names csv', default=PARTITION_CSV)
+    parser.add_argument("--max_tres", type=int, help="Maximum TRES", default=48)
+    parser.add_argument("--objective", type=str, choices=OBJECTIVES, help="Pick the shape with the most gpus, or rank the partitions by the predicted samples/s of throughput.py, samples per $ or time to --target_steps", default="gpus")
+    parser.add_argument("--target_steps", type=int, help="Steps for the time_to_step objective", default=1)
+    parser.add_argument("--global_batch", type=int, help="Samples per step for the time_to_step objective, default is the model's per-gpu batch x gpus", default=None)
+    parser.add_argument("--mem_per_gpu", type=int, help="Host memory (MB) per gpu the nodes must have free, default is the smallest per gpu share of the partition's nodes", default=None)
+    parser.add_argument("--per_node", action='store_true', help="Query each node with its own scontrol call instead of one cluster snapshot")
+    parser.add_argument("--scontrol_json", action='store_true', help="Use scontrol --json for the cluster snapshot where available")
+    parser.add_argument("--parallel", type=int, help="Concurrent scontrol calls with --per_node", default=8)
+    parser.add_argument("--query_timeout", type=float, help="Seconds before a --per_node query is given up", default=10.0)
+    parser.add_argument("--query_retries", type=int, help="Retries for a failed --per_node query", default=2)
+    parser.add_argument("--cache_ttl", type=float, help="Seconds sinfo / scontrol results are reused from the local cache, 0 disables it", default=None)
+    parser.add_argument("--refresh", action='store_true', help="Ignore cached sinfo / scontrol results")
+    parser.add_argument("--record_capacity", action='store_true', help="Also append this snapshot to the capacity_sampler.py store")
+    parser.add_argument("--profile", action='store_true', help="Print the seconds of each phase and the scheduler command calls to stderr")
+    parser.add_argument("--metrics_file", type=str, help="Write planning latency, idle gpus and wasted $/hour to a .prom textfile or append them to a json lines file", default=None)
+    args = parser.parse_args(argv)
+    slurm_cache.configure(ttl=args.cache_ttl, refresh_cache=args.refresh)
+    verbose = not (args.sbatch or args.json)
+
+    with profiling.phase(profiling.PLAN_PHASE):
+        report = collect_cluster_report(args.partition_csv, per_node=args.per_node, use_json=args.scontrol_json,
+                                        parallel=args.parallel, query_timeout=args.query_timeout, query_retries=args.query_retries)
+        cpu_min = 5
+        plans = plans_from_report(report, args.max_tres, cpu_min, args.objective, mem_per_gpu=args.mem_per_gpu)
+        if args.objective != "gpus" or args.partition == AUTO_PARTITION:
+            # best partition first, --partition auto keeps only that one
+            plans = rank_plans(plans, args.objective, target_steps=args.target_steps, global_batch=args.global_batch)
+    if args.record_capacity:
+        from capacity_sampler import CapacityStore
+        CapacityStore().record(report)
+    if args.metrics_file:
+        profiling.write_metrics(args.metrics_file, "auto_qos")
+    if args.profile:
+        print(profiling.summary(), file=sys.stderr)
+    if args.partition == AUTO_PARTITION:
+        plans = plans[:1]
+        args.partition = ""
+    price = get_wasted_price(report["empty_gpus"])
+    if args.json:
+        print(json.dumps({
+            "plans": [plan._asdict() for plan in plans if args.partition in plan.partition],
+            "empty_gpus": report["empty_gpus"],
+            "wasted_per_hour": price,
+            "unknown_nodes": report["unknown_nodes"],
+        }, indent=2))
+        return
+
+    # Print the results for each partition name
+    for plan in plans:
+        # print name, total gpus, gpus per node, nodes, cpus per gpu
+        predicted = f", predicted {plan.samples_per_second:.2f} samples/s" if plan.samples_per_second is not None else ""
+        if plan.price_per_hour is not None:
+            predicted += f", {plan.price_per_hour:.2f}$/hour"
+        if args.objective != "gpus":
+            predicted += f", {args.objective} {plan.score:.4g}"
+        if plan.nodelist:
+            predicted += f", on {plan.nodelist}" + (f" with {plan.mem_per_gpu}M per gpu" if plan.mem_per_gpu else "")
+        printif(f"{plan.partition}: total gpus {plan.total_gpus}, gpus per node {plan.gpus_per_node}, nodes {plan.nodes}, cpus per gpu {plan.cpus_per_gpu}{predicted}")
+        if args.partition in plan.partition and args.sbatch:
+            for line in format_sbatch_lines(plan):
+                print(line)
+    printif("Idle commands:")
+    for c in report["idle_commands"]:
+        if "gpu:0" in c:
+            continue
+        printif(c)
+    printif("Mix commands:")
+    for c in report["mix_commands"]:
+        if "gpu:0" in c:
+            continue
+        printif(c)
+
+    if report["unknown_nodes"]:
+        printif(f"Unknown nodes (query failed or timed out): {report['unknown_nodes']}")
+    # print empty gpus
+    printif(f"Empty GPUs: {report['empty_gpus']}")
+    printif(f"{price:1f}$/hour is being wasted!")
+
+if __name__ == "__main__":
+    main()
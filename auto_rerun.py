@@ -1,8 +1,21 @@
 import toml
 import os
-import json
+import sys
+import time
+import re
+import shlex
+import asyncio
 import subprocess
 import datetime
+from contextlib import contextmanager
+import auto_qos
+import elastic
+import profiling
+import queue_wait
+import slurm_cache
+from job_logs import JobLogClassifier
+from checkpoints import CheckpointIndex, default_sort_key
+from rerun_state import StateStore, STATE_DB
 
 CHECKPOINT_DIR = "outputs/"
 INITIAL_CHECKPOINT_NAME = "step.safetensors"
@@ -10,51 +23,137 @@ BATCH_SIZE = 12
 max_tres = 48
 PARTITION_NAME="big_suma_rtx3090"
 WEIGHT_NAME_FORMAT = "{now}_delta_lokr_bs{BATCH_SIZE}_multinode_l2"
-
-def get_datetime(filename):
-    return filename.split("_")[0]
+CHECKPOINT_SORT_KEY = default_sort_key # checkpoint file name -> (datetime, step), newest is largest
+# job_logs outcomes that are resubmitted
+RERUN_OUTCOMES = {"preempted", "completed", "node_failure", "nccl_timeout"}
+# squeue states of a job that got its allocation, the first competitor in one of them wins
+STARTED_STATES = {"CONFIGURING", "RUNNING", "COMPLETING", "SIGNALING", "STAGE_OUT"}
+# squeue / sacct states of a job that has not ended yet
+ACTIVE_STATES = {"PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "RESIZING", "SUSPENDED", "STOPPED", "SIGNALING", "STAGE_OUT"}
+# preemption hook: Slurm signals the batch shell signal_secs before the job ends, the trap installed between the markers
+# asks the training steps to save and resubmits from inside the allocation
+PREEMPTION_SIGNAL = "USR1"
+HOOK_BEGIN = "# >>> auto_rerun preemption hook >>>"
+HOOK_END = "# <<< auto_rerun preemption hook <<<"
+HOOK_WAIT_LINE = "until wait; do :; done # a trapped signal interrupts wait, wait again for the steps and the resubmission\n"
+SAVE_REQUEST_FILE = "save_request" # touched in the campaign directory when the signal arrives, for trainers that poll it
+SUBMIT_MARGIN = 30 # seconds of the signal lead time kept for planning and sbatch after waiting for the checkpoint
+# options of a pinned plan, removed from the sbatch file when the new plan is not pinned so old nodes are not requested
+PINNING_OPTIONS = ["--nodelist", "--mem-per-gpu"]
+# options of the allocation shape, in the order of auto_qos.format_sbatch_lines
+SHAPE_OPTIONS = ["--nodes", "--cpus-per-gpu", "--gres", "--partition", "--qos"]
+SUBMITTED_PATTERN = re.compile(r"Submitted batch job (\d+)")
 
 def get_newest_checkpoint():
-    return CHECKPOINT_DIR + sorted([f for f in os.listdir(CHECKPOINT_DIR) if f.endswith(".safetensors")], key=lambda x: (get_datetime(x), int(x.split("-")[-1].split(".")[0].lstrip("step").lstrip("0"))))[-1]
+    # newest checkpoint whose safetensors header matches its file size, truncated ones are skipped
+    index = CheckpointIndex(CHECKPOINT_DIR, sort_key=CHECKPOINT_SORT_KEY)
+    checkpoint_name = index.newest()
+    if checkpoint_name is None:
+        raise FileNotFoundError(f"No valid checkpoint in {CHECKPOINT_DIR}")
+    skipped = index.invalid_newer_than(checkpoint_name)
+    if skipped:
+        print(f"Skipping incomplete checkpoints {skipped}, falling back to {checkpoint_name}")
+    return CHECKPOINT_DIR + checkpoint_name
+
+def plan_allocations(partition_name, max_tres, objective="gpus", count=1, mem_per_gpu=None, released_job=None, **rank_kwargs):
+    """
+    Returns up to count AllocationPlans, the preferred one first, pinned to the best-fit nodes with mem_per_gpu MB per gpu
+    "time_to_result" ranks every candidate shape by the expected queue wait + run time of queue_wait,
+    the other objectives rank one plan per partition for partition_name "auto" or take the plan of partition_name
+    the allocation of released_job (the preempted job planning its successor) counts as free
+    rank_kwargs: target_steps, global_batch
+    """
+    with profiling.phase(profiling.PLAN_PHASE):
+        if objective == queue_wait.OBJECTIVE:
+            return queue_wait.best_plans(max_tres, partition_name, count, mem_per_gpu=mem_per_gpu, released_job=released_job, **rank_kwargs)
+        plans = auto_qos.get_allocation_plans(max_tres=max_tres, objective=objective, mem_per_gpu=mem_per_gpu, released_job=released_job)
+        if partition_name == auto_qos.AUTO_PARTITION:
+            return auto_qos.rank_plans(plans, objective, **rank_kwargs)[:count]
+        plan = auto_qos.select_plan(plans, partition_name)
+        return [plan] if plan else []
 
-def get_sbatch_capability(partition_name, max_tres):
+def get_sbatch_capability(partition_name, max_tres, objective="gpus", **rank_kwargs):
     """
     Returns the capability of the partition_name
-    returns nodes, cpus-per-gpu, gres
+    returns nodes, cpus-per-gpu, gres, partition, qos
+    objective is passed to the planner, "throughput" picks the shape with the best predicted samples per second,
+    partition_name "auto" takes the partition that is best by objective
+    """
+    plans = plan_allocations(partition_name, max_tres, objective, 1, **rank_kwargs)
+    if not plans:
+        raise RuntimeError(f"No allocation available for partition {partition_name}")
+    return auto_qos.format_sbatch_lines(plans[0])
+
+def sbatch_option(line):
+    # "#SBATCH --nodes=2 # comment" -> "--nodes", None for other lines
+    words = line.split()
+    return words[1].split("=")[0] if len(words) > 1 and words[0] == "#SBATCH" else None
+
+def sbatch_value(line):
+    # "#SBATCH --nodes=2 # comment" or "#SBATCH --nodes 2" -> "2", None without a value
+    words = line.split()
+    if "=" in words[1]:
+        return words[1].split("=", 1)[1]
+    return words[2] if len(words) > 2 and not words[2].startswith("#") else None
+
+def current_sbatch_lines(filename):
     """
-    sbatch_string = subprocess.run(["python", "auto_qos.py", "--sbatch", f"--max_tres={max_tres}","--partition={}".format(partition_name)], stdout=subprocess.PIPE).stdout.decode("utf-8")
-    return sbatch_string.split("\n")
+    The #SBATCH shape lines filename already has, in the order of auto_qos.format_sbatch_lines and without pinning
+    """
+    lines = {}
+    with open(filename, "r") as f:
+        for line in f:
+            option = sbatch_option(line)
+            if option in SHAPE_OPTIONS and sbatch_value(line) is not None:
+                lines.setdefault(option, f"#SBATCH {option}={sbatch_value(line)}")
+    return [lines[option] for option in SHAPE_OPTIONS if option in lines]
 
-def read_and_replace_lines(filename, partition_name, max_tres):
+def read_and_replace_lines(filename, partition_name, max_tres, objective="gpus", replacements=None, **rank_kwargs):
+    """
+    Rewrites the #SBATCH --nodes, --cpus-per-gpu, --gres, --partition, --qos, --nodelist and --mem-per-gpu lines of filename
+    for the planned allocation (or for the given replacement lines), options the file does not set are added after its last #SBATCH line
+    and --nodelist / --mem-per-gpu lines are removed when the allocation does not set them
+    returns the batch size for the weight name and the number of gpus (world size)
+    raises ValueError when the replacement lines miss --nodes, --gres or --partition
+    """
     with open(filename, "r") as f:
         lines = f.readlines()
-    replacements = get_sbatch_capability(partition_name, max_tres)
-    replaced_success = [False, False, False]
+    replacements = replacements or get_sbatch_capability(partition_name, max_tres, objective, **rank_kwargs)
+    # "#SBATCH --nodes=2" -> {"--nodes" : "#SBATCH --nodes=2"}
+    pending = {sbatch_option(line): line for line in replacements}
+    missing = [option for option in ["--nodes", "--gres", "--partition"] if option not in pending or sbatch_value(pending[option]) is None]
+    if missing:
+        raise ValueError(f"No {', '.join(missing)} in the #SBATCH lines for {filename}: {replacements}")
+    node_count = int(sbatch_value(pending["--nodes"]))
+    gpu_count = int(sbatch_value(pending["--gres"]).split(":")[-1])
+    partition = sbatch_value(pending["--partition"])
+    stale = [option for option in PINNING_OPTIONS if option not in pending]
     for i, line in enumerate(lines):
-        # find --nodes= string, --cpus-per-gpu= string, --gres= string and replace them
-        if "--nodes=" in line and not replaced_success[0]:
-            lines[i] = replacements[0] + "\n"
-            node_count = int(replacements[0].split("=")[1])
-            replaced_success[0] = True
-        elif "--cpus-per-gpu=" in line and not replaced_success[1]:
-            lines[i] = replacements[1]+ "\n"
-            replaced_success[1] = True
-        elif "--gres=" in line and not replaced_success[2]:
-            lines[i] = replacements[2]+ "\n"
-            gpu_count = int(replacements[2].split(":")[1])
-            replaced_success[2] = True
+        # the first #SBATCH line of each option is replaced
+        if sbatch_option(line) in pending:
+            lines[i] = pending.pop(sbatch_option(line)) + "\n"
+    lines = [line for line in lines if sbatch_option(line) not in stale]
+    last_sbatch = max((i for i, line in enumerate(lines) if line.startswith("#SBATCH")), default=0)
+    lines[last_sbatch + 1:last_sbatch + 1] = [line + "\n" for line in pending.values()]
     total_batch_size = BATCH_SIZE * gpu_count
     with open(filename, "w") as f:
         f.writelines(lines)
-    print(f"Updated the sbatch capability with {node_count} nodes, {gpu_count} gpus, {total_batch_size} batch size")
-    return total_batch_size
+    print(f"Updated the sbatch capability with {node_count} nodes, {gpu_count} gpus on {partition}, {total_batch_size} batch size")
+    return total_batch_size, node_count * gpu_count
 
-def replace_checkpoint_name(filename, batch_size):
+def replace_checkpoint_name(filename, batch_size, elastic_settings=None, world_size=None):
     # with toml
     with open(filename, "r") as f:
         config = toml.load(f)
     checkpoint_name = get_newest_checkpoint()
     config["training_arguments"]["network_weights"] = checkpoint_name
+    if elastic_settings:
+        # keep the global batch of the run whatever the allocation is
+        plan = elastic.plan_batch(elastic_settings["target_global_batch"], world_size, elastic_settings.get("max_per_gpu_batch", BATCH_SIZE),
+                                  elastic_settings.get("batch_tolerance", elastic.BATCH_TOLERANCE))
+        elastic.apply_to_config(config, plan, elastic_settings)
+        batch_size = plan.global_batch
+        print(f"Elastic batch: {plan.world_size} gpus x {plan.per_gpu_batch} x {plan.accumulation_steps} accumulation steps = {plan.global_batch}")
     # update extra_arguments.wandb_run_name and extra_arguments.output_name
     datetime_str = datetime.datetime.now().strftime("%m%d%H%M")
     config["extra_arguments"]["wandb_run_name"] = WEIGHT_NAME_FORMAT.format(now=datetime_str, BATCH_SIZE=batch_size)
@@ -63,115 +162,481 @@ def replace_checkpoint_name(filename, batch_size):
         toml.dump(config, f)
     print(f"Updated the checkpoint name to {checkpoint_name}")
 
-def check_previous_job_status():
-    # check if the previous job is finished
-    if os.path.exists("auto_rerun.txt"):
-        with open("auto_rerun.txt", "r") as f:
-            # get last line
-            rerun_job_id = f.readlines()[-1]
-        print(f"Rerunning job {rerun_job_id}")
-        # check the status of the job
-        #squeue --job=<job_id>
-        job_status = subprocess.run(["squeue", "--job={}".format(rerun_job_id)], stdout=subprocess.PIPE).stdout.decode("utf-8")
-        # if the message was not error, then the job is still running
-        if "NODES" in job_status and str(rerun_job_id) in job_status:
-            print("The previous job is still running, ending script")
-            return False
-        else:
-            print("The previous job is finished, may require rerun")
-            return True
+def preemption_hook_lines(campaign_name, state_db, workdir, signal_secs):
+    # the trap block, the rerun runs in the background so the batch shell keeps waiting for the steps to save
+    command = [sys.executable, os.path.abspath(__file__), "--campaign", campaign_name, "--state_db", os.path.abspath(state_db),
+               "--preempted_job", "$SLURM_JOB_ID", "--save_timeout", str(max(signal_secs - SUBMIT_MARGIN, 0))]
+    command = " ".join('"$SLURM_JOB_ID"' if word == "$SLURM_JOB_ID" else shlex.quote(word) for word in command)
+    return [
+        HOOK_BEGIN,
+        f"export AUTO_RERUN_SAVE_REQUEST={shlex.quote(os.path.join(os.path.abspath(workdir), SAVE_REQUEST_FILE))}",
+        'rm -f "$AUTO_RERUN_SAVE_REQUEST"',
+        "on_preemption_signal() {",
+        f'    echo "Received SIG{PREEMPTION_SIGNAL}, requesting a checkpoint and resubmitting"',
+        '    touch "$AUTO_RERUN_SAVE_REQUEST"',
+        "    # srun forwards the signal to the tasks of its step",
+        f"    kill -{PREEMPTION_SIGNAL} $(jobs -p) 2>/dev/null",
+        f"    (cd {shlex.quote(os.path.abspath(workdir))} && {command}) &",
+        "}",
+        f"trap on_preemption_signal {PREEMPTION_SIGNAL}",
+        HOOK_END,
+    ]
+
+def install_preemption_hook(filename, campaign_name, state_db, workdir, signal_secs):
+    """
+    Sets #SBATCH --signal=B:USR1@signal_secs in filename and installs the trap block after its #SBATCH lines,
+    replacing the ones of an earlier install
+    the trap needs the steps launched with srun ... & and a wait, the bare wait line becomes a loop that waits again
+    after the signal (it is appended if there is none, then a foreground srun delays the trap until the step ended)
+    """
+    with open(filename, "r") as f:
+        lines = f.readlines()
+    if HOOK_BEGIN + "\n" in lines and HOOK_END + "\n" in lines:
+        del lines[lines.index(HOOK_BEGIN + "\n"):lines.index(HOOK_END + "\n") + 1]
+    lines = [HOOK_WAIT_LINE if line.strip() == "wait" else line for line in lines]
+    if HOOK_WAIT_LINE not in lines:
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        lines.append(HOOK_WAIT_LINE)
+    signal = f"#SBATCH --signal=B:{PREEMPTION_SIGNAL}@{signal_secs}\n"
+    signal_index = next((i for i, line in enumerate(lines) if sbatch_option(line) == "--signal"), None)
+    if signal_index is not None:
+        lines[signal_index] = signal
     else:
-        print("No previous job to rerun")
+        last_sbatch = max((i for i, line in enumerate(lines) if line.startswith("#SBATCH")), default=0)
+        lines.insert(last_sbatch + 1, signal)
+    last_sbatch = max((i for i, line in enumerate(lines) if line.startswith("#SBATCH")), default=0)
+    lines[last_sbatch + 1:last_sbatch + 1] = [line + "\n" for line in preemption_hook_lines(campaign_name, state_db, workdir, signal_secs)]
+    with open(filename, "w") as f:
+        f.writelines(lines)
+    print(f"Installed the preemption hook in {filename}, SIG{PREEMPTION_SIGNAL} {signal_secs}s before the end of the job")
+
+def wait_for_new_checkpoint(timeout, interval=2.0):
+    """
+    Waits up to timeout seconds for a valid checkpoint newer than the current newest one, returns the newest
+    """
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return None
+    index = CheckpointIndex(CHECKPOINT_DIR, sort_key=CHECKPOINT_SORT_KEY)
+    before = index.newest()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(min(interval, max(deadline - time.time(), 0)))
+        newest = index.newest()
+        if newest != before:
+            print(f"New checkpoint {newest}")
+            return newest
+    print(f"No new checkpoint after {timeout}s, resubmitting from {before}")
+    return before
+
+def check_previous_job_status(job_id):
+    # check if the previous job is finished
+    print(f"Checking job {job_id}")
+    # check the status of the job
+    #squeue --job=<job_id>
+    job_status = slurm_cache.run_cached(["squeue", "--job={}".format(job_id)], check=False)
+    # if the message was not error, then the job is still running
+    if "NODES" in job_status and str(job_id) in job_status:
+        print("The previous job is still running, ending script")
         return False
+    else:
+        print("The previous job is finished, may require rerun")
+        return True
 
-def log_job_id(job_id):
-    with open("auto_rerun.txt", "a") as f:
-        f.write(job_id)
+def classify_job(job_id, bash_file=None):
+    # the logs are found from the --output / --error patterns of bash_file and read from the end
+    print(f"Checking logs of job_id {job_id.strip()}")
+    result = JobLogClassifier(bash_file).classify(job_id)
+    print(f"The job ended as {result.outcome} (sacct: {result.sacct_state}, logs: {result.files})")
+    return result.outcome
 
-def check_job_logs_if_preemptied(job_id):
+def check_job_logs_if_preemptied(job_id, bash_file=None):
     # check if the job was preemptied
-    # check the logs of the job
-    # we have to read files with *job_id*
-    # if the file contains "PREEMPTIED", then the job was preemptied
-    # if the file contains "COMPLETED", then the job was completed
-    # either way, we have to rerun the job
-    print(f"Checking files with job_id {job_id}")
-    files = [f for f in os.listdir() if job_id in f]
-    for file in files:
-        with open(file, "r") as f:
-            if "PREEMPTIED" in f.read():
-                print("The job was preemptied")
-                return True
-            elif "COMPLETED" in f.read():
-                print("The job was completed")
-                return True
-    return False # failed from error
-
-def main(bash_file, config_file, force, max_tres):
-    # check if the previous job is finished
-    if not check_previous_job_status():
-        # check if the job was preemptied
-        return
-    if os.path.exists("auto_rerun.txt"):
-        with open("auto_rerun.txt", "r") as f:
-            # get last line
-            job_id = f.readlines()[-1]
-    if not force and not check_job_logs_if_preemptied(job_id):
-        return
-    batch_size = read_and_replace_lines(bash_file, PARTITION_NAME, max_tres)
-    # update the checkpoint name
-    replace_checkpoint_name(config_file, batch_size)
-    #sbatch <filename>
-    job_id = subprocess.run(["sbatch", bash_file], stdout=subprocess.PIPE).stdout.decode("utf-8")
+    # preempted, completed, node failure and NCCL timeout are rerun, OOM and other errors are not
+    return classify_job(job_id, bash_file) in RERUN_OUTCOMES
+
+def submit(bash_file, sbatch_args=()):
+    #sbatch [options] <filename>, command line options override the #SBATCH lines
+    # raises when sbatch fails (a slurmctld timeout, a rejected option), the claimed submission is released by the caller
+    process = profiling.run(["sbatch", *sbatch_args, bash_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.stdout.decode("utf-8")
     # Submitted batch job 660060
-    print(f"Submitted batch job {job_id}")
-    job_id = job_id.split(" ")[-1]
-    log_job_id(job_id)
-
-def log_bash_configs(bash_file, config_file, job_id, active):
-    if not os.path.exists("auto_rerun_infos.json"):
-        infos = {"bash_file": bash_file, "config_file": config_file, "job_id" : job_id, "active" : active}
-        with open("auto_rerun_infos.json", "w") as f:
-            json.dump(infos, f)
+    print(output.strip())
+    match = SUBMITTED_PATTERN.search(output)
+    if process.returncode != 0 or match is None:
+        raise RuntimeError(f"sbatch {bash_file} failed with exit code {process.returncode}: {process.stderr.decode('utf-8').strip()}")
+    return match.group(1)
+
+def rerun(bash_file, config_file, max_tres, options=None, campaign_name=None, state_db=STATE_DB, released_job=None):
+    """
+    replace sbatch lines -> replace checkpoint name -> sbatch, returns the new job ids, the preferred allocation first
+    options are the campaign options: partition ("auto" for the best one), objective, target_steps,
+    elastic (the batch / accumulation / lr of the config follow the allocation),
+    compete (submit the best n allocations, the others with sbatch command line overrides),
+    signal_secs (install the preemption hook of campaign_name, needs campaign_name)
+    released_job is the preempted job resubmitting from its trap, its allocation counts as free, and without a plan
+    its current shape is resubmitted unpinned to queue for the partition it is leaving
+    """
+    options = options or {}
+    elastic_settings = options.get("elastic")
+    compete = options.get("compete", 1)
+    if compete > 1 and elastic_settings:
+        raise ValueError("Competing submissions share one config file, they can not be used with elastic mode")
+    partition_name = options.get("partition", PARTITION_NAME)
+    global_batch = elastic_settings["target_global_batch"] if elastic_settings else None
+    plans = plan_allocations(partition_name, max_tres, options.get("objective", "gpus"), compete, options.get("mem_per_gpu"),
+                             released_job, target_steps=options.get("target_steps", 1), global_batch=global_batch)
+    if plans:
+        replacements = auto_qos.format_sbatch_lines(plans[0])
+    elif released_job:
+        print(f"No allocation available for partition {partition_name}, resubmitting the shape of job {released_job} without pinning")
+        replacements = current_sbatch_lines(bash_file)
     else:
-        with open("auto_rerun_infos.json", "r") as f:
-            infos = json.load(f)
-        infos["bash_file"] = bash_file
-        infos["config_file"] = config_file
-        if job_id:
-            infos["job_id"] = job_id
-        if active:
-            infos["active"] = active
-        with open("auto_rerun_infos.json", "w") as f:
-            json.dump(infos, f)
+        raise RuntimeError(f"No allocation available for partition {partition_name}")
+    with profiling.phase("rewrite"):
+        batch_size, world_size = read_and_replace_lines(bash_file, partition_name, max_tres, replacements=replacements)
+        if options.get("signal_secs") and campaign_name:
+            install_preemption_hook(bash_file, campaign_name, state_db, os.getcwd(), options["signal_secs"])
+        # update the checkpoint name
+        replace_checkpoint_name(config_file, batch_size, elastic_settings, world_size)
+    with profiling.phase("submit"):
+        job_ids = [submit(bash_file)]
+        for plan in plans[1:]:
+            # "#SBATCH --nodes=2" -> "--nodes=2", a failed competitor is dropped, the preferred job is already queued
+            try:
+                job_ids.append(submit(bash_file, [line.split()[1] for line in auto_qos.format_sbatch_lines(plan)]))
+            except RuntimeError as error:
+                print(f"Skipping the competing allocation on {plan.partition}: {error}")
+    return job_ids
+
+def query_job_states(job_ids):
+    """
+    {job_id : state} from squeue, the jobs squeue no longer knows from sacct, both asked directly (not cached)
+    returns None when neither answered, jobs neither knows (purged) are missing
+    """
+    states = {}
+    answered = False
+    result = profiling.run(["squeue", "-h", "-o", "%i %T", "-j", ",".join(job_ids)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # squeue also exits 1 when it knows none of the ids any more
+    if result.returncode == 0:
+        states = parse_job_states(result.stdout.decode("utf-8"))
+        answered = True
+    missing = [job_id for job_id in job_ids if job_id not in states]
+    if missing:
+        result = profiling.run(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(missing)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            finished = parse_job_states(result.stdout.decode("utf-8"))
+            states.update({job_id: state for job_id, state in finished.items() if job_id in missing})
+            answered = True
+    return states if answered else None
+
+def resolve_competition(store, campaign):
+    """
+    Keeps the first competing job that started or ran (the most preferred one if several did) and cancels the others
+    a competitor that already ended counts as started unless it was cancelled, when every competitor left the queue
+    without one the competition is cleared and the latest job is classified as usual
+    returns False while no competitor is known to have started, also when squeue and sacct both fail,
+    so a running job is never cancelled by mistake
+    """
+    job_ids = store.competitors(campaign.name)
+    if not job_ids:
+        return True
+    states = query_job_states(job_ids)
+    if states is None:
+        print(f"[{campaign.name}] squeue and sacct failed, keeping the competitors {job_ids}")
+        return False
+    ended = [job_id for job_id in job_ids if states.get(job_id) not in ACTIVE_STATES]
+    started = [job_id for job_id in job_ids if states.get(job_id) in STARTED_STATES
+               or (job_id in ended and job_id in states and states[job_id] != "CANCELLED")]
+    if not started:
+        if len(ended) < len(job_ids):
+            return False
+        store.clear_competitors(campaign.name)
+        print(f"[{campaign.name}] every competitor of {job_ids} left the queue without running, checking job {campaign.latest_job_id}")
+        return True
+    winner = started[0]
+    losers = [job_id for job_id in job_ids if job_id != winner]
+    queued = [job_id for job_id in losers if job_id not in ended]
+    if queued:
+        profiling.run(["scancel", *queued])
+    for job_id in losers:
+        store.record_outcome(campaign.name, job_id, "cancelled")
+    store.set_latest_job(campaign.name, winner)
+    store.clear_competitors(campaign.name)
+    print(f"[{campaign.name}] job {winner} started first, cancelled {queued}")
+    return True
+
+def process_campaign(store, campaign, force=False, job_state=None, released_job=None):
+    """
+    One rerun check of a campaign, job_state is the squeue / sacct state when the caller already knows it
+    released_job is passed to rerun by the preemption hook
+    the submission is claimed with a compare-and-set, so overlapping runs submit at most once
+    returns the new job id, None if nothing was submitted
+    """
+    if store.competitors(campaign.name):
+        if not resolve_competition(store, campaign):
+            return None
+        campaign = store.get_campaign(campaign.name)
+    job_id = campaign.latest_job_id
+    if not job_id:
+        print(f"[{campaign.name}] No previous job to rerun")
+        return None
+    with working_directory(campaign.workdir):
+        job = store.get_job(campaign.name, job_id)
+        outcome = job.outcome if job else None
+        if outcome is None:
+            if job_state is not None:
+                if job_state in ACTIVE_STATES:
+                    return None
+            else:
+                with profiling.phase("status"):
+                    if not check_previous_job_status(job_id):
+                        return None
+            with profiling.phase("classify"):
+                outcome = classify_job(job_id, campaign.bash_file)
+            store.record_outcome(campaign.name, job_id, outcome)
+        if not force and outcome not in RERUN_OUTCOMES:
+            return None
+        if not store.claim_submission(campaign.name, campaign.version):
+            print(f"[{campaign.name}] Another process is already submitting, ending script")
+            return None
+        try:
+            new_job_ids = rerun(campaign.bash_file, campaign.config_file, campaign.options.get("max_tres", max_tres), campaign.options,
+                                campaign.name, store.path, released_job)
+        except BaseException:
+            store.release_submission(campaign.name)
+            raise
+        # the preferred job is recorded last and becomes the latest job
+        for new_job_id in reversed(new_job_ids):
+            store.record_submission(campaign.name, new_job_id)
+        if len(new_job_ids) > 1:
+            store.add_competitors(campaign.name, new_job_ids)
+        return new_job_ids[0]
+
+def handle_preemption_signal(store, campaign, job_id, save_timeout):
+    """
+    Run by the trap of the preemption hook inside the allocation of job_id once Slurm signalled it:
+    waits for the checkpoint the steps were asked to save, then resubmits without waiting for the job to end
+    returns the new job id, None if job_id is no longer the latest job of the campaign
+    """
+    if campaign.latest_job_id != job_id:
+        print(f"[{campaign.name}] job {job_id} is not the latest job {campaign.latest_job_id}, not resubmitting")
+        return None
+    with working_directory(campaign.workdir):
+        wait_for_new_checkpoint(save_timeout)
+    store.record_outcome(campaign.name, job_id, "preempted")
+    return process_campaign(store, store.get_campaign(campaign.name), released_job=job_id)
+
+def record_campaign_metrics(store, campaigns):
+    """
+    Sets the submissions, preemptions and resubmit gaps of each campaign as profiling gauges
+    a gap is from the end of a job (sacct End, else when its outcome was recorded) to the next submission,
+    0 when the next job was submitted before the end, from inside the allocation; cancelled competitors are skipped
+    """
+    histories = {campaign.name: [job for job in store.history(campaign.name) if job.outcome != "cancelled"] for campaign in campaigns}
+    ended = [job.job_id for history in histories.values() for job in history[:-1]]
+    ends = {}
+    if ended:
+        output = slurm_cache.run_cached(["sacct", "-n", "-X", "-P", "-o", "JobID,End", "-j", ",".join(ended)], check=False)
+        for line in output.splitlines():
+            parts = line.split("|")
+            if len(parts) >= 2:
+                ends[parts[0]] = queue_wait.parse_time(parts[1])
+    for name, history in histories.items():
+        profiling.set_gauge("campaign_submissions", len(history), campaign=name)
+        profiling.set_gauge("campaign_preemptions", sum(job.outcome == "preempted" for job in history), campaign=name)
+        gaps = []
+        for previous, job in zip(history, history[1:]):
+            end = ends.get(previous.job_id) or previous.ended_at
+            if end is not None:
+                gaps.append(max(job.submitted_at - end, 0.0))
+        if gaps:
+            profiling.set_gauge("campaign_last_resubmit_gap_seconds", gaps[-1], campaign=name)
+            profiling.set_gauge("campaign_mean_resubmit_gap_seconds", sum(gaps) / len(gaps), campaign=name)
+
+def main(store, campaign_names, force):
+    for name in campaign_names:
+        campaign = store.get_campaign(name)
+        if campaign is None or not campaign.active:
+            continue
+        process_campaign(store, campaign, force)
+
+@contextmanager
+def working_directory(path):
+    # the rerun pipeline uses paths relative to the campaign directory
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def parse_job_states(output):
+    """
+    "<job id> <state>" lines from squeue -o "%i %T" or sacct -P -o JobID,State -> {job_id : state}
+    """
+    states = {}
+    for line in output.splitlines():
+        parts = line.replace("|", " ").split()
+        if len(parts) >= 2:
+            states[parts[0]] = parts[1] # "CANCELLED by 123" -> CANCELLED
+    return states
+
+async def run_command(args):
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    profiling.record_subprocess(args[0], time.perf_counter() - start)
+    return stdout.decode("utf-8")
+
+async def get_job_states(job_ids):
+    """
+    One squeue call for every watched job, jobs squeue no longer knows are looked up with one sacct call
+    returns {job_id : state}, jobs neither knows are missing
+    """
+    job_ids = sorted(set(job_ids))
+    if not job_ids:
+        return {}
+    states = parse_job_states(await run_command(["squeue", "-h", "-o", "%i %T", "-j", ",".join(job_ids)]))
+    missing = [job_id for job_id in job_ids if job_id not in states]
+    if missing:
+        finished = parse_job_states(await run_command(["sacct", "-n", "-X", "-P", "-o", "JobID,State", "-j", ",".join(missing)]))
+        states.update({job_id: state for job_id, state in finished.items() if job_id in missing})
+    return states
+
+async def watch(store, campaign_names=None, force=False, min_interval=5.0, max_interval=120.0, metrics_file=None):
+    """
+    Watches the latest job of every active campaign (or campaign_names) with one batched squeue / sacct query per interval
+    polls every min_interval after a state change and backs off up to max_interval while nothing changes
+    runs the rerun pipeline in the campaign directory once its job ends, metrics_file is rewritten after every poll
+    """
+    interval = min_interval
+    last_states = {} # campaign -> (job_id, state)
+    while True:
+        changed = False
+        for campaign in store.list_campaigns():
+            # the latest job of a competition may stay pending while another competitor runs
+            if store.competitors(campaign.name) and (not campaign_names or campaign.name in campaign_names):
+                changed |= resolve_competition(store, campaign)
+        campaigns = [c for c in store.list_campaigns() if c.latest_job_id and (not campaign_names or c.name in campaign_names)]
+        watched = []
+        retries = [] # ended jobs whose rerun failed before, e.g. no allocation was available
+        for campaign in campaigns:
+            job = store.get_job(campaign.name, campaign.latest_job_id)
+            if job is None or job.outcome is None:
+                watched.append(campaign)
+            elif force or job.outcome in RERUN_OUTCOMES:
+                retries.append(campaign)
+        states = await get_job_states([campaign.latest_job_id for campaign in watched])
+        for campaign in watched + retries:
+            state = states.get(campaign.latest_job_id, "UNKNOWN") if campaign in watched else None
+            if state is not None and last_states.get(campaign.name) != (campaign.latest_job_id, state):
+                print(f"[{campaign.name}] job {campaign.latest_job_id}: {state}")
+                last_states[campaign.name] = (campaign.latest_job_id, state)
+                changed = True
+            if state in ACTIVE_STATES:
+                continue
+            try:
+                if process_campaign(store, campaign, force, job_state=state or "ENDED"):
+                    changed = True
+            except Exception as e:
+                # try again on the next poll
+                print(f"[{campaign.name}] rerun failed: {e}")
+        if metrics_file:
+            record_campaign_metrics(store, [c for c in store.list_campaigns() if not campaign_names or c.name in campaign_names])
+            profiling.write_metrics(metrics_file, "auto_rerun")
+        interval = min_interval if changed else min(interval * 2, max_interval)
+        await asyncio.sleep(interval)
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument("--campaign", type=str, nargs="+", help="Campaign names, default is 'default' (or every active campaign with --watch / --all_campaigns)", default=None)
+    parser.add_argument("--all_campaigns", action="store_true", help="Check every active campaign")
+    parser.add_argument("--state_db", type=str, help="sqlite file holding the campaigns", default=STATE_DB)
     parser.add_argument("--bash_file", type=str, help="The bash file to run the job", default=None)
     parser.add_argument("--config_file", type=str, help="The config file to run the job", default=None)
     parser.add_argument("--active", type=bool, help="Whether to activate the auto rerun", default=True)
     parser.add_argument("--job_id", type=str, help="The job id to rerun", default=None)
     parser.add_argument("--force", type=bool, help="Whether to activate the auto rerun", default=False)
-    parser.add_argument("--max_tres", type=int, help="The maximum number of GPUs", default=48)
+    parser.add_argument("--max_tres", type=int, help="The maximum number of GPUs", default=None)
+    parser.add_argument("--partition", type=str, help=f"Partition to resubmit to, 'auto' for the best partition by --objective, default {PARTITION_NAME}", default=None)
+    parser.add_argument("--objective", type=str, choices=auto_qos.OBJECTIVES + [queue_wait.OBJECTIVE], default=None,
+                        help="Allocation with the most gpus, the best predicted samples/s (calibrate with throughput.py), samples per $, time to --target_steps, or time to result including the predicted queue wait")
+    parser.add_argument("--compete", type=int, help="Submit the best n allocations and cancel the others once one starts, not with --target_global_batch", default=None)
+    parser.add_argument("--target_steps", type=int, help="Remaining steps for the time_to_step objective", default=None)
+    parser.add_argument("--target_global_batch", type=int, help="Elastic mode, keep this global batch size (gpus x per-gpu batch x accumulation) on any allocation", default=None)
+    parser.add_argument("--max_per_gpu_batch", type=int, help="Largest per-gpu batch in elastic mode", default=BATCH_SIZE)
+    parser.add_argument("--batch_tolerance", type=float, help="Elastic mode, relative distance to --target_global_batch accepted for a larger per-gpu batch when no split meets it exactly", default=elastic.BATCH_TOLERANCE)
+    parser.add_argument("--lr_scaling", type=str, choices=elastic.LR_SCALING, help="Learning rate scaling when the target global batch can not be met exactly", default="none")
+    parser.add_argument("--adjust_steps", action="store_true", help="Scale max_train_steps to keep the number of samples when the global batch differs from the target")
+    parser.add_argument("--mem_per_gpu", type=int, help="Host memory (MB) per gpu the pinned nodes must have free, default is the smallest per gpu share of the partition's nodes", default=None)
+    parser.add_argument("--signal_secs", type=int, help=f"Have Slurm send SIG{PREEMPTION_SIGNAL} this many seconds before the job ends, the installed trap requests a checkpoint and resubmits from inside the allocation", default=None)
+    parser.add_argument("--preempted_job", type=str, help="Used by the trap of --signal_secs: the job that received the signal", default=None)
+    parser.add_argument("--save_timeout", type=float, help="Seconds --preempted_job waits for the requested checkpoint", default=0.0)
+    parser.add_argument("--cache_ttl", type=float, help="Seconds squeue / sinfo / scontrol results are reused from the local cache, 0 disables it", default=None)
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached scheduler results")
+    parser.add_argument("--profile", action="store_true", help="Print the seconds of each phase and the scheduler command calls to stderr at the end")
+    parser.add_argument("--metrics_file", type=str, help="Write planning latency, idle gpus, wasted $/hour, preemptions and resubmit gaps per campaign to a .prom textfile or append them to a json lines file", default=None)
+    parser.add_argument("--watch", action="store_true", help="Keep running and watch the campaigns instead of checking once")
+    parser.add_argument("--min_interval", type=float, help="Seconds between polls right after a job changed state", default=5.0)
+    parser.add_argument("--max_interval", type=float, help="Longest seconds between polls while nothing changes", default=120.0)
     args = parser.parse_args()
-    bash_file = args.bash_file
-    config_file = args.config_file
-    active = args.active
-    job_id = args.job_id
-    max_tres = args.max_tres
-    if bash_file and config_file:
-        #update the json file
-        log_bash_configs(bash_file, config_file, job_id, active)
+    slurm_cache.configure(ttl=args.cache_ttl, refresh_cache=args.refresh)
+    store = StateStore(args.state_db)
+    campaign_names = args.campaign or ["default"]
+    if args.bash_file and args.config_file:
+        # register / update the campaign, paths are relative to the current directory
+        options = {"max_tres": args.max_tres} if args.max_tres else {}
+        if args.compete and args.compete > 1 and args.target_global_batch:
+            parser.error("--compete can not be used with --target_global_batch, the competitors share one config file")
+        for key in ["partition", "objective", "target_steps", "compete", "signal_secs", "mem_per_gpu"]:
+            if getattr(args, key) is not None:
+                options[key] = getattr(args, key)
+        for name in campaign_names:
+            if args.target_global_batch:
+                # base learning rates / steps are read once, later configs were already rescaled
+                existing = store.get_campaign(name)
+                base = existing.options.get("elastic", {}).get("base") if existing else None
+                if base is None:
+                    with open(args.config_file, "r") as f:
+                        base = elastic.read_base_values(toml.load(f))
+                options["elastic"] = {
+                    "target_global_batch": args.target_global_batch,
+                    "max_per_gpu_batch": args.max_per_gpu_batch,
+                    "batch_tolerance": args.batch_tolerance,
+                    "lr_scaling": args.lr_scaling,
+                    "adjust_steps": args.adjust_steps,
+                    "base": base,
+                }
+            store.upsert_campaign(name, os.getcwd(), args.bash_file, args.config_file, args.active, options)
+            if args.signal_secs:
+                # the next manual sbatch of the file already has the hook
+                install_preemption_hook(args.bash_file, name, args.state_db, os.getcwd(), args.signal_secs)
+            if args.job_id:
+                store.record_submission(name, args.job_id)
     else:
-        # read the json file
-        with open("auto_rerun_infos.json", "r") as f:
-            infos = json.load(f)
-        bash_file = infos["bash_file"]
-        config_file = infos["config_file"]
-        active = infos["active"]
-        job_id = infos["job_id"]
-    if not active:
+        for name in campaign_names:
+            if store.get_campaign(name) is None and store.import_legacy(name, os.getcwd()):
+                print(f"Imported auto_rerun_infos.json / auto_rerun.txt as campaign {name}")
+    if args.max_tres:
+        max_tres = args.max_tres
+    if args.preempted_job:
+        for name in campaign_names:
+            handle_preemption_signal(store, store.get_campaign(name), args.preempted_job, args.save_timeout)
         exit()
-
-    main(bash_file, config_file, args.force,max_tres)
+    if args.watch:
+        try:
+            asyncio.run(watch(store, args.campaign, args.force, args.min_interval, args.max_interval, args.metrics_file))
+        finally:
+            if args.profile:
+                print(profiling.summary(), file=sys.stderr)
+        exit()
+    if args.all_campaigns:
+        campaign_names = [campaign.name for campaign in store.list_campaigns()]
+    main(store, campaign_names, args.force)
+    if args.metrics_file:
+        record_campaign_metrics(store, [campaign for campaign in store.list_campaigns() if campaign.name in campaign_names])
+        profiling.write_metrics(args.metrics_file, "auto_rerun")
+    if args.profile:
+        print(profiling.summary(), file=sys.stderr)
@@ -0,0 +1,146 @@
+"""
+End-to-end latency of auto_qos planning and one auto_rerun cycle against the simulated cluster of fake_slurm.py
+reports wall time, number of scheduler subprocesses (from the shim call log) and peak memory per cluster size,
+peak memory is the peak RSS of the process so far, or the tracemalloc peak of each phase with --tracemalloc (slows the timings a lot)
+
+python benchmarks/bench_e2e.py --sizes 10 100 1000 10000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import struct
+import sys
+import resource
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import fake_slurm
+import slurm_cache
+from rerun_state import StateStore
+auto_qos = auto_rerun = None # imported in main() once AUTO_QOS_PARTITION_CSV points at the simulated cluster
+
+CONFIG = """[training_arguments]
+network_weights = "outputs/step.safetensors"
+
+[extra_arguments]
+wandb_run_name = "start"
+output_name = "start"
+"""
+
+def write_checkpoint(path):
+    # smallest valid safetensors file, one float32 tensor
+    header = json.dumps({"weight": {"dtype": "F32", "shape": [1], "data_offsets": [0, 4]}}).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)) + header + b"\0" * 4)
+
+@contextlib.contextmanager
+def measure(state_dir, results, size, phase, trace_memory=False):
+    """
+    Times the block, counts emulated scheduler commands and records the peak memory
+    """
+    calls_before, seconds_before = fake_slurm.call_count(state_dir)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+    calls_after, seconds_after = fake_slurm.call_count(state_dir)
+    results.append({
+        "nodes": size, "phase": phase, "seconds": elapsed,
+        "subprocesses": calls_after - calls_before, "command_seconds": seconds_after - seconds_before,
+        "peak_mb": peak / 1024 / 1024,
+    })
+
+def setup_cluster(root, size, seed):
+    state_dir = os.path.join(root, f"cluster_{size}")
+    with contextlib.redirect_stdout(io.StringIO()):
+        fake_slurm.main(["--state", state_dir, "init", "--nodes", str(size), "--seed", str(seed)])
+    bin_dir = fake_slurm.write_shims(state_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+    return state_dir
+
+def setup_campaign(root, state_dir):
+    workdir = os.path.join(root, "campaign")
+    os.makedirs(os.path.join(workdir, "outputs"), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, "train_network_15gpu_offset.sh"), os.path.join(workdir, "train.sh"))
+    with open(os.path.join(workdir, "config.toml"), "w") as f:
+        f.write(CONFIG)
+    write_checkpoint(os.path.join(workdir, "outputs", "08151230_delta_lokr_bs48_multinode_l2-step00001000.safetensors"))
+    with auto_rerun.working_directory(workdir):
+        output = fake_slurm.run_emulated("sbatch", ["train.sh"], state_dir)[0]
+    job_id = output.split()[-1]
+    fake_slurm.main(["--state", state_dir, "preempt", job_id])
+    return workdir, job_id
+
+def bench_size(root, size, args, results):
+    state_dir = setup_cluster(root, size, args.seed)
+    partition_csv = os.path.join(root, "partitions.csv")
+    slurm_cache.configure(ttl=0, refresh_cache=False, cache_dir=os.path.join(root, f"cache_{size}"))
+    os.makedirs(slurm_cache.CACHE_DIR, exist_ok=True)
+    with measure(state_dir, results, size, "plan", args.tracemalloc):
+        auto_qos.get_allocation_plans(max_tres=args.max_tres, partition_csv=partition_csv)
+    if size <= args.per_node_limit:
+        with measure(state_dir, results, size, "plan --per_node", args.tracemalloc):
+            auto_qos.get_allocation_plans(max_tres=args.max_tres, partition_csv=partition_csv, per_node=True, parallel=args.parallel)
+    # warm cache: the second planning within the ttl should not start any subprocess
+    slurm_cache.configure(ttl=60)
+    auto_qos.get_allocation_plans(max_tres=args.max_tres, partition_csv=partition_csv)
+    with measure(state_dir, results, size, "plan (cached)", args.tracemalloc):
+        auto_qos.get_allocation_plans(max_tres=args.max_tres, partition_csv=partition_csv)
+    slurm_cache.configure(ttl=0)
+    workdir, job_id = setup_campaign(root, state_dir)
+    store = StateStore(os.path.join(root, f"state_{size}.db"))
+    store.upsert_campaign("bench", workdir, "train.sh", "config.toml", options={"max_tres": args.max_tres})
+    store.record_submission("bench", job_id)
+    with measure(state_dir, results, size, "rerun cycle", args.tracemalloc):
+        new_job_id = auto_rerun.process_campaign(store, store.get_campaign("bench"))
+    store.close()
+    if new_job_id is None:
+        print(f"warning: the rerun cycle at {size} nodes did not submit a job")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against fake_slurm.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--max_tres", type=int, default=48)
+    parser.add_argument("--parallel", type=int, default=8)
+    parser.add_argument("--per_node_limit", type=int, default=100, help="Largest cluster to also time --per_node on, one subprocess per node")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="Peak python memory of each phase instead of the process peak RSS")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to this file")
+    args = parser.parse_args()
+    root = tempfile.mkdtemp(prefix="bench_e2e_")
+    # every simulated cluster has the same partitions, auto_rerun plans with the default csv of auto_qos
+    fake_slurm.write_partition_csv(root)
+    os.environ["AUTO_QOS_PARTITION_CSV"] = os.path.join(root, "partitions.csv")
+    global auto_qos, auto_rerun
+    import auto_qos
+    import auto_rerun
+    path = os.environ["PATH"]
+    results = []
+    try:
+        for size in args.sizes:
+            bench_size(root, size, args, results)
+            os.environ["PATH"] = path
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(f"{'nodes':>7} {'phase':<16} {'seconds':>9} {'subprocesses':>12} {'command s':>9} {'peak MB':>8}")
+    for result in results:
+        print(f"{result['nodes']:>7} {result['phase']:<16} {result['seconds']:>9.3f} {result['subprocesses']:>12} {result['command_seconds']:>9.3f} {result['peak_mb']:>8.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
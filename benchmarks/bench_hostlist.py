@@ -0,0 +1,126 @@
+"""
+Fuzzes hostlist.expand / compress against the original StringNodeParser of auto_qos.py
+and times expansion, count and membership on very large nodelists
+
+python benchmarks/bench_hostlist.py --fuzz 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hostlist
+
+class LegacyStringNodeParser:
+    # original parser from auto_qos.py, one bracket per token and no suffix
+    def __init__(self, node_string):
+        self.node_string = node_string
+        self.node_list = []
+        self.parse()
+    def parse(self):
+        comma_list = []
+        inside_bracket = False
+        for i, c in enumerate(self.node_string):
+            if c == '[':
+                inside_bracket = True
+            elif c == ']':
+                inside_bracket = False
+            elif c == ',' and not inside_bracket:
+                comma_list.append(i)
+        start = 0
+        for i in comma_list:
+            self.parse_node(self.node_string[start:i])
+            start = i + 1
+        self.parse_node(self.node_string[start:])
+    def parse_node(self, node_string):
+        if '[' not in node_string:
+            self.node_list.append(node_string)
+            return
+        bracket_start = node_string.index('[')
+        bracket_end = node_string.index(']')
+        prefix = node_string[:bracket_start]
+        if ',' not in node_string[bracket_start:bracket_end] and "-" not in node_string[bracket_start:bracket_end]:
+            self.node_list.append(prefix + node_string[bracket_start:bracket_end + 1])
+            return
+        ranges = node_string[bracket_start + 1:bracket_end].split(',')
+        for r in ranges:
+            if '-' in r:
+                start, end = r.split('-')
+                for i in range(int(start), int(end) + 1):
+                    self.node_list.append(prefix + str(i).zfill(len(start)))
+            else:
+                self.node_list.append(prefix + r)
+    def get_node_list(self):
+        return self.node_list
+
+def random_token(rng):
+    """
+    A token in the subset the legacy parser handles: one bracket at the end, with a "," or "-" inside
+    (the legacy parser kept a lone node[5] as the literal "node[5]")
+    """
+    prefix = rng.choice(["node", "gpu-", "ip-10-0-231-", "a100n", "n"])
+    if rng.random() < 0.2:
+        return prefix + str(rng.randint(0, 999)).zfill(rng.choice([1, 2, 3]))
+    width = rng.choice([1, 2, 3, 4])
+    parts = []
+    for _ in range(rng.randint(1, 4)):
+        start = rng.randint(0, 50)
+        if rng.random() < 0.5:
+            parts.append(f"{str(start).zfill(width)}-{str(start + rng.randint(0, 30)).zfill(width)}")
+        else:
+            parts.append(str(start).zfill(width))
+    if len(parts) == 1 and '-' not in parts[0]:
+        parts.append(str(rng.randint(51, 99)).zfill(width))
+    return f"{prefix}[{','.join(parts)}]"
+
+def fuzz(cases, rng):
+    for case in range(cases):
+        node_string = ",".join(random_token(rng) for _ in range(rng.randint(1, 4)))
+        expected = LegacyStringNodeParser(node_string).get_node_list()
+        assert list(hostlist.expand(node_string)) == expected, f"expand {node_string}"
+        assert hostlist.count(node_string) == len(expected), f"count {node_string}"
+        for name in rng.sample(expected, min(len(expected), 5)):
+            assert hostlist.contains(node_string, name), f"contains {name} in {node_string}"
+        compressed = hostlist.compress(expected)
+        assert set(hostlist.expand(compressed)) == set(expected), f"compress {node_string} -> {compressed}"
+    # multi-dimensional names the legacy parser can not handle, checked by round trip
+    for case in range(cases):
+        names = [f"rack{r}-gpu{str(g).zfill(2)}" for r in rng.sample(range(1, 20), rng.randint(1, 5)) for g in rng.sample(range(1, 17), rng.randint(1, 16))]
+        compressed = hostlist.compress(names)
+        assert set(hostlist.expand(compressed)) == set(names), f"compress {names} -> {compressed}"
+        assert hostlist.count(compressed) == len(set(names)), f"count {compressed}"
+    print(f"{cases} legacy cases and {cases} multi-dimensional cases identical")
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<48} {time.perf_counter() - start:>10.4f}s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark hostlist.py")
+    parser.add_argument("--fuzz", type=int, default=2000, help="Random cases compared against the legacy parser")
+    parser.add_argument("--size", type=int, default=1000000, help="Nodes in the large nodelist")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    fuzz(args.fuzz, rng)
+
+    width = len(str(args.size))
+    large = f"node[{'1'.zfill(width)}-{str(args.size).zfill(width)}],rack[1-{args.size // 1000}]-gpu[001-999]"
+    # sinfo style list with many short tokens
+    fragmented = ",".join(f"n{i}[{str(j).zfill(3)}-{str(j + 3).zfill(3)},{str(j + 7).zfill(3)}]" for i in range(args.size // 5000) for j in range(0, 500, 10))
+    print(f"large nodelist: {large}")
+    timed("legacy parser, fragmented list", lambda: LegacyStringNodeParser(fragmented).get_node_list())
+    names = timed("hostlist.expand, fragmented list", lambda: list(hostlist.expand(fragmented)))
+    timed("hostlist.compress, fragmented list", hostlist.compress, names)
+    timed("legacy parser, node[1-size] only", lambda: LegacyStringNodeParser(large.split(",")[0]).get_node_list())
+    timed("hostlist.expand, full large list", lambda: sum(1 for _ in hostlist.expand(large)))
+    timed("hostlist.count, large list", hostlist.count, large)
+    timed("hostlist.contains, last node of large list", hostlist.contains, large, f"rack{args.size // 1000}-gpu999")
+    timed("first 10 names of large list", lambda: [name for name, _ in zip(hostlist.expand(large), range(10))])
+
+if __name__ == "__main__":
+    main()
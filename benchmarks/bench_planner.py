@@ -0,0 +1,121 @@
+"""
+Compares the sort-based max_nodes_x_gpus planner of auto_qos with the original quadratic one
+on synthetic fragmented clusters, checks both give identical results and prints timings
+sizes above --reference_limit are checked against the memoized reference instead, the same loop with the matching
+entries counted once per distinct shape, which is exact and fast enough for 100k nodes
+
+python benchmarks/bench_planner.py --sizes 10000 30000 100000
+"""
+import argparse
+import os
+from collections import Counter
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auto_qos import max_nodes_x_gpus
+
+def reference_max_nodes_x_gpus(data, cpu_min, max_tres):
+    # original O(n^2) planner from auto_qos.py, kept as the reference
+    max_product = {}
+    filtered_data = [entry for entry in data if entry[2] != 0 and entry[2] >= cpu_min]
+    for name, gpus, cpu_count in filtered_data:
+        matching_entries = [x for x in filtered_data if x[0] == name and x[1] >= gpus and x[2] >= cpu_count]
+        match_count = len(matching_entries)
+        product_num = gpus * match_count
+        if product_num > max_tres:
+            while product_num > max_tres:
+                product_num -= gpus
+                match_count -= 1
+        if match_count == 0 or product_num == 0:
+            continue
+        if name not in max_product:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+        elif product_num > max_product[name][0]:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+        elif product_num == max_product[name][0] and cpu_count > max_product[name][3] and max_product[name][2] >= match_count:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+    return max_product
+
+def memoized_reference_max_nodes_x_gpus(data, cpu_min, max_tres):
+    # the reference loop, the matching entries of each distinct (partition, gpus, cpus) are counted once
+    # over the distinct shapes of its partition instead of over every entry
+    max_product = {}
+    filtered_data = [entry for entry in data if entry[2] != 0 and entry[2] >= cpu_min]
+    shapes = {}
+    for (name, gpus, cpu_count), count in Counter(filtered_data).items():
+        shapes.setdefault(name, []).append((gpus, cpu_count, count))
+    matches = {}
+    for entry in filtered_data:
+        name, gpus, cpu_count = entry
+        if entry not in matches:
+            matches[entry] = sum(count for x_gpus, x_cpu_count, count in shapes[name] if x_gpus >= gpus and x_cpu_count >= cpu_count)
+        match_count = matches[entry]
+        product_num = gpus * match_count
+        if product_num > max_tres:
+            while product_num > max_tres:
+                product_num -= gpus
+                match_count -= 1
+        if match_count == 0 or product_num == 0:
+            continue
+        if name not in max_product:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+        elif product_num > max_product[name][0]:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+        elif product_num == max_product[name][0] and cpu_count > max_product[name][3] and max_product[name][2] >= match_count:
+            max_product[name] = (product_num, gpus, match_count, cpu_count)
+    return max_product
+
+def synthetic_infos(node_count, partition_count, rng):
+    """
+    [(partition, free gpus, cpus per gpu)] like collect_cluster_report()["all_infos"], fragmented by random allocations
+    """
+    infos = []
+    partitions = [f"part{i:03d}_{rng.choice(['a100', '4090', 'a6000', '3090'])}" for i in range(partition_count)]
+    for _ in range(node_count):
+        total_gpus = rng.choice([4, 6, 8])
+        total_cpus = rng.choice([48, 64, 96, 128])
+        free_gpus = rng.randint(0, total_gpus)
+        free_cpus = rng.randint(0, total_cpus)
+        infos.append((rng.choice(partitions), free_gpus, free_cpus // max(free_gpus, 1)))
+    return infos
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the allocation planner")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 30000, 100000], help="Node counts to benchmark")
+    parser.add_argument("--partitions", type=int, default=8, help="Partitions in the synthetic cluster")
+    parser.add_argument("--reference_limit", type=int, default=10000, help="Largest size the quadratic reference is run on, larger sizes are checked against the memoized reference")
+    parser.add_argument("--check_cases", type=int, default=500, help="Small random cases compared against the reference")
+    parser.add_argument("--cpu_min", type=int, default=5)
+    parser.add_argument("--max_tres", type=int, default=48)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    # many small inputs exercise the tie-break rules
+    for case in range(args.check_cases):
+        infos = synthetic_infos(rng.randint(1, 300), rng.randint(1, 4), rng)
+        max_tres = rng.choice([4, 8, 16, args.max_tres])
+        expected = reference_max_nodes_x_gpus(infos, args.cpu_min, max_tres)
+        got = max_nodes_x_gpus(infos, args.cpu_min, max_tres)
+        assert got == expected, f"case {case}: {got} != {expected}"
+        assert memoized_reference_max_nodes_x_gpus(infos, args.cpu_min, max_tres) == expected, f"case {case}: memoized reference differs"
+    print(f"{args.check_cases} random cases identical")
+
+    print(f"{'nodes':>8} {'sorted (s)':>12} {'reference (s)':>14} {'speedup':>8} {'reference':>10}")
+    for size in args.sizes:
+        infos = synthetic_infos(size, args.partitions, rng)
+        got, elapsed = timed(max_nodes_x_gpus, infos, args.cpu_min, args.max_tres)
+        reference, label = (reference_max_nodes_x_gpus, "quadratic") if size <= args.reference_limit else (memoized_reference_max_nodes_x_gpus, "memoized")
+        expected, reference_elapsed = timed(reference, infos, args.cpu_min, args.max_tres)
+        assert got == expected, f"{size} nodes: {got} != {expected}"
+        print(f"{size:>8} {elapsed:>12.4f} {reference_elapsed:>14.4f} {reference_elapsed / elapsed:>7.1f}x {label:>10}")
+
+if __name__ == "__main__":
+    main()
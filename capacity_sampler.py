@@ -0,0 +1,327 @@
+"""
+Samples the free gpus / cpus of every partition and node at a fixed interval into an append-only columnar store,
+and answers idle gpu-hours per partition per day, free capacity by hour of week and the cost of the idle gpus
+
+every column is a file of fixed-width native integers (array module), rows are appended in time order,
+so a time range is found with a bisect of the time column and only that slice of the other columns is read
+partition rows are written on every sample, node rows only when the node's free gpus / cpus changed
+a row is 12 bytes, a month of per-minute samples of 10 partitions is ~5MB
+names are kept in index.json next to the columns
+
+python capacity_sampler.py --sample --interval 60
+python capacity_sampler.py --report --days 30
+python capacity_sampler.py --windows --partition big_suma_rtx3090 --gpus 16
+"""
+import argparse
+import bisect
+import datetime
+import json
+import os
+import time
+from array import array
+
+import auto_qos
+import slurm_cache
+
+CAPACITY_DIR = os.environ.get("CAPACITY_DIR", os.path.join(os.path.expanduser("~"), ".cache", "slurm_scripts", "capacity"))
+INTERVAL = 60 # seconds between samples
+HOURS_PER_WEEK = 7 * 24
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+# (column, array typecode), time is unix seconds
+PARTITION_COLUMNS = [("time", "I"), ("partition", "H"), ("free_gpus", "H"), ("free_cpus", "I")]
+NODE_COLUMNS = [("time", "I"), ("node", "I"), ("free_gpus", "H"), ("free_cpus", "H")]
+
+def hour_of_week(stamp):
+    # 0 is Monday 00:00-01:00 local time
+    local = time.localtime(stamp)
+    return local.tm_wday * 24 + local.tm_hour
+
+class ColumnTable:
+    """
+    Append-only table of fixed-width columns, <directory>/<name>.<column> each
+    a crash between the column writes leaves columns of different lengths, the shortest one is the row count
+    """
+    def __init__(self, directory, name, columns):
+        self.directory = directory
+        self.columns = columns
+        self.paths = {column: os.path.join(directory, f"{name}.{column}") for column, _ in columns}
+        self.types = dict(columns)
+
+    def __len__(self):
+        sizes = [os.path.getsize(path) // array(self.types[column]).itemsize if os.path.exists(path) else 0
+                 for column, path in self.paths.items()]
+        return min(sizes)
+
+    def append(self, rows):
+        """
+        rows are tuples in column order, time last written so a row is complete once its time is there
+        columns longer than the row count (a crash between the column writes) are cut back first, so the rows stay aligned
+        """
+        if not rows:
+            return
+        count = len(self)
+        for i, (column, typecode) in reversed(list(enumerate(self.columns))):
+            with open(self.paths[column], "ab") as f:
+                f.truncate(count * array(typecode).itemsize)
+                array(typecode, [row[i] for row in rows]).tofile(f)
+
+    def read_column(self, column, start=0, stop=None):
+        # rows [start, stop) of column
+        values = array(self.types[column])
+        stop = len(self) if stop is None else stop
+        if stop <= start:
+            return values
+        with open(self.paths[column], "rb") as f:
+            f.seek(start * values.itemsize)
+            values.fromfile(f, stop - start)
+        return values
+
+    def read_range(self, start_time, end_time, columns=None):
+        """
+        {column : array} of the rows with start_time <= time < end_time
+        """
+        times = self.read_column("time")
+        first, last = bisect.bisect_left(times, start_time), bisect.bisect_left(times, end_time)
+        result = {"time": times[first:last]}
+        for column in columns or [column for column, _ in self.columns]:
+            if column != "time":
+                result[column] = self.read_column(column, first, last)
+        return result
+
+class CapacityStore:
+    def __init__(self, directory=CAPACITY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        self.partitions = ColumnTable(directory, "partitions", PARTITION_COLUMNS)
+        self.nodes = ColumnTable(directory, "nodes", NODE_COLUMNS)
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # last: node -> [free gpus, free cpus] of its latest row
+            return {"interval": INTERVAL, "partitions": [], "nodes": [], "last": {}}
+
+    def name_id(self, kind, name):
+        names = self.index[kind]
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def record(self, report, stamp=None, interval=INTERVAL):
+        """
+        Appends one sample of a collect_cluster_report result, nodes that are no longer idle / mix count as fully allocated
+        """
+        stamp = int(stamp or time.time())
+        with slurm_cache.locked(self.index_path + ".lock"):
+            self.index = self.load_index()
+            self.index["interval"] = interval
+            free = {} # node -> (partition, free gpus, free cpus)
+            for partition, nodes in report["nodes"].items():
+                for node in nodes:
+                    free[node.name] = (partition, max(node.free_gpus, 0), max(node.free_cpus, 0))
+            totals = {partition: [0, 0] for partition in self.index["partitions"]}
+            for partition, gpus, cpus in free.values():
+                total = totals.setdefault(partition, [0, 0])
+                total[0] += gpus
+                total[1] += cpus
+            partition_rows = [(stamp, self.name_id("partitions", partition), gpus, cpus) for partition, (gpus, cpus) in totals.items()]
+            node_rows = []
+            for name in sorted(set(free) | set(self.index["last"])):
+                values = list(free[name][1:]) if name in free else [0, 0]
+                if self.index["last"].get(name) != values:
+                    node_rows.append((stamp, self.name_id("nodes", name), values[0], values[1]))
+                    self.index["last"][name] = values
+            self.partitions.append(partition_rows)
+            self.nodes.append(node_rows)
+            slurm_cache.atomic_write_json(self.index_path, self.index)
+        return len(partition_rows), len(node_rows)
+
+    def idle_gpu_hours(self, start, end):
+        """
+        {(partition, "YYYY-MM-DD") : idle gpu-hours}, each sample counts until the next one of its partition,
+        at most two intervals so gaps in the sampling count as unknown rather than idle
+        """
+        rows = self.partitions.read_range(start, end)
+        max_gap = 2 * self.index["interval"]
+        hours = {}
+        previous = {} # partition id -> (time, free gpus)
+        def add(partition, stamp, gpus, seconds):
+            key = (self.index["partitions"][partition], datetime.date.fromtimestamp(stamp).isoformat())
+            hours[key] = hours.get(key, 0.0) + gpus * min(seconds, max_gap) / 3600
+        for stamp, partition, gpus in zip(rows["time"], rows["partition"], rows["free_gpus"]):
+            if partition in previous:
+                add(partition, *previous[partition], stamp - previous[partition][0])
+            previous[partition] = (stamp, gpus)
+        for partition, (stamp, gpus) in previous.items():
+            add(partition, stamp, gpus, min(end - stamp, self.index["interval"]))
+        return hours
+
+    def wasted_cost(self, start, end):
+        """
+        {partition : $} of the idle gpu-hours at the PRICES rate of auto_qos, partitions without a price are left out
+        """
+        cost = {}
+        for (partition, _), gpu_hours in self.idle_gpu_hours(start, end).items():
+            price = auto_qos.price_per_gpu_hour(partition)
+            if price is not None:
+                cost[partition] = cost.get(partition, 0.0) + gpu_hours * price
+        return cost
+
+    def free_by_hour_of_week(self, start, end):
+        """
+        {partition : [sorted free gpus of the samples in that hour of week] x 168}
+        """
+        rows = self.partitions.read_range(start, end, ["partition", "free_gpus"])
+        profile = {}
+        quarters = {} # stamp // 900 -> hour of week, utc offsets are whole quarter hours
+        for stamp, partition, gpus in zip(rows["time"], rows["partition"], rows["free_gpus"]):
+            if partition not in profile:
+                profile[partition] = [[] for _ in range(HOURS_PER_WEEK)]
+            quarter = stamp // 900
+            if quarter not in quarters:
+                quarters[quarter] = hour_of_week(stamp)
+            profile[partition][quarters[quarter]].append(gpus)
+        for hours in profile.values():
+            for values in hours:
+                values.sort()
+        return {self.index["partitions"][partition]: hours for partition, hours in profile.items()}
+
+    def node_idle_gpu_hours(self, start, end):
+        """
+        {node : idle gpu-hours}, node rows hold until the node's next change
+        """
+        rows = self.nodes.read_range(0, end, ["node", "free_gpus"])
+        hours = {}
+        current = {} # node id -> (time, free gpus)
+        def add(node, since, gpus, until):
+            seconds = until - max(since, start)
+            if seconds > 0:
+                name = self.index["nodes"][node]
+                hours[name] = hours.get(name, 0.0) + gpus * seconds / 3600
+        for stamp, node, gpus in zip(rows["time"], rows["node"], rows["free_gpus"]):
+            if node in current:
+                add(node, *current[node], stamp)
+            current[node] = (stamp, gpus)
+        for node, (stamp, gpus) in current.items():
+            add(node, stamp, gpus, end)
+        return hours
+
+class CapacityForecast:
+    """
+    Probability that a partition has some number of free gpus in each hour of week, from the samples of the last weeks
+    used as the QueueWaitPredictor prior: the wait is the time until the first hour that is likely to have the gpus free
+    """
+    def __init__(self, store, weeks=4, threshold=0.5, now=None):
+        self.now = now or time.time()
+        self.threshold = threshold
+        self.profile = store.free_by_hour_of_week(self.now - weeks * 7 * 86400, self.now)
+
+    def probability(self, partition, gpus, hour):
+        values = self.profile.get(partition, [[]] * HOURS_PER_WEEK)[hour]
+        if not values:
+            return None
+        return (len(values) - bisect.bisect_left(values, gpus)) / len(values)
+
+    def wait_seconds(self, partition, gpus):
+        """
+        Seconds until the start of the first hour (from the current one) with probability >= threshold, None without samples
+        """
+        if partition not in self.profile:
+            return None
+        current = hour_of_week(self.now)
+        hour_start = self.now - self.now % 3600
+        for offset in range(HOURS_PER_WEEK):
+            probability = self.probability(partition, gpus, (current + offset) % HOURS_PER_WEEK)
+            if probability is not None and probability >= self.threshold:
+                return max(hour_start + offset * 3600 - self.now, 0.0)
+        return None
+
+    def prior(self, partition, qos, nodes, gpus_per_node):
+        return self.wait_seconds(partition, nodes * gpus_per_node)
+
+def wait_prior(directory=CAPACITY_DIR, **forecast_kwargs):
+    """
+    The prior hook of QueueWaitPredictor from the samples in directory, None if nothing was sampled there
+    """
+    if not os.path.exists(os.path.join(directory, "index.json")):
+        return None
+    return CapacityForecast(CapacityStore(directory), **forecast_kwargs).prior
+
+def free_windows(forecast, partition, gpus):
+    """
+    [(first hour, last hour)] runs of hours of week where gpus are likely free, a run may wrap around the week
+    """
+    likely = [(forecast.probability(partition, gpus, hour) or 0.0) >= forecast.threshold for hour in range(HOURS_PER_WEEK)]
+    if all(likely):
+        return [(0, HOURS_PER_WEEK - 1)]
+    start = likely.index(False) + 1 # start the scan after a busy hour, so runs are not split at the week boundary
+    windows = []
+    for offset in range(HOURS_PER_WEEK):
+        hour = (start + offset) % HOURS_PER_WEEK
+        if likely[hour] and (not windows or windows[-1][1] != (hour - 1) % HOURS_PER_WEEK):
+            windows.append([hour, hour])
+        elif likely[hour]:
+            windows[-1][1] = hour
+    return [tuple(window) for window in windows]
+
+def format_hour(hour):
+    return f"{DAY_NAMES[hour // 24]} {hour % 24:02d}:00"
+
+def main():
+    parser = argparse.ArgumentParser(description="Sample idle gpus / cpus into a columnar store and query it")
+    parser.add_argument("--capacity_dir", type=str, default=CAPACITY_DIR)
+    parser.add_argument("--partition_csv", type=str, default=auto_qos.PARTITION_CSV)
+    parser.add_argument("--sample", action="store_true", help="Record a sample every --interval seconds")
+    parser.add_argument("--interval", type=int, default=INTERVAL)
+    parser.add_argument("--count", type=int, default=0, help="Samples to record, 0 keeps sampling")
+    parser.add_argument("--report", action="store_true", help="Print idle gpu-hours per partition per day and their cost over --days")
+    parser.add_argument("--days", type=float, default=7)
+    parser.add_argument("--nodes", type=int, default=0, help="With --report, also print the n nodes with the most idle gpu-hours")
+    parser.add_argument("--windows", action="store_true", help="Print the hours of week in which --gpus gpus of --partition are likely free")
+    parser.add_argument("--partition", type=str, default=None)
+    parser.add_argument("--gpus", type=int, default=1)
+    parser.add_argument("--weeks", type=int, default=4, help="Weeks of samples for --windows")
+    args = parser.parse_args()
+    store = CapacityStore(args.capacity_dir)
+    if args.sample:
+        recorded = 0
+        while True:
+            started = time.time()
+            try:
+                partitions, nodes = store.record(auto_qos.collect_cluster_report(args.partition_csv), started, args.interval)
+                print(f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started))}: {partitions} partitions, {nodes} node changes")
+            except Exception as e:
+                # a failed scheduler query loses one sample, not the sampler
+                print(f"Sampling failed: {e}")
+            recorded += 1
+            if args.count and recorded >= args.count:
+                break
+            time.sleep(max(args.interval - (time.time() - started), 0))
+    now = time.time()
+    start = now - args.days * 86400
+    if args.report:
+        for (partition, day), gpu_hours in sorted(store.idle_gpu_hours(start, now).items(), key=lambda item: (item[0][1], item[0][0])):
+            print(f"{day} {partition}: {gpu_hours:.1f} idle gpu-hours")
+        for partition, cost in sorted(store.wasted_cost(start, now).items()):
+            print(f"{partition}: {cost:.2f}$ wasted")
+        if args.nodes:
+            ranked = sorted(store.node_idle_gpu_hours(start, now).items(), key=lambda item: -item[1])
+            for node, gpu_hours in ranked[:args.nodes]:
+                print(f"{node}: {gpu_hours:.1f} idle gpu-hours")
+    if args.windows:
+        forecast = CapacityForecast(store, args.weeks, now=now)
+        partitions = [args.partition] if args.partition else sorted(forecast.profile)
+        for partition in partitions:
+            windows = free_windows(forecast, partition, args.gpus)
+            text = ", ".join(f"{format_hour(first)}-{format_hour((last + 1) % HOURS_PER_WEEK)}" for first, last in windows) or "none"
+            print(f"{partition} {args.gpus} gpus likely free: {text}")
+            wait = forecast.wait_seconds(partition, args.gpus)
+            if wait is not None:
+                print(f"{partition}: {args.gpus} gpus expected free in {wait / 3600:.1f}h")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Incremental index of the safetensors checkpoints of an output directory
+
+the index is kept in <directory>/.checkpoint_index.json and only files whose mtime or size changed are re-checked,
+each file is validated from its 8 byte header length and json header alone, without reading the tensors
+"""
+import json
+import os
+import re
+import struct
+
+import slurm_cache
+
+INDEX_NAME = ".checkpoint_index.json"
+MAX_HEADER_BYTES = 100 * 1024 * 1024 # safetensors refuses larger headers too
+STEP_PATTERN = re.compile(r'-(?:step)?(\d+)\.safetensors$')
+DATETIME_PATTERN = re.compile(r'^(\d+)_')
+
+def get_datetime(filename):
+    # 08151230_<name>.safetensors -> "08151230", None without a numeric datetime prefix
+    match = DATETIME_PATTERN.match(filename)
+    return match.group(1) if match else None
+
+def get_step(filename):
+    # <name>-step00001000.safetensors or <name>-000010.safetensors -> 1000, 10
+    # the final save of a run has no step and comes after its steps
+    match = STEP_PATTERN.search(filename)
+    return int(match.group(1)) if match else float("inf")
+
+def default_sort_key(filename):
+    # 08151230_delta_lokr_bs48_multinode_l2-step00001000.safetensors -> ("08151230", 1000)
+    # names without a datetime prefix (the initial step.safetensors) are the oldest, any saved checkpoint wins over them
+    prefix = get_datetime(filename)
+    if prefix is None:
+        return ("", -1)
+    return (prefix, get_step(filename))
+
+def validate_safetensors(path):
+    """
+    True if the header parses and the declared tensor byte ranges end exactly at the end of the file
+    a checkpoint cut short by preemption fails this
+    """
+    try:
+        size = os.path.getsize(path)
+        if size < 8:
+            return False
+        with open(path, "rb") as f:
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            if header_length > min(size - 8, MAX_HEADER_BYTES):
+                return False
+            header = json.loads(f.read(header_length))
+        data_end = 0
+        for name, info in header.items():
+            if name == "__metadata__":
+                continue
+            begin, end = info["data_offsets"]
+            if begin > end:
+                return False
+            data_end = max(data_end, end)
+        return 8 + header_length + data_end == size
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return False
+
+class CheckpointIndex:
+    def __init__(self, directory, sort_key=default_sort_key, index_file=None):
+        self.directory = directory
+        self.sort_key = sort_key # filename -> comparable, newest is largest
+        self.index_file = index_file or os.path.join(directory, INDEX_NAME)
+        self.index = self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"dir_mtime": None, "files": {}} # files: {name : {"mtime", "size", "valid"}}
+
+    def save(self):
+        # a unique temp file, the preemption hook and cron / --watch may save the same index at once
+        slurm_cache.atomic_write_json(self.index_file, self.index)
+
+    def refresh_entry(self, name, stat):
+        entry = self.index["files"].get(name)
+        if entry is not None and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return False
+        self.index["files"][name] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "valid": validate_safetensors(os.path.join(self.directory, name)),
+        }
+        return True
+
+    def update(self):
+        """
+        Lists the directory only if its mtime changed, otherwise re-checks just the invalid entries
+        (a file still being written when it was indexed may have been finished since)
+        """
+        changed = False
+        dir_mtime = os.stat(self.directory).st_mtime_ns
+        if dir_mtime != self.index["dir_mtime"]:
+            seen = set()
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".safetensors"):
+                        seen.add(entry.name)
+                        changed |= self.refresh_entry(entry.name, entry.stat())
+            for name in set(self.index["files"]) - seen:
+                del self.index["files"][name]
+                changed = True
+            self.index["dir_mtime"] = dir_mtime
+            changed = True
+        else:
+            for name, entry in list(self.index["files"].items()):
+                if not entry["valid"]:
+                    try:
+                        changed |= self.refresh_entry(name, os.stat(os.path.join(self.directory, name)))
+                    except FileNotFoundError:
+                        del self.index["files"][name]
+                        changed = True
+        if changed:
+            self.save()
+
+    def sorted_names(self):
+        return sorted(self.index["files"], key=self.sort_key)
+
+    def newest(self, valid_only=True):
+        """
+        Returns the newest checkpoint file name, the newest valid one if valid_only, None if there is none
+        """
+        self.update()
+        for name in reversed(self.sorted_names()):
+            if not valid_only or self.index["files"][name]["valid"]:
+                return name
+        return None
+
+    def invalid_newer_than(self, name):
+        # corrupt checkpoints that sort after name, i.e. were skipped
+        names = self.sorted_names()
+        newer = names[names.index(name) + 1:] if name in names else names
+        return [n for n in newer if not self.index["files"][n]["valid"]]
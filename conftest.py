@@ -0,0 +1 @@
+# makes the top-level modules importable from tests/ with a plain `pytest` run from the repo root
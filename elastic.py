@@ -0,0 +1,94 @@
+"""
+Elastic resubmission: keeps the global batch size of a run fixed whatever allocation the planner picks
+
+global batch = gpus * train_batch_size * gradient_accumulation_steps, the per-gpu batch and accumulation steps
+are recomputed for every allocation, learning rates and max_train_steps are optionally rescaled
+when the target can not be met exactly, from base values saved when the campaign was registered
+"""
+import math
+from collections import namedtuple
+
+# sd-scripts config keys
+BATCH_KEY = "train_batch_size"
+ACCUMULATION_KEY = "gradient_accumulation_steps"
+STEPS_KEY = "max_train_steps"
+LR_KEYS = ["learning_rate", "unet_lr", "text_encoder_lr"]
+DEFAULT_SECTION = "training_arguments"
+LR_SCALING = ["none", "linear", "sqrt"]
+BATCH_TOLERANCE = 0.1 # relative distance to the target global batch traded for a larger per-gpu batch when no split is exact
+
+ElasticPlan = namedtuple("ElasticPlan", ["world_size", "per_gpu_batch", "accumulation_steps", "global_batch"])
+
+def plan_batch(target_global_batch, world_size, max_per_gpu_batch, tolerance=BATCH_TOLERANCE):
+    """
+    Per-gpu batch and accumulation steps for world_size gpus
+    every per-gpu batch is tried with the accumulation steps just below and above the target,
+    an exact split with the largest per-gpu batch wins; without one the largest per-gpu batch whose global batch is
+    within tolerance (relative) of the target, so world sizes that do not divide the target do not end up at
+    a per-gpu batch of 1 with many accumulation steps; without one within tolerance the closest
+    """
+    if world_size <= 0:
+        raise ValueError(f"world_size must be positive, got {world_size}")
+    best = None
+    for per_gpu_batch in range(1, max_per_gpu_batch + 1):
+        steps = target_global_batch / (world_size * per_gpu_batch)
+        for accumulation_steps in {max(math.floor(steps), 1), max(math.ceil(steps), 1)}:
+            global_batch = world_size * per_gpu_batch * accumulation_steps
+            distance = abs(global_batch - target_global_batch)
+            within = distance <= tolerance * target_global_batch
+            key = (distance > 0, not within, 0 if within else distance, -per_gpu_batch, distance, accumulation_steps)
+            if best is None or key < best[0]:
+                best = (key, ElasticPlan(world_size, per_gpu_batch, accumulation_steps, global_batch))
+    return best[1]
+
+def scale_lr(base_lr, base_global_batch, global_batch, rule="none"):
+    # linear: lr proportional to the batch, sqrt: to its square root
+    if rule == "linear":
+        return base_lr * global_batch / base_global_batch
+    if rule == "sqrt":
+        return base_lr * math.sqrt(global_batch / base_global_batch)
+    return base_lr
+
+def scale_steps(base_steps, base_global_batch, global_batch):
+    # the same number of samples over the run
+    return math.ceil(base_steps * base_global_batch / global_batch)
+
+def find_section(config, key, create=True):
+    """
+    The table of config that holds key, training_arguments (created if needed) when none does, None if not create
+    """
+    for section in config.values():
+        if isinstance(section, dict) and key in section:
+            return section
+    return config.setdefault(DEFAULT_SECTION, {}) if create else None
+
+def read_base_values(config):
+    """
+    Learning rates and max_train_steps of a config before any elastic change, saved in the campaign options
+    """
+    base = {"learning_rates": {}}
+    for key in LR_KEYS:
+        section = find_section(config, key, create=False)
+        if section is not None:
+            base["learning_rates"][key] = section[key]
+    steps_section = find_section(config, STEPS_KEY, create=False)
+    if steps_section is not None:
+        base[STEPS_KEY] = steps_section[STEPS_KEY]
+    return base
+
+def apply_to_config(config, plan, settings):
+    """
+    Writes plan into the config, settings are the "elastic" campaign options:
+    target_global_batch, lr_scaling, adjust_steps and the base values of read_base_values
+    """
+    find_section(config, BATCH_KEY)[BATCH_KEY] = plan.per_gpu_batch
+    find_section(config, ACCUMULATION_KEY)[ACCUMULATION_KEY] = plan.accumulation_steps
+    base_global_batch = settings["target_global_batch"]
+    base = settings.get("base", {})
+    rule = settings.get("lr_scaling", "none")
+    if rule != "none":
+        for key, base_lr in base.get("learning_rates", {}).items():
+            find_section(config, key)[key] = scale_lr(base_lr, base_global_batch, plan.global_batch, rule)
+    if settings.get("adjust_steps") and STEPS_KEY in base:
+        find_section(config, STEPS_KEY)[STEPS_KEY] = scale_steps(base[STEPS_KEY], base_global_batch, plan.global_batch)
+    return config
@@ -0,0 +1,532 @@
+"""
+Simulated Slurm cluster for testing and benchmarking auto_qos.py / auto_rerun.py without a real cluster
+
+python fake_slurm.py init --state /tmp/cluster --nodes 1000      # synthetic cluster + partitions.csv
+python fake_slurm.py shims --state /tmp/cluster                  # /tmp/cluster/bin/{sinfo,scontrol,squeue,sbatch,sacct,scancel}
+export PATH=/tmp/cluster/bin:$PATH AUTO_QOS_PARTITION_CSV=/tmp/cluster/partitions.csv
+python fake_slurm.py tick --state /tmp/cluster --seconds 600     # advance the clock, start / finish / preempt jobs
+python fake_slurm.py preempt --state /tmp/cluster 1000           # preempt one job, after running its --signal trap
+
+every emulated command is appended to <state>/calls.log as one json line (argv, seconds) for subprocess counts
+"""
+import argparse
+import fcntl
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hostlist
+
+COMMANDS = ["sinfo", "scontrol", "squeue", "sbatch", "sacct", "scancel"]
+# partition -> (gres type, gpus per node choices, cpus per node choices, memory MB per node, qos list, share of nodes)
+PARTITIONS = {
+    "big_suma_rtx3090": ("rtx3090", [4, 8], [64, 96], 257000, ["normal", "big_qos"], 0.35),
+    "suma_rtx3090": ("rtx3090", [4, 8], [64, 96], 257000, ["normal", "base_qos"], 0.15),
+    "suma_a100": ("a100", [4, 8], [64, 128], 1000000, ["normal", "a100_qos"], 0.15),
+    "suma_rtx4090": ("rtx4090", [6, 8], [64, 96], 385000, ["normal", "big_qos"], 0.2),
+    "suma_a6000": ("a6000", [4, 8], [96, 128], 513000, ["normal", "a6000_qos"], 0.15),
+}
+ACTIVE = ("PENDING", "RUNNING")
+STATE_CODES = {"PENDING": "PD", "RUNNING": "R", "COMPLETED": "CD", "CANCELLED": "CA", "PREEMPTED": "PR"}
+JOB_DURATION = 6 * 3600 # simulated seconds a submitted job runs before COMPLETED
+# the trap block auto_rerun.install_preemption_hook writes into batch scripts, the only part of a script that is run
+HOOK_BEGIN = "# >>> auto_rerun preemption hook >>>"
+HOOK_END = "# <<< auto_rerun preemption hook <<<"
+
+@contextmanager
+def cluster_state(state_dir, write=False):
+    """
+    Loads <state_dir>/cluster.json under a lock, writes it back if write
+    """
+    path = os.path.join(state_dir, "cluster.json")
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        with open(path, "r") as f:
+            state = json.load(f)
+        yield state
+        if write:
+            with open(path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(path + ".tmp", path)
+
+def generate_cluster(node_count, seed=0, busy=0.5, down=0.02):
+    """
+    node_count nodes over PARTITIONS, roughly busy of them partly or fully allocated by background jobs
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    state = {"clock": now, "next_job_id": 1000, "nodes": {}, "jobs": {}}
+    names = list(PARTITIONS)
+    counts = [max(1, round(node_count * PARTITIONS[name][5])) for name in names]
+    counts[0] += node_count - sum(counts) # rounding goes to the first partition
+    for partition, count in zip(names, counts):
+        gres_type, gpu_choices, cpu_choices, memory, _, _ = PARTITIONS[partition]
+        for i in range(1, max(count, 0) + 1):
+            node = {
+                "name": f"{partition.split('_')[-1]}-{partition.split('_')[0]}{i:04d}",
+                "partition": partition,
+                "gres_type": gres_type,
+                "gpus": rng.choice(gpu_choices),
+                "cpus": rng.choice(cpu_choices),
+                "memory": memory,
+                "alloc_gpus": 0,
+                "alloc_cpus": 0,
+                "alloc_memory": 0,
+                "down": rng.random() < down,
+            }
+            state["nodes"][node["name"]] = node
+            if not node["down"] and rng.random() < busy:
+                # background job of another user on part of (or the whole) node
+                gpus = rng.randint(1, node["gpus"])
+                job = new_job(state, {"job_name": "background", "partition": partition, "qos": "normal", "nodes": 1,
+                                      "gpus_per_node": gpus, "cpus_per_gpu": rng.choice([2, 4, 8, 12]), "mem_per_gpu": 16000},
+                              user="other", workdir="/tmp")
+                job["duration"] = rng.randint(600, 3 * 24 * 3600)
+                allocate(state, job, [node["name"]])
+    return state
+
+def new_job(state, request, user=None, workdir=None):
+    job_id = str(state["next_job_id"])
+    state["next_job_id"] += 1
+    job = dict(request)
+    job.update({"job_id": job_id, "user": user or os.environ.get("USER", "user"), "workdir": workdir or os.getcwd(),
+                "state": "PENDING", "submit": state["clock"], "start": None, "end": None, "duration": JOB_DURATION,
+                "alloc_nodes": [], "reason": "Resources"})
+    state["jobs"][job_id] = job
+    return job
+
+def fits(node, job):
+    gpus = job["gpus_per_node"]
+    return (not node["down"]
+            and node["gpus"] - node["alloc_gpus"] >= gpus
+            and node["cpus"] - node["alloc_cpus"] >= gpus * job["cpus_per_gpu"]
+            and node["memory"] - node["alloc_memory"] >= gpus * job.get("mem_per_gpu", 0))
+
+def allocate(state, job, node_names):
+    for name in node_names:
+        node = state["nodes"][name]
+        node["alloc_gpus"] += job["gpus_per_node"]
+        node["alloc_cpus"] += job["gpus_per_node"] * job["cpus_per_gpu"]
+        node["alloc_memory"] += job["gpus_per_node"] * job.get("mem_per_gpu", 0)
+    job.update({"state": "RUNNING", "start": state["clock"], "alloc_nodes": list(node_names), "reason": "None"})
+    write_log(job, "job started on " + hostlist.compress(node_names))
+
+def release(state, job, final_state, message=None):
+    for name in job["alloc_nodes"]:
+        node = state["nodes"][name]
+        node["alloc_gpus"] -= job["gpus_per_node"]
+        node["alloc_cpus"] -= job["gpus_per_node"] * job["cpus_per_gpu"]
+        node["alloc_memory"] -= job["gpus_per_node"] * job.get("mem_per_gpu", 0)
+    job.update({"state": final_state, "end": state["clock"]})
+    if message:
+        write_log(job, message)
+
+def try_start(state, job):
+    allowed = set(hostlist.expand(job["nodelist"])) if job.get("nodelist") else None
+    candidates = [name for name, node in state["nodes"].items()
+                  if node["partition"] == job["partition"] and (allowed is None or name in allowed) and fits(node, job)]
+    if len(candidates) < job["nodes"]:
+        return False
+    allocate(state, job, candidates[:job["nodes"]])
+    return True
+
+def log_path(job, pattern):
+    path = re.sub(r'%([%xjAu])', lambda m: {"%": "%", "x": job["job_name"], "j": job["job_id"], "A": job["job_id"], "u": job["user"]}[m.group(1)], pattern)
+    return os.path.join(job["workdir"], path)
+
+def write_log(job, message):
+    if job["user"] == "other" or not job.get("output"):
+        return
+    with open(log_path(job, job["output"]), "a") as f:
+        f.write(message + "\n")
+
+def advance(state, seconds, preempt_probability=0.0, rng=None):
+    """
+    Moves the clock forward: running jobs past their duration complete, pending jobs start if they fit,
+    and every running job of the user is preempted with preempt_probability
+    """
+    rng = rng or random.Random()
+    state["clock"] += seconds
+    for job in state["jobs"].values():
+        if job["state"] == "RUNNING" and job["start"] + job["duration"] <= state["clock"]:
+            release(state, job, "COMPLETED")
+    for job in state["jobs"].values():
+        if job["state"] == "RUNNING" and job["user"] != "other" and rng.random() < preempt_probability:
+            preempt(state, job)
+    for job in sorted(state["jobs"].values(), key=lambda j: int(j["job_id"])):
+        if job["state"] == "PENDING":
+            try_start(state, job)
+
+def preempt(state, job):
+    node = job["alloc_nodes"][0] if job["alloc_nodes"] else "unknown"
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(state["clock"]))
+    release(state, job, "PREEMPTED", f"slurmstepd: error: *** JOB {job['job_id']} ON {node} CANCELLED AT {stamp} DUE TO PREEMPTION ***")
+
+def deliver_signal(job):
+    """
+    Runs the preemption hook of the job's batch script like the batch shell receiving the --signal=[B:]SIG@secs signal,
+    with the output appended to the job's log, returns False if the job asked for no signal or its script has no hook
+    """
+    if not job.get("signal"):
+        return False
+    name = job["signal"].split(":")[-1].split("@")[0]
+    with open(job["script"], "r") as f:
+        lines = f.read().splitlines()
+    if HOOK_BEGIN not in lines or HOOK_END not in lines:
+        return False
+    block = lines[lines.index(HOOK_BEGIN):lines.index(HOOK_END) + 1]
+    script = "\n".join(block + [f"kill -{name} $$", "until wait; do :; done"]) + "\n"
+    write_log(job, f"slurmstepd: sending SIG{name} to the batch step of job {job['job_id']}")
+    with open(log_path(job, job["output"]), "a") as log:
+        subprocess.run(["bash", "-c", script], cwd=job["workdir"], stdout=log, stderr=subprocess.STDOUT,
+                       env=dict(os.environ, SLURM_JOB_ID=job["job_id"]))
+    return True
+
+def node_state(node):
+    if node["down"]:
+        return "down*"
+    if node["alloc_gpus"] == 0 and node["alloc_cpus"] == 0:
+        return "idle"
+    if node["alloc_gpus"] >= node["gpus"] or node["alloc_cpus"] >= node["cpus"]:
+        return "alloc"
+    return "mix"
+
+# ---- emulated commands, each takes argv and the state dir and returns (stdout, exit code) ----
+
+def cmd_sinfo(argv, state_dir):
+    with cluster_state(state_dir) as state:
+        groups = {}
+        for name, node in state["nodes"].items():
+            groups.setdefault((node["partition"], node_state(node)), []).append(name)
+    lines = [] if "-h" in argv else ["PARTITION AVAIL  TIMELIMIT  NODES  STATE NODELIST"]
+    for (partition, status), names in groups.items():
+        lines.append(f"{partition} up 3-00:00:00 {len(names)} {status} {hostlist.compress(names)}")
+    return "\n".join(lines) + "\n", 0
+
+def node_fields(node, boot_time):
+    gpus, gres_type = node["gpus"], node["gres_type"]
+    alloc_tres = ""
+    if node["alloc_cpus"] or node["alloc_gpus"]:
+        alloc_tres = f"cpu={node['alloc_cpus']},mem={node['alloc_memory']}M,gres/gpu={node['alloc_gpus']},gres/gpu:{gres_type}={node['alloc_gpus']}"
+    return [
+        ("NodeName", node["name"]), ("Arch", "x86_64"), ("CoresPerSocket", node["cpus"] // 2),
+        ("CPUAlloc", node["alloc_cpus"]), ("CPUEfctv", node["cpus"]), ("CPUTot", node["cpus"]), ("CPULoad", "0.00"),
+        ("AvailableFeatures", "(null)"), ("ActiveFeatures", "(null)"),
+        ("Gres", f"gpu:{gres_type}:{gpus}(S:0-1)"),
+        ("NodeAddr", node["name"]), ("NodeHostName", node["name"]), ("Version", "23.02.6"),
+        ("OS", "Linux 5.15.0-91-generic #101-Ubuntu SMP Tue Nov 14 13:30:08 UTC 2023"),
+        ("RealMemory", node["memory"]), ("AllocMem", node["alloc_memory"]), ("FreeMem", node["memory"] - node["alloc_memory"]),
+        ("Sockets", 2), ("Boards", 1),
+        ("State", node_state(node).rstrip("*").upper() + ("+NOT_RESPONDING" if node["down"] else "")),
+        ("ThreadsPerCore", 1), ("TmpDisk", 0), ("Weight", 1), ("Owner", "N/A"), ("MCS_label", "N/A"),
+        ("Partitions", node["partition"]), ("BootTime", boot_time), ("SlurmdStartTime", boot_time),
+        ("CfgTRES", f"cpu={node['cpus']},mem={node['memory']}M,billing={node['cpus']},gres/gpu={gpus},gres/gpu:{gres_type}={gpus}"),
+        ("AllocTRES", alloc_tres),
+        ("CapWatts", "n/a"), ("CurrentWatts", 0), ("AveWatts", 0),
+        ("ExtSensorsJoules", "n/s"), ("ExtSensorsWatts", 0), ("ExtSensorsTemp", "n/s"),
+    ]
+
+# line breaks of the multi-line `scontrol show node` format, after these keys
+MULTILINE_BREAKS = {"CoresPerSocket", "CPULoad", "AvailableFeatures", "ActiveFeatures", "Gres", "NodeAddr", "Version", "OS",
+                    "Boards", "MCS_label", "Partitions", "SlurmdStartTime", "CfgTRES", "AllocTRES", "CapWatts", "ExtSensorsTemp"}
+
+def format_node(node, one_line, boot_time):
+    fields = [f"{key}={value}" for key, value in node_fields(node, boot_time)]
+    if one_line:
+        return " ".join(fields)
+    lines, line = [], []
+    for (key, _), field in zip(node_fields(node, boot_time), fields):
+        line.append(field)
+        if key in MULTILINE_BREAKS:
+            lines.append(" ".join(line))
+            line = []
+    return "\n   ".join(lines) + "\n"
+
+def node_json(node):
+    return {
+        "name": node["name"], "partitions": [node["partition"]], "cpus": node["cpus"], "alloc_cpus": node["alloc_cpus"],
+        "real_memory": node["memory"], "alloc_memory": node["alloc_memory"], "state": [node_state(node).rstrip("*").upper()],
+        "gres": f"gpu:{node['gres_type']}:{node['gpus']}(S:0-1)",
+        "gres_used": f"gpu:{node['gres_type']}:{node['alloc_gpus']}(IDX:N/A)",
+        "tres": f"cpu={node['cpus']},mem={node['memory']}M,billing={node['cpus']},gres/gpu={node['gpus']}",
+        "tres_used": f"cpu={node['alloc_cpus']},mem={node['alloc_memory']}M,gres/gpu={node['alloc_gpus']}" if node["alloc_cpus"] else None,
+    }
+
+def cmd_scontrol(argv, state_dir):
+    if argv[:2] == ["show", "hostnames"]:
+        names = argv[2] if len(argv) > 2 else os.environ.get("SLURM_JOB_NODELIST", "")
+        return "".join(name + "\n" for name in hostlist.expand(names)), 0
+    if argv[:2] == ["show", "job"]:
+        with cluster_state(state_dir) as state:
+            job = state["jobs"].get(argv[2]) if len(argv) > 2 else None
+        if job is None:
+            return "slurm_load_jobs error: Invalid job id specified\n", 1
+        gpus = job['nodes'] * job['gpus_per_node']
+        tres = f"cpu={gpus * job['cpus_per_gpu']},mem={gpus * job.get('mem_per_gpu', 0)}M,node={job['nodes']},billing=1,gres/gpu={gpus}"
+        node_list = hostlist.compress(job["alloc_nodes"]) if job["state"] == "RUNNING" else "(null)"
+        return (f"JobId={job['job_id']} JobName={job['job_name']}\n   JobState={job['state']} Reason={job['reason']}\n"
+                f"   Partition={job['partition']} QOS={job['qos']}\n   NodeList={node_list}\n   NumNodes={job['nodes']} TRES={tres}\n"), 0
+    if argv[:2] != ["show", "node"]:
+        return f"scontrol: unsupported command {' '.join(argv)}\n", 1
+    rest = argv[2:]
+    with cluster_state(state_dir) as state:
+        boot_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(state["clock"] - 30 * 24 * 3600))
+        names = [a for a in rest if not a.startswith("-")]
+        nodes = [state["nodes"][n] for n in names if n in state["nodes"]] if names else list(state["nodes"].values())
+    if names and not nodes:
+        return f"Node {names[0]} not found\n", 1
+    if "--json" in rest:
+        return json.dumps({"nodes": [node_json(node) for node in nodes]}), 0
+    one_line = "-o" in rest or "--oneliner" in rest
+    return "\n".join(format_node(node, one_line, boot_time) for node in nodes) + "\n", 0
+
+def parse_options(argv):
+    """
+    --key=value / --key value / -x value -> ({key: value}, positional)
+    """
+    options, positional = {}, []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith("--"):
+            key, sep, value = arg[2:].partition("=")
+            if not sep and i + 1 < len(argv) and not argv[i + 1].startswith("-") and key not in ("start", "noheader", "parsable2", "allocations", "batch"):
+                value = argv[i + 1]
+                i += 1
+            options[key] = value
+        elif arg.startswith("-") and len(arg) == 2:
+            if arg in ("-h", "-n", "-X", "-P", "-a") or i + 1 >= len(argv):
+                options[arg[1]] = ""
+            else:
+                options[arg[1]] = argv[i + 1]
+                i += 1
+        else:
+            positional.append(arg)
+        i += 1
+    return options, positional
+
+def format_time(stamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stamp)) if stamp else "N/A"
+
+SQUEUE_FIELDS = {
+    "i": lambda job, state: job["job_id"], "T": lambda job, state: job["state"], "t": lambda job, state: STATE_CODES.get(job["state"], job["state"][:2]),
+    "P": lambda job, state: job["partition"], "j": lambda job, state: job["job_name"], "u": lambda job, state: job["user"],
+    "D": lambda job, state: str(job["nodes"]), "q": lambda job, state: job["qos"],
+    "S": lambda job, state: format_time(job["start"] or estimate_start(state, job)),
+    "b": lambda job, state: f"gres/gpu:{job['gpus_per_node']}", "R": lambda job, state: hostlist.compress(job["alloc_nodes"]) or f"({job['reason']})",
+    "V": lambda job, state: format_time(job["submit"]),
+}
+
+def estimate_start(state, job):
+    # the earliest end of a running job in the partition, like the backfill estimate of squeue --start
+    ends = [j["start"] + j["duration"] for j in state["jobs"].values() if j["state"] == "RUNNING" and j["partition"] == job["partition"]]
+    return min(ends) if ends else state["clock"]
+
+def cmd_squeue(argv, state_dir):
+    options, _ = parse_options(argv)
+    job_filter = options.get("job") or options.get("jobs") or options.get("j")
+    with cluster_state(state_dir) as state:
+        jobs = [job for job in state["jobs"].values() if job["state"] in ACTIVE]
+        if job_filter:
+            wanted = set(job_filter.split(","))
+            known = [job for job in state["jobs"].values() if job["job_id"] in wanted]
+            if not known:
+                return "slurm_load_jobs error: Invalid job id specified\n", 1
+            jobs = [job for job in jobs if job["job_id"] in wanted]
+        if "p" in options or "partition" in options:
+            partitions = set((options.get("p") or options.get("partition")).split(","))
+            jobs = [job for job in jobs if job["partition"] in partitions]
+        if "start" in options:
+            jobs = [job for job in jobs if job["state"] == "PENDING"]
+        fmt = options.get("o") or options.get("format")
+        lines = []
+        if fmt is None:
+            if "start" in options:
+                header = "JOBID PARTITION     NAME     USER ST          START_TIME  NODES SCHEDNODES           NODELIST(REASON)"
+                fmt = "%i %P %j %u %t %S %D (null) (%r)"
+            else:
+                header = "JOBID PARTITION     NAME     USER ST       TIME  NODES NODELIST(REASON)"
+                fmt = "%i %P %j %u %t 0:00 %D %R"
+            if "h" not in options and "noheader" not in options:
+                lines.append(header)
+        fields = SQUEUE_FIELDS.copy()
+        fields["r"] = lambda job, state: job["reason"]
+        for job in sorted(jobs, key=lambda j: int(j["job_id"])):
+            lines.append(re.sub(r'%\.?\d*([a-zA-Z])', lambda m: fields.get(m.group(1), lambda j, s: "")(job, state), fmt))
+    return "\n".join(lines) + ("\n" if lines else ""), 0
+
+SACCT_FIELDS = {
+    "jobid": lambda job: job["job_id"], "jobname": lambda job: job["job_name"], "state": lambda job: job["state"],
+    "partition": lambda job: job["partition"], "qos": lambda job: job["qos"], "nnodes": lambda job: str(job["nodes"]),
+    "submit": lambda job: format_time(job["submit"]), "start": lambda job: format_time(job["start"]), "end": lambda job: format_time(job["end"]),
+    "alloctres": lambda job: f"cpu={job['nodes'] * job['gpus_per_node'] * job['cpus_per_gpu']},gres/gpu={job['nodes'] * job['gpus_per_node']},node={job['nodes']}",
+    "elapsed": lambda job: "%02d:%02d:%02d" % ((lambda s: (s // 3600, s % 3600 // 60, s % 60))(int(((job["end"] or job["start"] or 0) - (job["start"] or 0))))),
+    "user": lambda job: job["user"], "workdir": lambda job: job["workdir"],
+}
+
+def cmd_sacct(argv, state_dir):
+    options, _ = parse_options(argv)
+    fields = (options.get("o") or options.get("format") or "JobID,JobName,Partition,State").split(",")
+    job_filter = options.get("j") or options.get("jobs")
+    with cluster_state(state_dir) as state:
+        jobs = list(state["jobs"].values())
+    if job_filter:
+        wanted = set(job_filter.split(","))
+        jobs = [job for job in jobs if job["job_id"] in wanted]
+    elif "allusers" not in options and "a" not in options:
+        jobs = [job for job in jobs if job["user"] != "other"]
+    if "r" in options or "partition" in options:
+        partitions = set((options.get("r") or options.get("partition")).split(","))
+        jobs = [job for job in jobs if job["partition"] in partitions]
+    separator = "|" if ("P" in options or "parsable2" in options) else " "
+    lines = [] if ("n" in options or "noheader" in options) else [separator.join(fields)]
+    for job in sorted(jobs, key=lambda j: int(j["job_id"])):
+        lines.append(separator.join(SACCT_FIELDS.get(field.lower(), lambda j: "")(job) for field in fields))
+    return "\n".join(lines) + ("\n" if lines else ""), 0
+
+def read_sbatch_directives(path):
+    directives = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("#SBATCH"):
+                directives.extend(line.split("#", 2)[1][len("SBATCH"):].split())
+    return directives
+
+def cmd_sbatch(argv, state_dir):
+    script = next((a for a in argv if not a.startswith("-")), None)
+    if script is None or not os.path.exists(script):
+        return "sbatch: error: Unable to open file\n", 1
+    # command line options override #SBATCH lines
+    options, _ = parse_options(read_sbatch_directives(script) + [a for a in argv if a != script])
+    gres = options.get("gres", "gpu:1")
+    mem_per_gpu = options.get("mem-per-gpu", "0")
+    request = {
+        "job_name": options.get("job-name") or options.get("J") or os.path.basename(script),
+        "partition": options.get("partition") or options.get("p") or list(PARTITIONS)[0],
+        "qos": options.get("qos") or options.get("q") or "normal",
+        "nodes": int(options.get("nodes") or options.get("N") or 1),
+        "gpus_per_node": int(gres.split(":")[-1]),
+        "cpus_per_gpu": int(options.get("cpus-per-gpu", 1)),
+        "mem_per_gpu": int(re.sub(r'[^0-9]', '', mem_per_gpu) or 0) * (1024 if mem_per_gpu.upper().endswith("G") else 1),
+        "nodelist": options.get("nodelist") or options.get("w"),
+        "signal": options.get("signal"),
+        "output": options.get("output") or options.get("o") or "slurm-%j.out",
+        "error": options.get("error") or options.get("e"),
+        "script": os.path.abspath(script),
+    }
+    with cluster_state(state_dir, write=True) as state:
+        if not any(node["partition"] == request["partition"] for node in state["nodes"].values()):
+            return "sbatch: error: invalid partition specified: {}\n".format(request["partition"]), 1
+        job = new_job(state, request)
+        try_start(state, job)
+    return f"Submitted batch job {job['job_id']}\n", 0
+
+def cmd_scancel(argv, state_dir):
+    options, job_ids = parse_options(argv)
+    signal = options.get("s") or options.get("signal")
+    with cluster_state(state_dir, write=True) as state:
+        for job_id in job_ids:
+            job = state["jobs"].get(job_id)
+            if job is None or job["state"] not in ACTIVE:
+                continue
+            if signal:
+                job.setdefault("signals", []).append(signal)
+                continue
+            release(state, job, "CANCELLED", f"slurmstepd: error: *** JOB {job_id} CANCELLED AT {format_time(state['clock'])} ***")
+    return "", 0
+
+def run_emulated(command, argv, state_dir):
+    start = time.perf_counter()
+    stdout, code = globals()["cmd_" + command](argv, state_dir)
+    with open(os.path.join(state_dir, "calls.log"), "a") as f:
+        f.write(json.dumps({"argv": [command] + argv, "seconds": time.perf_counter() - start}) + "\n")
+    return stdout, code
+
+def write_partition_csv(state_dir):
+    # Partition Name,Allowed QoS Names,<unused> like the csv auto_qos reads
+    with open(os.path.join(state_dir, "partitions.csv"), "w") as f:
+        for partition, (_, _, _, _, qos_list, _) in PARTITIONS.items():
+            f.write(f"{partition},{'|'.join(qos_list)},\n")
+        f.write("maintenance,normal,\n")
+
+def write_shims(state_dir):
+    bin_dir = os.path.join(state_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for command in COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" --state "{os.path.abspath(state_dir)}" {command} "$@"\n')
+        os.chmod(path, 0o755)
+    return bin_dir
+
+def call_count(state_dir):
+    """
+    Number of emulated commands run so far and their total seconds
+    """
+    path = os.path.join(state_dir, "calls.log")
+    if not os.path.exists(path):
+        return 0, 0.0
+    with open(path, "r") as f:
+        calls = [json.loads(line) for line in f if line.strip()]
+    return len(calls), sum(call["seconds"] for call in calls)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    state_dir = os.environ.get("FAKE_SLURM_STATE", "fake_cluster")
+    if argv[:1] == ["--state"]:
+        state_dir, argv = argv[1], argv[2:]
+    if argv[:1] and argv[0] in COMMANDS:
+        # the arguments are the emulated command's own, -h included
+        stdout, code = run_emulated(argv[0], argv[1:], state_dir)
+        (sys.stdout if code == 0 else sys.stderr).write(stdout)
+        return code
+    parser = argparse.ArgumentParser(description="Simulated Slurm cluster")
+    parser.add_argument("--state", default=state_dir, help="Cluster state directory")
+    parser.add_argument("command", help="init, shims, tick, preempt, or an emulated command: " + ", ".join(COMMANDS))
+    args, rest = parser.parse_known_args(argv)
+    sub = argparse.ArgumentParser(prog=f"fake_slurm.py {args.command}")
+    if args.command == "init":
+        sub.add_argument("--nodes", type=int, default=100)
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--busy", type=float, default=0.5, help="Share of nodes with a background job")
+        options = sub.parse_args(rest)
+        os.makedirs(args.state, exist_ok=True)
+        state = generate_cluster(options.nodes, options.seed, options.busy)
+        with open(os.path.join(args.state, "cluster.json"), "w") as f:
+            json.dump(state, f)
+        write_partition_csv(args.state)
+        print(f"{len(state['nodes'])} nodes in {args.state}")
+    elif args.command == "shims":
+        print(write_shims(args.state))
+    elif args.command == "tick":
+        sub.add_argument("--seconds", type=int, default=60)
+        sub.add_argument("--preempt_probability", type=float, default=0.0)
+        options = sub.parse_args(rest)
+        with cluster_state(args.state, write=True) as state:
+            advance(state, options.seconds, options.preempt_probability)
+    elif args.command == "preempt":
+        sub.add_argument("job_ids", nargs="+")
+        sub.add_argument("--no_signal", action="store_true", help="Preempt without running the --signal trap of the jobs first")
+        options = sub.parse_args(rest)
+        with cluster_state(args.state) as state:
+            running = [dict(state["jobs"][job_id]) for job_id in options.job_ids if state["jobs"].get(job_id, {}).get("state") == "RUNNING"]
+        if not options.no_signal:
+            # the hook calls the emulated commands, so it runs without the state lock
+            for job in running:
+                deliver_signal(job)
+        with cluster_state(args.state, write=True) as state:
+            for job_id in options.job_ids:
+                if state["jobs"].get(job_id, {}).get("state") in ACTIVE:
+                    preempt(state, state["jobs"][job_id])
+    else:
+        parser.error(f"unknown command {args.command}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Slurm hostlist expressions, e.g. node[01,03-05],rack[1-2]-gpu[01-08]
+
+expand() is a generator, count() and contains() work on the parsed ranges without building the node list,
+compress() turns node names back into bracket form for --nodelist
+"""
+import re
+
+_DIGITS = re.compile(r'\d+')
+
+
+def split_hostlist(hostlist):
+    """
+    Splits on "," which is not inside [], anode[01-03],bnode5 -> ["anode[01-03]", "bnode5"]
+    """
+    tokens = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(hostlist):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            tokens.append(hostlist[start:i])
+            start = i + 1
+    tokens.append(hostlist[start:])
+    return [token.strip() for token in tokens if token.strip()]
+
+
+def parse_ranges(bracket):
+    """
+    "01,03-05" -> [(1, 1, 2), (3, 5, 2)] as (start, end, zero padded width)
+    """
+    ranges = []
+    for r in bracket.split(','):
+        start, _, end = r.strip().partition('-')
+        ranges.append((int(start), int(end or start), len(start)))
+    return ranges
+
+
+def parse_token(token):
+    """
+    rack[1-2]-gpu[01-08] -> ["rack", [(1, 2, 1)], "-gpu", [(1, 8, 2)]]
+    literal parts are strings, bracket parts are lists of ranges
+    """
+    segments = []
+    position = 0
+    while True:
+        bracket_start = token.find('[', position)
+        if bracket_start == -1:
+            break
+        bracket_end = token.index(']', bracket_start)
+        if bracket_start > position:
+            segments.append(token[position:bracket_start])
+        segments.append(parse_ranges(token[bracket_start + 1:bracket_end]))
+        position = bracket_end + 1
+    if position < len(token):
+        segments.append(token[position:])
+    return segments
+
+
+def _range_values(ranges):
+    for start, end, width in ranges:
+        for i in range(start, end + 1):
+            yield str(i).zfill(width)
+
+
+def _range_size(ranges):
+    return sum(max(end - start + 1, 0) for start, end, _ in ranges)
+
+
+def _expand_segments(segments, prefix=""):
+    # every bracket is its own dimension, the last one changes fastest
+    # (itertools.product would materialize every range first)
+    if not segments:
+        yield prefix
+        return
+    first, rest = segments[0], segments[1:]
+    if isinstance(first, str):
+        yield from _expand_segments(rest, prefix + first)
+        return
+    for value in _range_values(first):
+        yield from _expand_segments(rest, prefix + value)
+
+
+def expand(hostlist):
+    """
+    Lazily yields every node name of the hostlist, in order
+    """
+    for token in split_hostlist(hostlist):
+        yield from _expand_segments(parse_token(token))
+
+
+def count(hostlist):
+    """
+    Number of names in the hostlist, without expanding it
+    """
+    total = 0
+    for token in split_hostlist(hostlist):
+        size = 1
+        for segment in parse_token(token):
+            if not isinstance(segment, str):
+                size *= _range_size(segment)
+        total += size
+    return total
+
+
+def _token_contains(segments, name):
+    pattern = ""
+    previous_was_range = False
+    for segment in segments:
+        if isinstance(segment, str):
+            pattern += re.escape(segment)
+            previous_was_range = False
+        else:
+            if previous_was_range:
+                return None # node[1-2][3-4], digits can not be split unambiguously
+            pattern += r'(\d+)'
+            previous_was_range = True
+    match = re.fullmatch(pattern, name)
+    if match is None:
+        return False
+    bracket_segments = [segment for segment in segments if not isinstance(segment, str)]
+    for digits, ranges in zip(match.groups(), bracket_segments):
+        value = int(digits)
+        if not any(start <= value <= end and str(value).zfill(width) == digits for start, end, width in ranges):
+            return False
+    return True
+
+
+def contains(hostlist, name):
+    """
+    Whether name is in the hostlist, without expanding it
+    """
+    for token in split_hostlist(hostlist):
+        segments = parse_token(token)
+        found = _token_contains(segments, name)
+        if found is None:
+            found = any(candidate == name for candidate in expand(token))
+        if found:
+            return True
+    return False
+
+
+def _format_ranges(values):
+    # values are sorted (int, width) of one group, consecutive ints become start-end
+    parts = []
+    start = previous = values[0][0]
+    width = values[0][1]
+    for value, _ in values[1:] + [(None, None)]:
+        if value is not None and value == previous + 1:
+            previous = value
+            continue
+        if start == previous:
+            parts.append(str(start).zfill(width))
+        else:
+            parts.append(f"{str(start).zfill(width)}-{str(previous).zfill(width)}")
+        if value is not None:
+            start = previous = value
+    return ",".join(parts)
+
+
+def _compress_once(tokens):
+    # brackets the last number before the first "[" of every token, grouping tokens that differ only in it
+    groups = {} # (prefix, suffix, width) -> [(int, width)]
+    passthrough = []
+    order = []
+    for token in tokens:
+        head_end = token.find('[')
+        head = token if head_end == -1 else token[:head_end]
+        numbers = list(_DIGITS.finditer(head))
+        if not numbers:
+            key = (token, None, None)
+            if key not in groups:
+                groups[key] = None
+                order.append(key)
+            continue
+        digits = numbers[-1]
+        key = (token[:digits.start()], token[digits.end():], digits.group())
+        passthrough.append((key, int(digits.group()), len(digits.group())))
+    # zero padded numbers fix the width, "10" joins a width 2 group like 08-12
+    padded_widths = {}
+    for (prefix, suffix, digits), value, width in passthrough:
+        if digits.startswith('0') and width > 1:
+            padded_widths.setdefault((prefix, suffix), set()).add(width)
+    for (prefix, suffix, digits), value, width in passthrough:
+        if not (digits.startswith('0') and width > 1):
+            fitting = [w for w in padded_widths.get((prefix, suffix), ()) if w <= width]
+            width = max(fitting) if fitting else 1
+        key = (prefix, suffix, width)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((value, width))
+    compressed = []
+    for key in order:
+        prefix, suffix, width = key
+        if groups[key] is None:
+            compressed.append(prefix)
+            continue
+        values = sorted(set(groups[key]))
+        compressed.append(f"{prefix}[{_format_ranges(values)}]{suffix}")
+    return compressed
+
+
+def compress(names):
+    """
+    ["node01", "node02", "node03", "node07"] -> "node[01-03,07]"
+    multi-dimensional names are compressed one number at a time, rack[1-2]-gpu[01-08]
+    """
+    tokens = list(dict.fromkeys(names))
+    if not tokens:
+        return ""
+    while True:
+        # every pass brackets one more number per token, stops once no number is left outside brackets
+        compressed = _compress_once(tokens)
+        if compressed == tokens:
+            break
+        tokens = compressed
+    # node[5] -> node5
+    return ",".join(re.sub(r'\[(\d+)\]', r'\1', token) for token in tokens)
+
+
+class HostList:
+    """
+    A hostlist expression that iterates, counts and tests membership without materializing the node list
+    """
+    def __init__(self, hostlist):
+        self.hostlist = hostlist
+
+    def __iter__(self):
+        return expand(self.hostlist)
+
+    def __len__(self):
+        return count(self.hostlist)
+
+    def __contains__(self, name):
+        return contains(self.hostlist, name)
+
+    def __str__(self):
+        return self.hostlist
@@ -0,0 +1,150 @@
+"""
+Classifies how a job ended from its --output / --error logs, cross-checked with sacct
+
+only the tail of a log is read on the first check, later checks read the bytes written since,
+offsets and what was found so far are kept in a small state file next to the logs
+"""
+import getpass
+import glob
+import json
+import os
+import re
+from collections import namedtuple
+
+import slurm_cache
+
+# outcome, byte patterns; the first outcome found in this order wins
+OUTCOME_PATTERNS = [
+    ("preempted", [b"DUE TO PREEMPTION", b"PREEMPTIED", b"PREEMPTED"]),
+    ("node_failure", [b"DUE TO NODE FAILURE", b"NODE_FAIL"]),
+    ("nccl_timeout", [b"Watchdog caught collective operation timeout", b"NCCL timeout", b"NCCL communicator was aborted"]),
+    ("oom", [b"CUDA out of memory", b"OutOfMemoryError", b"oom-kill", b"oom_kill", b"Out Of Memory"]),
+    ("completed", [b"COMPLETED"]),
+]
+OUTCOME_ORDER = [outcome for outcome, _ in OUTCOME_PATTERNS]
+LONGEST_PATTERN = max(len(pattern) for _, patterns in OUTCOME_PATTERNS for pattern in patterns)
+
+# sacct State -> outcome, the scheduler is trusted over the logs for these
+SACCT_DECISIVE = {"PREEMPTED": "preempted", "NODE_FAIL": "node_failure", "OUT_OF_MEMORY": "oom"}
+SACCT_OUTCOMES = dict(SACCT_DECISIVE, COMPLETED="completed", TIMEOUT="timeout", FAILED="failed", CANCELLED="cancelled")
+
+JobOutcome = namedtuple("JobOutcome", ["outcome", "sacct_state", "files"])
+
+def read_log_patterns(bash_file):
+    """
+    Returns job name, --output and --error patterns from the #SBATCH lines of bash_file
+    """
+    job_name = os.path.basename(bash_file) if bash_file else "sbatch"
+    output_pattern = error_pattern = None
+    if bash_file and os.path.exists(bash_file):
+        with open(bash_file, "r") as f:
+            for line in f:
+                if not line.startswith("#SBATCH"):
+                    continue
+                option = line.split("#", 2)[1][len("SBATCH"):].strip().split()
+                if not option:
+                    continue
+                match = re.match(r'(--job-name|-J|--output|-o|--error|-e)(?:=|$)(.*)', option[0])
+                if not match:
+                    continue
+                value = match.group(2) or (option[1] if len(option) > 1 else "")
+                if match.group(1) in ("--job-name", "-J"):
+                    job_name = value
+                elif match.group(1) in ("--output", "-o"):
+                    output_pattern = value
+                else:
+                    error_pattern = value
+    return job_name, output_pattern or "slurm-%j.out", error_pattern
+
+def expand_log_pattern(pattern, job_id, job_name):
+    """
+    multinode-o-%x.%j -> multinode-o-big_train.660060, unknown placeholders (%N, %t, ...) become a glob
+    """
+    replacements = {"%": "%", "x": job_name, "j": job_id, "A": job_id.split("_")[0], "u": getpass.getuser()}
+    return re.sub(r'%(\d*)([%a-zA-Z])', lambda m: replacements.get(m.group(2), "*"), pattern)
+
+class JobLogClassifier:
+    def __init__(self, bash_file=None, state_file=".job_log_offsets.json", tail_bytes=4 * 1024 * 1024, chunk_bytes=1024 * 1024):
+        self.bash_file = bash_file
+        self.state_file = state_file
+        self.tail_bytes = tail_bytes
+        self.chunk_bytes = chunk_bytes
+        self.state = self.load_state() # {path : {"inode", "offset", "found"}}
+
+    def load_state(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        # a unique temp file, the preemption hook and cron / --watch may save the same state file at once
+        slurm_cache.atomic_write_json(self.state_file, self.state)
+
+    def log_files(self, job_id):
+        job_name, output_pattern, error_pattern = read_log_patterns(self.bash_file)
+        files = []
+        for pattern in (output_pattern, error_pattern):
+            if pattern:
+                files.extend(glob.glob(expand_log_pattern(pattern, job_id, job_name)))
+        return sorted(set(files))
+
+    def scan(self, path):
+        """
+        Returns the outcomes found in path, reading only bytes not seen by a previous scan
+        and at most tail_bytes from the end
+        """
+        stat = os.stat(path)
+        entry = self.state.get(path)
+        if entry is None or entry["inode"] != stat.st_ino or entry["offset"] > stat.st_size:
+            entry = {"inode": stat.st_ino, "offset": 0, "found": []} # new or rotated file
+        start = max(entry["offset"], stat.st_size - self.tail_bytes)
+        found = set(entry["found"])
+        with open(path, "rb") as f:
+            # step back so a pattern split over the previous read is still seen
+            position = max(start - LONGEST_PATTERN, 0)
+            f.seek(position)
+            while position < stat.st_size:
+                chunk = f.read(self.chunk_bytes + LONGEST_PATTERN)
+                for outcome, patterns in OUTCOME_PATTERNS:
+                    if outcome not in found and any(pattern in chunk for pattern in patterns):
+                        found.add(outcome)
+                if position + len(chunk) >= stat.st_size:
+                    break
+                # consecutive chunks overlap by LONGEST_PATTERN bytes
+                position += len(chunk) - LONGEST_PATTERN
+                f.seek(position)
+        entry["offset"] = stat.st_size
+        entry["found"] = sorted(found)
+        self.state[path] = entry
+        return found
+
+    def sacct_state(self, job_id):
+        try:
+            output = slurm_cache.run_cached(["sacct", "-n", "-X", "-P", "-o", "State", "-j", job_id], check=False)
+        except OSError:
+            return None # no sacct on this cluster
+        states = output.split()
+        return states[0] if states else None # "CANCELLED by 123" -> CANCELLED
+
+    def classify(self, job_id, use_sacct=True):
+        """
+        Returns JobOutcome with outcome one of preempted, node_failure, nccl_timeout, oom, completed,
+        or the sacct state (timeout, failed, cancelled) when the logs show nothing, "unknown" otherwise
+        """
+        job_id = str(job_id).strip()
+        files = self.log_files(job_id)
+        found = set()
+        for path in files:
+            found |= self.scan(path)
+        self.save_state()
+        from_logs = next((outcome for outcome in OUTCOME_ORDER if outcome in found), None)
+        sacct_state = self.sacct_state(job_id) if use_sacct else None
+        if sacct_state in SACCT_DECISIVE:
+            outcome = SACCT_DECISIVE[sacct_state]
+        elif from_logs:
+            outcome = from_logs
+        else:
+            outcome = SACCT_OUTCOMES.get(sacct_state, "unknown")
+        return JobOutcome(outcome, sacct_state, files)
@@ -0,0 +1,66 @@
+"""
+Places an allocation shape (nodes x gpus per node, cpus and memory per gpu) on concrete nodes
+
+every node is modeled by its free gpus, cpus and memory and its gres type, a node holds the shape if it has
+gpus per node free gpus with cpus / memory per gpu of each for them, all nodes of a job share one gres type
+best fit: the nodes that are left with the fewest stranded gpus (free gpus without the cpus / memory to use them),
+then with the fewest free gpus, cpus and memory, so whole free nodes stay free for other jobs
+"""
+from collections import namedtuple
+
+import throughput
+
+# free_* are what is not allocated yet, memory in MB, real_memory 0 when scontrol does not report it
+NodeResources = namedtuple("NodeResources", ["name", "partition", "gpu_type", "total_gpus", "free_gpus", "free_cpus", "real_memory", "free_memory"])
+
+def node_resources(record, partition, free_gpus, total_gpus, free_cpus):
+    """
+    NodeResources of a NodeRecord, the gpu counts come from NodeInfoParser
+    """
+    real_memory = int(record.real_memory or 0)
+    return NodeResources(
+        name=record.name,
+        partition=partition,
+        gpu_type=throughput.gpu_type_of(record.gres, partition),
+        total_gpus=int(total_gpus),
+        free_gpus=int(free_gpus),
+        free_cpus=int(free_cpus),
+        real_memory=real_memory,
+        free_memory=real_memory - int(record.alloc_mem or 0),
+    )
+
+def fair_mem_per_gpu(nodes):
+    # the smallest memory per gpu share of the nodes, None if they do not report memory
+    shares = [node.real_memory // node.total_gpus for node in nodes if node.real_memory and node.total_gpus]
+    return min(shares) if shares else None
+
+def fits(node, gpus, cpus_per_gpu, mem_per_gpu=None):
+    return (node.free_gpus >= gpus
+            and node.free_cpus >= gpus * cpus_per_gpu
+            and (not mem_per_gpu or node.free_memory >= gpus * mem_per_gpu))
+
+def leftover(node, gpus, cpus_per_gpu, mem_per_gpu=None):
+    """
+    (stranded gpus, free gpus, free cpus, free memory) of node after placing gpus on it, smaller is a better fit
+    stranded gpus are those the cpus / memory left can not serve at the same cpus / memory per gpu
+    """
+    gpus_left = node.free_gpus - gpus
+    cpus_left = node.free_cpus - gpus * cpus_per_gpu
+    memory_left = node.free_memory - gpus * (mem_per_gpu or 0)
+    usable = min(gpus_left, cpus_left // max(cpus_per_gpu, 1))
+    if mem_per_gpu:
+        usable = min(usable, memory_left // mem_per_gpu)
+    return (gpus_left - usable, gpus_left, cpus_left, memory_left)
+
+def pack(nodes, count, gpus_per_node, cpus_per_gpu, mem_per_gpu=None, gpu_type=None):
+    """
+    Names of up to count nodes that hold gpus_per_node gpus each with the best fit, fewer if fewer fit
+    nodes of another gres type than gpu_type are skipped, without gpu_type the type with the most fitting nodes is used
+    """
+    candidates = [node for node in nodes if fits(node, gpus_per_node, cpus_per_gpu, mem_per_gpu)]
+    if gpu_type is None:
+        types = [node.gpu_type for node in candidates]
+        gpu_type = max(set(types), key=types.count) if types else None
+    candidates = [node for node in candidates if node.gpu_type == gpu_type]
+    candidates.sort(key=lambda node: (leftover(node, gpus_per_node, cpus_per_gpu, mem_per_gpu), node.name))
+    return [node.name for node in candidates[:count]]
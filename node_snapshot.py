@@ -0,0 +1,235 @@
+import json
+import re
+import subprocess
+import time
+import hostlist
+from slurm_cache import run_cached
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+
+# compact per-node record, only the fields NodeInfoParser and the node packing need
+# values are kept as the raw strings scontrol prints so the gres/AllocTRES/CfgTRES parsing stays the same
+# real_memory / alloc_mem are MB, "0" when scontrol does not report them
+NodeRecord = namedtuple("NodeRecord", ["name", "gres", "cfg_tres", "alloc_tres", "cpu_alloc", "cpu_tot", "partitions", "real_memory", "alloc_mem"],
+                        defaults=("0", "0"))
+
+# allocation of one job, the per node values assume the job is spread evenly (--nodes with --gres / --cpus-per-gpu per node)
+JobAllocation = namedtuple("JobAllocation", ["job_id", "nodes", "gpus_per_node", "cpus_per_node", "mem_per_node"])
+MEMORY_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024} # -> MB
+
+# split before every "Key=" token, values like OS=Linux 5.15.0 #1 SMP keep their spaces
+_FIELD_SPLIT = re.compile(r'\s+(?=[A-Za-z_]+=)')
+
+
+def parse_scontrol_nodes(output):
+    """
+    Parses `scontrol show node` output (one-line -o or multi-line) in a single pass
+    returns {node_name : NodeRecord}
+    """
+    records = {}
+    fields = None
+    for token in _FIELD_SPLIT.split(output.strip()):
+        key, sep, value = token.partition('=')
+        if not sep:
+            continue
+        if key == "NodeName":
+            if fields is not None:
+                records[fields["NodeName"]] = record_from_fields(fields)
+            fields = {}
+        if fields is not None:
+            fields[key] = value.strip()
+    if fields is not None:
+        records[fields["NodeName"]] = record_from_fields(fields)
+    return records
+
+
+def record_from_fields(fields):
+    return NodeRecord(
+        name=fields["NodeName"],
+        gres=fields.get("Gres", "(null)"),
+        cfg_tres=fields.get("CfgTRES", ""),
+        alloc_tres=fields.get("AllocTRES", ""),
+        cpu_alloc=fields.get("CPUAlloc", "0"),
+        cpu_tot=fields.get("CPUTot", "0"),
+        partitions=fields.get("Partitions", ""),
+        real_memory=fields.get("RealMemory", "0"),
+        alloc_mem=fields.get("AllocMem", "0"),
+    )
+
+
+def parse_scontrol_json(output):
+    """
+    Parses `scontrol show node --json` output into the same records as parse_scontrol_nodes
+    """
+    records = {}
+    for node in json.loads(output).get("nodes", []):
+        partitions = node.get("partitions") or []
+        records[node["name"]] = NodeRecord(
+            name=node["name"],
+            gres=node.get("gres") or "(null)",
+            cfg_tres=node.get("tres") or "",
+            alloc_tres=node.get("tres_used") or "",
+            cpu_alloc=str(node.get("alloc_cpus", 0)),
+            cpu_tot=str(node.get("cpus", 0)),
+            partitions=",".join(partitions) if isinstance(partitions, list) else partitions,
+            real_memory=str(node.get("real_memory", 0)),
+            alloc_mem=str(node.get("alloc_memory", 0)),
+        )
+    return records
+
+
+def query_node(node_name, timeout=None):
+    """
+    Queries a single node with `scontrol show node <name>`, returns NodeRecord or None
+    raises subprocess.TimeoutExpired if timeout (seconds) is given and exceeded
+    """
+    output = run_cached(["scontrol", "show", "node", node_name], timeout=timeout)
+    return parse_scontrol_nodes(output).get(node_name)
+
+
+def query_node_with_retry(node_name, timeout=10.0, retries=2, backoff=0.5):
+    """
+    query_node with a timeout and retries, waits backoff, 2*backoff, 4*backoff... between attempts
+    returns None if every attempt failed or timed out
+    """
+    for attempt in range(retries + 1):
+        try:
+            return query_node(node_name, timeout=timeout)
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
+            if attempt < retries:
+                time.sleep(backoff * (2 ** attempt))
+    return None
+
+
+def query_nodes(node_names, parallelism=8, timeout=10.0, retries=2, backoff=0.5):
+    """
+    Queries nodes one scontrol call each, at most parallelism calls at a time
+    returns {node_name : NodeRecord or None}, None means the node is unknown
+    """
+    node_names = list(dict.fromkeys(node_names)) # dedup, keep order
+    with ThreadPoolExecutor(max_workers=max(parallelism, 1)) as executor:
+        records = executor.map(lambda name: query_node_with_retry(name, timeout, retries, backoff), node_names)
+        return dict(zip(node_names, records))
+
+
+def parse_memory(value):
+    # "80G", "512M", "1024" -> MB
+    value = value.strip()
+    if value and value[-1].upper() in MEMORY_UNITS:
+        return int(float(value[:-1]) * MEMORY_UNITS[value[-1].upper()])
+    return int(float(value or 0))
+
+
+def parse_tres(tres):
+    # "cpu=20,mem=80G,node=2,gres/gpu=8" -> {"cpu" : "20", "mem" : "80G", ...}
+    return dict(item.split("=", 1) for item in tres.split(",") if "=" in item)
+
+
+def tres_gpus(tres):
+    # gres/gpu, else the sum of the typed gres/gpu:<type> counts
+    if "gres/gpu" in tres:
+        return int(tres["gres/gpu"])
+    return sum(int(count) for key, count in tres.items() if key.startswith("gres/gpu:"))
+
+
+def parse_scontrol_job(output):
+    """
+    JobAllocation of `scontrol show job <id>` output, None if the job holds no nodes (pending, ended)
+    """
+    fields = {}
+    for token in _FIELD_SPLIT.split(output.strip()):
+        key, sep, value = token.partition('=')
+        if sep:
+            fields.setdefault(key, value.strip())
+    node_list = fields.get("NodeList", "(null)")
+    if node_list in ("", "(null)"):
+        return None
+    nodes = list(hostlist.expand(node_list))
+    # newer releases print AllocTRES next to ReqTRES, older ones only TRES
+    tres = parse_tres(fields.get("AllocTRES") or fields.get("TRES", ""))
+    return JobAllocation(
+        job_id=fields.get("JobId"),
+        nodes=nodes,
+        gpus_per_node=tres_gpus(tres) // len(nodes),
+        cpus_per_node=int(tres.get("cpu", 0)) // len(nodes),
+        mem_per_node=parse_memory(tres.get("mem", "0")) // len(nodes),
+    )
+
+
+def query_job_allocation(job_id, timeout=None):
+    """
+    JobAllocation of a running job from `scontrol show job`, never cached, None if it is unknown or holds no nodes
+    """
+    try:
+        output = run_cached(["scontrol", "show", "job", str(job_id)], ttl=0, timeout=timeout, check=False, stderr=subprocess.DEVNULL)
+    except subprocess.TimeoutExpired:
+        return None
+    return parse_scontrol_job(output)
+
+
+def release_allocation(record, allocation):
+    """
+    record with the gpus, cpus and memory allocation holds on one node counted as free again
+    """
+    alloc_tres = []
+    for key, value in parse_tres(record.alloc_tres).items():
+        if key == "cpu":
+            value = str(max(int(value) - allocation.cpus_per_node, 0))
+        elif key == "mem":
+            value = f"{max(parse_memory(value) - allocation.mem_per_node, 0)}M"
+        elif key.startswith("gres/gpu"):
+            value = str(max(int(value) - allocation.gpus_per_node, 0))
+        alloc_tres.append(f"{key}={value}")
+    return record._replace(
+        alloc_tres=",".join(alloc_tres),
+        cpu_alloc=str(max(int(record.cpu_alloc) - allocation.cpus_per_node, 0)),
+        alloc_mem=str(max(int(record.alloc_mem or 0) - allocation.mem_per_node, 0)),
+    )
+
+
+class ClusterSnapshot:
+    """
+    Node records of the cluster, from a single scontrol call (from_scontrol) or per-node queries (from_nodes)
+    use_json uses `scontrol show node --json` where available and falls back to `scontrol show node -o`
+    """
+    def __init__(self, records, unknown=()):
+        self.records = records # {"<node>" : NodeRecord}
+        self.unknown = set(unknown) # nodes that could not be queried
+
+    @classmethod
+    def from_scontrol(cls, use_json=False):
+        if use_json:
+            try:
+                output = run_cached(["scontrol", "show", "node", "--json"], stderr=subprocess.DEVNULL)
+                return cls(parse_scontrol_json(output))
+            except (subprocess.CalledProcessError, ValueError):
+                pass # old slurm without --json
+        return cls(parse_scontrol_nodes(run_cached(["scontrol", "show", "node", "-o"])))
+
+    @classmethod
+    def from_nodes(cls, node_names, parallelism=8, timeout=10.0, retries=2, backoff=0.5):
+        """
+        Builds the snapshot from per-node queries, for sites where `scontrol show node -o` is not usable
+        nodes that timed out or failed are kept in unknown instead of aborting
+        """
+        results = query_nodes(node_names, parallelism, timeout, retries, backoff)
+        records = {name: record for name, record in results.items() if record is not None}
+        return cls(records, unknown=[name for name, record in results.items() if record is None])
+
+    def release(self, allocation):
+        # counts the allocation of a job that is about to end as free on its nodes
+        for name in allocation.nodes:
+            if self.records.get(name) is not None:
+                self.records[name] = release_allocation(self.records[name], allocation)
+
+    def is_unknown(self, node_name):
+        return node_name in self.unknown
+
+    def get(self, node_name):
+        return self.records.get(node_name)
+
+    def __contains__(self, node_name):
+        return node_name in self.records
+
+    def __len__(self):
+        return len(self.records)
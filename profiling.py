@@ -0,0 +1,117 @@
+"""
+Phase timings, subprocess counts / latencies and gauges of one auto_qos / auto_rerun process
+
+every scheduler command goes through run (or record_subprocess for the asyncio ones), phases are nested with phase()
+and recorded as "plan/sinfo" paths, gauges are set where the values are computed (idle gpus, wasted $/hour, ...)
+--profile prints summary(), --metrics_file writes everything with write_metrics:
+a .prom file is rewritten as a Prometheus textfile (node_exporter textfile collector), any other file gets a json line appended
+
+python auto_qos.py --profile
+python auto_rerun.py --watch --metrics_file /var/lib/node_exporter/auto_rerun.prom
+"""
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+import slurm_cache
+
+METRIC_PREFIX = "slurm_scripts_"
+PLAN_PHASE = "plan" # its seconds are exported as the planning latency
+
+phases = {} # "plan/sinfo" -> [count, seconds]
+subprocesses = {} # command -> [count, seconds, max seconds]
+gauges = {} # (name, ((label, value), ...)) -> value
+_stack = []
+
+def reset():
+    phases.clear()
+    subprocesses.clear()
+    gauges.clear()
+    del _stack[:]
+
+@contextmanager
+def phase(name):
+    """
+    Times the block as name, below the phases it is nested in
+    """
+    _stack.append(name)
+    path = "/".join(_stack)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = phases.setdefault(path, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+        _stack.pop()
+
+def record_subprocess(command, seconds):
+    entry = subprocesses.setdefault(command, [0, 0.0, 0.0])
+    entry[0] += 1
+    entry[1] += seconds
+    entry[2] = max(entry[2], seconds)
+
+def run(args, **kwargs):
+    """
+    subprocess.run that records the latency of args[0]
+    """
+    start = time.perf_counter()
+    try:
+        return subprocess.run(args, **kwargs)
+    finally:
+        record_subprocess(os.path.basename(args[0]), time.perf_counter() - start)
+
+def set_gauge(name, value, **labels):
+    gauges[(name, tuple(sorted(labels.items())))] = value
+
+def summary():
+    lines = [f"{'phase':40s} {'calls':>6s} {'seconds':>9s}"]
+    for path, (count, seconds) in phases.items():
+        lines.append(f"{path:40s} {count:6d} {seconds:9.3f}")
+    lines.append(f"{'subprocess':40s} {'calls':>6s} {'seconds':>9s} {'mean ms':>8s} {'max ms':>8s}")
+    for command, (count, seconds, longest) in sorted(subprocesses.items()):
+        lines.append(f"{command:40s} {count:6d} {seconds:9.3f} {seconds / count * 1000:8.1f} {longest * 1000:8.1f}")
+    return "\n".join(lines)
+
+def metrics():
+    """
+    [(name, {label : value}, value)] of the phases, subprocesses and gauges
+    """
+    samples = []
+    for path, (count, seconds) in phases.items():
+        samples.append(("phase_seconds", {"phase": path}, seconds))
+        if path == PLAN_PHASE:
+            samples.append(("planning_seconds", {}, seconds / count))
+    for command, (count, seconds, _) in sorted(subprocesses.items()):
+        samples.append(("subprocess_calls", {"command": command}, count))
+        samples.append(("subprocess_seconds", {"command": command}, seconds))
+    for (name, labels), value in gauges.items():
+        samples.append((name, dict(labels), value))
+    return samples
+
+def format_prometheus(samples):
+    # the text format wants the samples of a metric family together after its one TYPE line, the sort keeps their order
+    lines = []
+    family = None
+    for name, labels, value in sorted(samples, key=lambda sample: sample[0]):
+        if name != family:
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            family = name
+        label_text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"')) for key, label in labels.items())
+        lines.append(f"{METRIC_PREFIX}{name}{{{label_text}}} {value}" if label_text else f"{METRIC_PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def write_metrics(path, source):
+    """
+    Writes metrics() to path, source ("auto_qos", "auto_rerun") labels the samples
+    """
+    samples = [(name, dict(labels, source=source), value) for name, labels, value in metrics()]
+    if path.endswith(".prom"):
+        # the collector may read at any time, replace the file in one step, cron and --watch may write it at once
+        slurm_cache.atomic_write_text(path, format_prometheus(samples))
+        return
+    with open(path, "a") as f:
+        f.write(json.dumps({"time": time.time(), "source": source,
+                            "metrics": [{"name": name, "labels": labels, "value": value} for name, labels, value in samples]}) + "\n")
@@ -0,0 +1,157 @@
+"""
+Predicts how long a candidate allocation waits in the queue, so the planner can minimize wait + run time instead of maximizing gpus
+
+with jobs pending in the partition that the free gpus can not hold next to the candidate,
+it starts after them: the latest squeue --start estimate of those jobs is used,
+otherwise the median historical wait (sacct Start - Submit) of jobs of the same partition / qos / shape,
+then of the same partition / qos, then of the partition, then the prior hook, then 0
+the default prior is the hour-of-week capacity forecast of capacity_sampler when it has samples
+
+python queue_wait.py --target_steps 1000
+python queue_wait.py --partition suma_rtx3090 --target_steps 1000 --global_batch 96
+"""
+import argparse
+import datetime
+import statistics
+import time
+
+import auto_qos
+import capacity_sampler
+import profiling
+import slurm_cache
+import throughput
+
+OBJECTIVE = "time_to_result" # planner objective name used by auto_rerun
+HISTORY_DAYS = 7
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def parse_time(value):
+    # sacct / squeue time, None for Unknown, N/A, None, ...
+    try:
+        return datetime.datetime.strptime(value, TIME_FORMAT).timestamp()
+    except ValueError:
+        return None
+
+def gpus_of_tres(tres):
+    """
+    gres/gpu=8,... (sacct AllocTRES) or gres/gpu:4 / gpu:rtx3090:4 (squeue %b) -> gpus, 0 if there are none
+    """
+    for item in tres.split(","):
+        if item.startswith("gres/gpu=") or item.startswith("gres:gpu="):
+            return int(item.split("=")[1])
+        if "gpu" in item and item.split(":")[-1].isdigit():
+            return int(item.split(":")[-1])
+    return 0
+
+class QueueWaitPredictor:
+    def __init__(self, history_days=HISTORY_DAYS, prior=None, now=None):
+        self.history_days = history_days
+        self.prior = prior # (partition, qos, nodes, gpus per node) -> seconds or None, used without history
+        self.now = now or time.time()
+        self.pending = [] # [(partition, qos, gpus, start estimate)]
+        self.waits = {} # (partition, qos, nodes, gpus per node) -> [seconds]
+
+    def load(self):
+        """
+        One squeue --start and one sacct call
+        """
+        with profiling.phase("queue_history"):
+            output = slurm_cache.run_cached(["squeue", "--start", "-h", "-o", "%i|%P|%q|%D|%b|%S"], check=False)
+            for line in output.splitlines():
+                parts = line.split("|")
+                if len(parts) < 6 or not parts[3].isdigit():
+                    continue
+                _, partition, qos, nodes, tres_per_node, start = parts
+                self.pending.append((partition, qos, int(nodes) * gpus_of_tres(tres_per_node), parse_time(start)))
+            output = slurm_cache.run_cached(["sacct", "-n", "-X", "-P", "--allusers", "-S", f"now-{self.history_days}days",
+                                             "-o", "Partition,QOS,NNodes,AllocTRES,Submit,Start"], check=False)
+            for line in output.splitlines():
+                parts = line.split("|")
+                if len(parts) < 6 or not parts[2].isdigit():
+                    continue
+                partition, qos, nodes, alloc_tres, submit, start = parts
+                submit, start = parse_time(submit), parse_time(start)
+                nodes = int(nodes)
+                if submit is None or start is None or nodes == 0:
+                    continue
+                key = (partition, qos, nodes, gpus_of_tres(alloc_tres) // nodes)
+                self.waits.setdefault(key, []).append(max(start - submit, 0))
+        return self
+
+    def historical_wait(self, partition, qos, nodes, gpus_per_node):
+        for match in [
+            lambda key: key == (partition, qos, nodes, gpus_per_node),
+            lambda key: key[:2] == (partition, qos),
+            lambda key: key[0] == partition,
+        ]:
+            waits = [wait for key, values in self.waits.items() if match(key) for wait in values]
+            if waits:
+                return statistics.median(waits)
+        if self.prior is not None:
+            return self.prior(partition, qos, nodes, gpus_per_node)
+        return None
+
+    def current_wait(self, plan, free_gpus):
+        """
+        Seconds until the jobs pending ahead in the partition have started, None if the candidate fits next to them
+        """
+        ahead = [(gpus, start) for partition, qos, gpus, start in self.pending if partition == plan.partition]
+        if not ahead or free_gpus - sum(gpus for gpus, _ in ahead) >= plan.total_gpus:
+            return None
+        starts = [start for _, start in ahead if start is not None]
+        return max(max(starts) - self.now, 0) if starts else None
+
+    def expected_wait(self, plan, free_gpus):
+        wait = self.current_wait(plan, free_gpus)
+        if wait is None:
+            wait = self.historical_wait(plan.partition, plan.qos, plan.nodes, plan.gpus_per_node)
+        return wait or 0.0
+
+def run_seconds(plan, target_steps, global_batch):
+    # the remaining samples at the predicted samples per second of the plan
+    return target_steps * global_batch / plan.samples_per_second if plan.samples_per_second else float("inf")
+
+def rank_by_time_to_result(plans, report, predictor, target_steps, global_batch):
+    """
+    Plans best first by expected wait + run time of target_steps steps of global_batch samples, score is that time in seconds
+    """
+    ranked = []
+    for plan in plans:
+        seconds = predictor.expected_wait(plan, report["empty_gpus"].get(plan.partition, 0)) + run_seconds(plan, target_steps, global_batch)
+        ranked.append(plan._replace(score=seconds))
+    return sorted(ranked, key=lambda plan: (plan.score, -plan.total_gpus))
+
+def best_plans(max_tres=auto_qos.max_tres, partition_name=auto_qos.AUTO_PARTITION, count=1, target_steps=1, global_batch=None,
+               cpu_min=5, partition_csv=None, model=None, predictor=None, mem_per_gpu=None, **report_kwargs):
+    """
+    The count candidates with the smallest expected wait + run time, of partition_name or of every partition for "auto"
+    without global_batch (elastic mode) a step is the batch of a full max_tres allocation, so a smaller shape needs longer
+    """
+    report = auto_qos.collect_cluster_report(partition_csv or auto_qos.PARTITION_CSV, **report_kwargs)
+    model = model or throughput.ThroughputModel.load()
+    plans = auto_qos.candidate_plans(report, max_tres, cpu_min, model, mem_per_gpu)
+    if partition_name != auto_qos.AUTO_PARTITION:
+        exact = [plan for plan in plans if plan.partition == partition_name]
+        plans = exact or [plan for plan in plans if partition_name in plan.partition]
+    predictor = predictor or QueueWaitPredictor(prior=capacity_sampler.wait_prior()).load()
+    global_batch = global_batch or model.per_gpu_batch * max_tres
+    return rank_by_time_to_result(plans, report, predictor, target_steps, global_batch)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank candidate allocations by expected queue wait + run time")
+    parser.add_argument("--partition", type=str, default=auto_qos.AUTO_PARTITION)
+    parser.add_argument("--max_tres", type=int, default=auto_qos.max_tres)
+    parser.add_argument("--target_steps", type=int, default=1, help="Remaining steps of the run")
+    parser.add_argument("--global_batch", type=int, default=None, help="Samples per step, default is the per-gpu batch of the throughput model x max_tres")
+    parser.add_argument("--history_days", type=int, default=HISTORY_DAYS)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--capacity_dir", type=str, default=capacity_sampler.CAPACITY_DIR, help="Samples of capacity_sampler.py used when there is no wait history")
+    args = parser.parse_args()
+    predictor = QueueWaitPredictor(args.history_days, prior=capacity_sampler.wait_prior(args.capacity_dir)).load()
+    plans = best_plans(args.max_tres, args.partition, args.top, args.target_steps, args.global_batch, predictor=predictor)
+    for plan in plans:
+        print(f"{plan.partition} {plan.nodes}x{plan.gpus_per_node} (qos {plan.qos}): {plan.score / 3600:.2f}h to result, "
+              f"{plan.samples_per_second:.2f} samples/s")
+
+if __name__ == "__main__":
+    main()
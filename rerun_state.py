@@ -0,0 +1,184 @@
+"""
+sqlite state of auto_rerun campaigns, so one process (cron or --watch) can manage many campaigns safely
+
+campaigns hold the bash / config files, options and the latest job id (constant time lookup),
+jobs hold the submission history with timestamps and outcomes,
+submissions are claimed with a compare-and-set on the campaign version so overlapping runs can not double-submit,
+competitors hold the jobs submitted for the same rerun on different allocations until one of them starts
+"""
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+STATE_DB = os.environ.get("AUTO_RERUN_STATE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "auto_rerun_state.db"))
+CLAIM_TIMEOUT = 600 # seconds before a claim of a crashed process can be taken over
+
+Campaign = namedtuple("Campaign", ["name", "workdir", "bash_file", "config_file", "active", "options", "latest_job_id", "version", "submitting_since"])
+Job = namedtuple("Job", ["campaign", "job_id", "submitted_at", "ended_at", "outcome"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    name TEXT PRIMARY KEY,
+    workdir TEXT NOT NULL,
+    bash_file TEXT NOT NULL,
+    config_file TEXT NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1,
+    options TEXT NOT NULL DEFAULT '{}',
+    latest_job_id TEXT,
+    version INTEGER NOT NULL DEFAULT 0,
+    submitting_since REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    campaign TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    submitted_at REAL NOT NULL,
+    ended_at REAL,
+    outcome TEXT,
+    PRIMARY KEY (campaign, job_id)
+);
+CREATE TABLE IF NOT EXISTS competitors (
+    campaign TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    preference INTEGER NOT NULL,
+    PRIMARY KEY (campaign, job_id)
+);
+"""
+
+class StateStore:
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        # autocommit, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        # takes the write lock up front, concurrent writers wait (up to timeout) instead of failing half way
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _campaign(row):
+        if row is None:
+            return None
+        name, workdir, bash_file, config_file, active, options, latest_job_id, version, submitting_since = row
+        return Campaign(name, workdir, bash_file, config_file, bool(active), json.loads(options), latest_job_id, version, submitting_since)
+
+    def upsert_campaign(self, name, workdir, bash_file, config_file, active=True, options=None):
+        """
+        Creates or updates a campaign, options are merged into the existing ones
+        """
+        with self.transaction() as connection:
+            existing = self._campaign(connection.execute("SELECT * FROM campaigns WHERE name = ?", (name,)).fetchone())
+            merged = dict(existing.options if existing else {}, **(options or {}))
+            if existing is None:
+                connection.execute("INSERT INTO campaigns (name, workdir, bash_file, config_file, active, options) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (name, workdir, bash_file, config_file, int(active), json.dumps(merged)))
+            else:
+                connection.execute("UPDATE campaigns SET workdir = ?, bash_file = ?, config_file = ?, active = ?, options = ?, version = version + 1 WHERE name = ?",
+                                   (workdir, bash_file, config_file, int(active), json.dumps(merged), name))
+
+    def set_active(self, name, active):
+        with self.transaction() as connection:
+            connection.execute("UPDATE campaigns SET active = ?, version = version + 1 WHERE name = ?", (int(active), name))
+
+    def get_campaign(self, name):
+        return self._campaign(self.connection.execute("SELECT * FROM campaigns WHERE name = ?", (name,)).fetchone())
+
+    def list_campaigns(self, active_only=True):
+        query = "SELECT * FROM campaigns" + (" WHERE active = 1" if active_only else "") + " ORDER BY name"
+        return [self._campaign(row) for row in self.connection.execute(query).fetchall()]
+
+    def get_job(self, campaign, job_id):
+        row = self.connection.execute("SELECT * FROM jobs WHERE campaign = ? AND job_id = ?", (campaign, job_id)).fetchone()
+        return Job(*row) if row else None
+
+    def history(self, campaign):
+        return [Job(*row) for row in self.connection.execute("SELECT * FROM jobs WHERE campaign = ? ORDER BY submitted_at", (campaign,)).fetchall()]
+
+    def claim_submission(self, name, expected_version):
+        """
+        Compare-and-set: marks the campaign as submitting if nobody changed it since expected_version
+        returns False if another process got there first
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE campaigns SET version = version + 1, submitting_since = ? "
+                "WHERE name = ? AND version = ? AND (submitting_since IS NULL OR submitting_since < ?)",
+                (now, name, expected_version, now - CLAIM_TIMEOUT))
+            return cursor.rowcount == 1
+
+    def release_submission(self, name):
+        # the claimed submission failed, let the next run try again
+        with self.transaction() as connection:
+            connection.execute("UPDATE campaigns SET submitting_since = NULL, version = version + 1 WHERE name = ?", (name,))
+
+    def record_submission(self, name, job_id, submitted_at=None):
+        """
+        Adds job_id to the history and makes it the latest job, ends a claim
+        """
+        if not job_id:
+            raise ValueError(f"Empty job id for campaign {name}")
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO jobs (campaign, job_id, submitted_at) VALUES (?, ?, ?)",
+                               (name, job_id, submitted_at or time.time()))
+            connection.execute("UPDATE campaigns SET latest_job_id = ?, submitting_since = NULL, version = version + 1 WHERE name = ?",
+                               (job_id, name))
+
+    def record_outcome(self, name, job_id, outcome, ended_at=None):
+        with self.transaction() as connection:
+            connection.execute("UPDATE jobs SET outcome = ?, ended_at = ? WHERE campaign = ? AND job_id = ?",
+                               (outcome, ended_at or time.time(), name, job_id))
+
+    def set_latest_job(self, name, job_id):
+        with self.transaction() as connection:
+            connection.execute("UPDATE campaigns SET latest_job_id = ?, version = version + 1 WHERE name = ?", (job_id, name))
+
+    def add_competitors(self, name, job_ids):
+        """
+        job_ids were submitted for the same rerun, most preferred first
+        """
+        with self.transaction() as connection:
+            connection.executemany("INSERT OR REPLACE INTO competitors (campaign, job_id, preference) VALUES (?, ?, ?)",
+                                   [(name, job_id, i) for i, job_id in enumerate(job_ids)])
+
+    def competitors(self, name):
+        return [row[0] for row in self.connection.execute("SELECT job_id FROM competitors WHERE campaign = ? ORDER BY preference", (name,)).fetchall()]
+
+    def clear_competitors(self, name):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM competitors WHERE campaign = ?", (name,))
+
+    def import_legacy(self, name, workdir):
+        """
+        Imports auto_rerun_infos.json / auto_rerun.txt of workdir, returns the campaign or None if there is nothing to import
+        """
+        infos_path = os.path.join(workdir, "auto_rerun_infos.json")
+        if not os.path.exists(infos_path):
+            return None
+        with open(infos_path, "r") as f:
+            infos = json.load(f)
+        self.upsert_campaign(name, workdir, infos["bash_file"], infos["config_file"], infos.get("active", True))
+        job_ids = [infos["job_id"]] if infos.get("job_id") else []
+        txt_path = os.path.join(workdir, "auto_rerun.txt")
+        if os.path.exists(txt_path):
+            with open(txt_path, "r") as f:
+                job_ids += [line.strip() for line in f if line.strip()]
+        submitted_at = os.path.getmtime(txt_path) if os.path.exists(txt_path) else time.time()
+        for i, job_id in enumerate(dict.fromkeys(job_ids)):
+            # keep the file order, the last line is the latest job
+            self.record_submission(name, job_id, submitted_at + i * 1e-3)
+        return self.get_campaign(name)
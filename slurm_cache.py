@@ -0,0 +1,177 @@
+"""
+Local TTL cache of read-only scheduler commands (sinfo, scontrol, squeue) shared between processes
+
+entries are written to a temp file and os.replace'd, so readers never see a partial entry
+a per-entry flock makes concurrent misses wait for the first caller instead of all asking slurmctld
+set SLURM_CACHE_DIR to a shared directory to share the cache between users, entries and lock files are created
+readable by every user (as the umask allows), a cache directory this user can not use falls back to running the command
+
+python slurm_cache.py --stats
+python slurm_cache.py --clear
+"""
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+
+import profiling
+
+CACHE_DIR = os.environ.get("SLURM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "slurm_scripts"))
+cache_ttl = float(os.environ.get("SLURM_CACHE_TTL", 10)) # seconds, 0 disables the cache
+refresh = False # bypass cached entries, fresh results are still written back
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+warned = False # the unusable cache directory is reported once per process
+
+def configure(ttl=None, refresh_cache=None, cache_dir=None):
+    """
+    Sets the cache options for this process, used by the --cache_ttl / --refresh flags
+    """
+    global cache_ttl, refresh, CACHE_DIR
+    if ttl is not None:
+        cache_ttl = ttl
+    if refresh_cache is not None:
+        refresh = refresh_cache
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+
+def cache_key(args):
+    return hashlib.sha1(json.dumps(list(args)).encode('utf-8')).hexdigest()
+
+@contextmanager
+def locked(path):
+    # flock does not need write access, so a lock file created by another user of a shared directory can be opened read-only
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+def atomic_write_text(path, text):
+    # through a unique temp file in the same directory, concurrent writers of path can not take each other's temp file
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        # mkstemp creates 0600, other users of a shared directory have to read it
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def atomic_write_json(path, data, indent=None):
+    atomic_write_text(path, json.dumps(data, indent=indent))
+
+def read_entry(path, ttl):
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["created"] > ttl:
+        return None
+    return entry
+
+def record_stat(command, hit):
+    try:
+        update_stats(command, hit)
+    except OSError:
+        # the stats of a shared cache are best effort
+        pass
+
+def update_stats(command, hit):
+    stats_path = os.path.join(CACHE_DIR, "stats.json")
+    with locked(stats_path + ".lock"):
+        try:
+            with open(stats_path, "r") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {"hits": 0, "misses": 0, "commands": {}}
+        key = "hits" if hit else "misses"
+        stats[key] += 1
+        per_command = stats["commands"].setdefault(command, {"hits": 0, "misses": 0})
+        per_command[key] += 1
+        atomic_write_json(stats_path, stats)
+
+def get_stats():
+    try:
+        with open(os.path.join(CACHE_DIR, "stats.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"hits": 0, "misses": 0, "commands": {}}
+
+def run_uncached(args, timeout=None, check=True, stderr=None):
+    result = profiling.run(args, stdout=subprocess.PIPE, stderr=stderr, check=check, timeout=timeout)
+    return result.stdout.decode('utf-8'), result.returncode
+
+def cache_unusable(error):
+    global warned
+    if not warned:
+        print(f"The slurm cache {CACHE_DIR} is not usable ({error}), running the commands uncached")
+        warned = True
+
+def run_cached(args, ttl=None, timeout=None, check=True, stderr=None):
+    """
+    Runs args and returns stdout as str, served from the cache if an entry younger than ttl seconds exists
+    non-zero exits raise CalledProcessError if check, and are never cached
+    a cache directory that can not be created, locked or written (another user's shared cache) runs args uncached
+    """
+    ttl = cache_ttl if ttl is None else ttl
+    if ttl <= 0:
+        return run_uncached(args, timeout, check, stderr)[0]
+    path = os.path.join(CACHE_DIR, cache_key(args) + ".json")
+    if not refresh:
+        entry = read_entry(path, ttl)
+        if entry is not None:
+            record_stat(args[0], hit=True)
+            return entry["stdout"]
+    with ExitStack() as stack:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            stack.enter_context(locked(path + ".lock"))
+        except OSError as error:
+            cache_unusable(error)
+            return run_uncached(args, timeout, check, stderr)[0]
+        if not refresh:
+            # another process may have filled it while we waited for the lock
+            entry = read_entry(path, ttl)
+            if entry is not None:
+                record_stat(args[0], hit=True)
+                return entry["stdout"]
+        stdout, returncode = run_uncached(args, timeout, check, stderr)
+        if returncode == 0:
+            try:
+                atomic_write_json(path, {"args": list(args), "created": time.time(), "stdout": stdout})
+            except OSError as error:
+                cache_unusable(error)
+    record_stat(args[0], hit=False)
+    return stdout
+
+def clear():
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".json") and name != "stats.json":
+            os.remove(os.path.join(CACHE_DIR, name))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect the shared scheduler command cache")
+    parser.add_argument("--stats", action="store_true", help="Print cache hit / miss counts")
+    parser.add_argument("--clear", action="store_true", help="Remove every cached entry")
+    args = parser.parse_args()
+    if args.clear:
+        clear()
+    if args.stats or not args.clear:
+        print(json.dumps(get_stats(), indent=2))
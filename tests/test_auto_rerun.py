@@ -0,0 +1,78 @@
+import subprocess
+
+import pytest
+
+import auto_rerun
+from rerun_state import StateStore
+
+class FakeScheduler:
+    """
+    Stands in for profiling.run: squeue / sacct answer from states, a command in failing exits 1, scancel is recorded
+    """
+    def __init__(self, squeue=None, sacct=None, failing=()):
+        self.squeue = squeue or {}
+        self.sacct = sacct or {}
+        self.failing = set(failing)
+        self.cancelled = []
+
+    def __call__(self, args, **kwargs):
+        command = args[0]
+        if command == "scancel":
+            self.cancelled.extend(args[1:])
+            return subprocess.CompletedProcess(args, 0, b"", b"")
+        if command in self.failing:
+            return subprocess.CompletedProcess(args, 1, b"", b"")
+        job_ids = args[args.index("-j") + 1].split(",")
+        if command == "squeue":
+            lines = [f"{job_id} {self.squeue[job_id]}" for job_id in job_ids if job_id in self.squeue]
+        else:
+            lines = [f"{job_id}|{self.sacct[job_id]}" for job_id in job_ids if job_id in self.sacct]
+        return subprocess.CompletedProcess(args, 0, "".join(line + "\n" for line in lines).encode("utf-8"), b"")
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.upsert_campaign("c", str(tmp_path), "train.sh", "config.toml")
+    # the preferred job is recorded last and becomes the latest job
+    for job_id in ["1035", "1034", "1033"]:
+        store.record_submission("c", job_id)
+    store.add_competitors("c", ["1033", "1034", "1035"])
+    yield store
+    store.close()
+
+def resolve(store, monkeypatch, scheduler):
+    monkeypatch.setattr(auto_rerun.profiling, "run", scheduler)
+    return auto_rerun.resolve_competition(store, store.get_campaign("c"))
+
+def test_running_competitor_wins(store, monkeypatch):
+    scheduler = FakeScheduler(squeue={"1033": "PENDING", "1034": "RUNNING", "1035": "PENDING"})
+    assert resolve(store, monkeypatch, scheduler)
+    assert store.get_campaign("c").latest_job_id == "1034"
+    assert scheduler.cancelled == ["1033", "1035"]
+    assert store.competitors("c") == []
+
+def test_pending_competitors_are_kept(store, monkeypatch):
+    scheduler = FakeScheduler(squeue={"1033": "PENDING", "1034": "PENDING", "1035": "PENDING"})
+    assert not resolve(store, monkeypatch, scheduler)
+    assert store.competitors("c") == ["1033", "1034", "1035"]
+
+def test_failed_scheduler_keeps_the_competitors(store, monkeypatch):
+    scheduler = FakeScheduler(failing={"squeue", "sacct"})
+    assert not resolve(store, monkeypatch, scheduler)
+    assert scheduler.cancelled == []
+    assert store.competitors("c") == ["1033", "1034", "1035"]
+
+def test_competitors_that_left_the_queue(store, monkeypatch):
+    # the winner was preempted before a poll saw it run, squeue knows none of the ids and exits 1
+    scheduler = FakeScheduler(sacct={"1033": "PREEMPTED", "1034": "CANCELLED by 1000", "1035": "PREEMPTED"}, failing={"squeue"})
+    assert resolve(store, monkeypatch, scheduler)
+    assert store.get_campaign("c").latest_job_id == "1033"
+    assert scheduler.cancelled == []
+    assert store.competitors("c") == []
+
+def test_competitors_cancelled_before_starting(store, monkeypatch):
+    scheduler = FakeScheduler(sacct={"1033": "CANCELLED by 1000", "1034": "CANCELLED by 1000"}, failing={"squeue"})
+    assert resolve(store, monkeypatch, scheduler)
+    # 1035 was purged, the latest job is classified and rerun as usual
+    assert store.get_campaign("c").latest_job_id == "1033"
+    assert store.competitors("c") == []
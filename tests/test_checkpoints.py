@@ -0,0 +1,55 @@
+import json
+import struct
+
+import pytest
+
+from checkpoints import CheckpointIndex, default_sort_key, validate_safetensors
+
+def write_safetensors(path, tensor_bytes=8, cut=0):
+    header = json.dumps({"__metadata__": {"format": "pt"},
+                         "weight": {"dtype": "F32", "shape": [tensor_bytes // 4], "data_offsets": [0, tensor_bytes]}}).encode("utf-8")
+    data = struct.pack("<Q", len(header)) + header + b"\0" * tensor_bytes
+    path.write_bytes(data[:len(data) - cut])
+
+def test_default_sort_key():
+    names = [
+        "08151230_delta_lokr_bs48_multinode_l2.safetensors",
+        "08151230_delta_lokr_bs48_multinode_l2-step00001000.safetensors",
+        "step.safetensors",
+        "08161000_delta_lokr_bs48_multinode_l2-000010.safetensors",
+        "08151230_delta_lokr_bs48_multinode_l2-step00000500.safetensors",
+    ]
+    assert sorted(names, key=default_sort_key) == [
+        "step.safetensors",
+        "08151230_delta_lokr_bs48_multinode_l2-step00000500.safetensors",
+        "08151230_delta_lokr_bs48_multinode_l2-step00001000.safetensors",
+        "08151230_delta_lokr_bs48_multinode_l2.safetensors",
+        "08161000_delta_lokr_bs48_multinode_l2-000010.safetensors",
+    ]
+
+def test_validate_safetensors(tmp_path):
+    write_safetensors(tmp_path / "ok.safetensors")
+    assert validate_safetensors(str(tmp_path / "ok.safetensors"))
+
+@pytest.mark.parametrize("content", [
+    b"",
+    b"\0" * 7,
+    struct.pack("<Q", 1000) + b"{}",
+    struct.pack("<Q", 4) + b"nope",
+])
+def test_validate_safetensors_rejects_broken_files(tmp_path, content):
+    (tmp_path / "bad.safetensors").write_bytes(content)
+    assert not validate_safetensors(str(tmp_path / "bad.safetensors"))
+
+def test_validate_safetensors_rejects_truncated_files(tmp_path):
+    # a checkpoint cut short by preemption
+    write_safetensors(tmp_path / "cut.safetensors", cut=3)
+    assert not validate_safetensors(str(tmp_path / "cut.safetensors"))
+
+def test_newest_skips_truncated_checkpoints(tmp_path):
+    write_safetensors(tmp_path / "step.safetensors")
+    write_safetensors(tmp_path / "08151230_run-step00000500.safetensors")
+    write_safetensors(tmp_path / "08151230_run-step00001000.safetensors", cut=3)
+    index = CheckpointIndex(str(tmp_path))
+    assert index.newest() == "08151230_run-step00000500.safetensors"
+    assert index.invalid_newer_than(index.newest()) == ["08151230_run-step00001000.safetensors"]
@@ -0,0 +1,27 @@
+import pytest
+
+import elastic
+
+@pytest.mark.parametrize("world_size, per_gpu_batch, accumulation_steps", [
+    (8, 12, 1),
+    (1, 12, 8),
+    (3, 8, 4),
+    (7, 7, 2),
+    (5, 10, 2),
+    (36, 3, 1),
+])
+def test_plan_batch(world_size, per_gpu_batch, accumulation_steps):
+    plan = elastic.plan_batch(96, world_size, 12)
+    assert (plan.per_gpu_batch, plan.accumulation_steps) == (per_gpu_batch, accumulation_steps)
+    assert plan.global_batch == world_size * per_gpu_batch * accumulation_steps
+
+@pytest.mark.parametrize("world_size", [1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 96])
+def test_plan_batch_keeps_the_target_when_it_can(world_size):
+    assert elastic.plan_batch(96, world_size, 12).global_batch == 96
+
+@pytest.mark.parametrize("world_size", [5, 7, 9, 11, 13, 14, 15, 21, 22, 30])
+def test_plan_batch_world_sizes_that_do_not_divide_the_target(world_size):
+    plan = elastic.plan_batch(96, world_size, 12)
+    # never micro-batch 1 with many accumulation steps
+    assert plan.per_gpu_batch > 1
+    assert abs(plan.global_batch - 96) <= elastic.BATCH_TOLERANCE * 96
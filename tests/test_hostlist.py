@@ -0,0 +1,31 @@
+import random
+
+import pytest
+
+import hostlist
+
+@pytest.mark.parametrize("expression, names", [
+    ("node01", ["node01"]),
+    ("node[01,03-05,07]", ["node01", "node03", "node04", "node05", "node07"]),
+    ("anode[01-02],bnode[01-02]", ["anode01", "anode02", "bnode01", "bnode02"]),
+    ("rack[1-2]-gpu[01-02]", ["rack1-gpu01", "rack1-gpu02", "rack2-gpu01", "rack2-gpu02"]),
+])
+def test_expand(expression, names):
+    assert list(hostlist.expand(expression)) == names
+    assert hostlist.count(expression) == len(names)
+    assert all(hostlist.contains(expression, name) for name in names)
+
+def test_contains_keeps_the_zero_padding():
+    assert hostlist.contains("node[01-10]", "node07")
+    assert not hostlist.contains("node[01-10]", "node7")
+    assert not hostlist.contains("node[01-10]", "node11")
+
+def test_compress():
+    assert hostlist.compress(["node01", "node02", "node03", "node05"]) == "node[01-03,05]"
+    assert hostlist.compress(["rack1-gpu01", "rack1-gpu02", "rack2-gpu01", "rack2-gpu02"]) == "rack[1-2]-gpu[01-02]"
+
+def test_compress_round_trip():
+    rng = random.Random(0)
+    for _ in range(100):
+        names = sorted({f"{rng.choice(['a100-suma', 'node', 'rack1-gpu'])}{rng.randint(1, 40):04d}" for _ in range(rng.randint(1, 30))})
+        assert sorted(hostlist.expand(hostlist.compress(names))) == names
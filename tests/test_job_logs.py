@@ -0,0 +1,58 @@
+import pytest
+
+import job_logs
+from job_logs import JobLogClassifier
+
+BASH_FILE = """#!/bin/bash
+#SBATCH --job-name=big_train
+#SBATCH --output=multinode-o-%x.%j
+#SBATCH --error=multinode-e-%x.%j
+srun python train.py
+"""
+
+@pytest.fixture
+def classifier(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "train.sh").write_text(BASH_FILE)
+    return JobLogClassifier("train.sh", state_file=str(tmp_path / "offsets.json"), tail_bytes=4096, chunk_bytes=64)
+
+def write_log(tmp_path, job_id, text, stream="o"):
+    with open(tmp_path / f"multinode-{stream}-big_train.{job_id}", "a") as f:
+        f.write(text)
+
+@pytest.mark.parametrize("text, outcome", [
+    ("step 10\nslurmstepd: error: *** JOB 7 ON node01 CANCELLED AT 2024-08-15T12:30:00 DUE TO PREEMPTION ***\n", "preempted"),
+    ("slurmstepd: error: *** JOB 7 ON node01 CANCELLED AT 2024-08-15T12:30:00 DUE TO NODE FAILURE ***\n", "node_failure"),
+    ("[E ProcessGroupNCCL.cpp] Watchdog caught collective operation timeout: WorkNCCL(SeqNum=1)\n", "nccl_timeout"),
+    ("torch.cuda.OutOfMemoryError: CUDA out of memory. Tried to allocate 2.00 GiB\n", "oom"),
+    ("Traceback (most recent call last):\nValueError: bad config\n", "unknown"),
+])
+def test_classify_from_logs(classifier, tmp_path, text, outcome):
+    write_log(tmp_path, "7", "x" * 5000 + text, stream="e")
+    assert classifier.classify("7", use_sacct=False).outcome == outcome
+
+def test_preemption_wins_over_the_oom_it_caused(classifier, tmp_path):
+    write_log(tmp_path, "7", "CUDA out of memory\n")
+    write_log(tmp_path, "7", "*** JOB 7 CANCELLED DUE TO PREEMPTION ***\n", stream="e")
+    assert classifier.classify("7", use_sacct=False).outcome == "preempted"
+
+def test_later_reads_only_see_new_bytes(classifier, tmp_path):
+    write_log(tmp_path, "7", "step 1\n" * 1000)
+    assert classifier.classify("7", use_sacct=False).outcome == "unknown"
+    write_log(tmp_path, "7", "*** JOB 7 CANCELLED DUE TO PREEMPTION ***\n")
+    assert classifier.classify("7", use_sacct=False).outcome == "preempted"
+    # the offsets are kept, a new classifier starts where the last one stopped
+    again = JobLogClassifier("train.sh", state_file=classifier.state_file)
+    assert again.classify("7", use_sacct=False).outcome == "preempted"
+
+@pytest.mark.parametrize("sacct_state, outcome", [
+    ("PREEMPTED", "preempted"),
+    ("OUT_OF_MEMORY", "oom"),
+    ("TIMEOUT", "timeout"),
+    ("FAILED", "failed"),
+])
+def test_sacct_state(classifier, tmp_path, monkeypatch, sacct_state, outcome):
+    monkeypatch.setattr(job_logs.slurm_cache, "run_cached", lambda args, **kwargs: sacct_state + "\n")
+    write_log(tmp_path, "7", "step 10\n")
+    result = classifier.classify("7")
+    assert (result.outcome, result.sacct_state) == (outcome, sacct_state)
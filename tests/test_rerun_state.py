@@ -0,0 +1,38 @@
+import pytest
+
+from rerun_state import StateStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.upsert_campaign("c", str(tmp_path), "train.sh", "config.toml")
+    store.record_submission("c", "1000")
+    yield store
+    store.close()
+
+def test_claim_is_compare_and_set(store, tmp_path):
+    other = StateStore(store.path)
+    version = store.get_campaign("c").version
+    assert store.claim_submission("c", version)
+    # a second process that read the same version loses, so the campaign is submitted once
+    assert not other.claim_submission("c", version)
+    assert not other.claim_submission("c", other.get_campaign("c").version)
+    other.close()
+
+def test_submission_ends_the_claim(store):
+    assert store.claim_submission("c", store.get_campaign("c").version)
+    store.record_submission("c", "1001")
+    campaign = store.get_campaign("c")
+    assert campaign.latest_job_id == "1001"
+    assert campaign.submitting_since is None
+    assert store.claim_submission("c", campaign.version)
+
+def test_released_claim_can_be_taken_again(store):
+    assert store.claim_submission("c", store.get_campaign("c").version)
+    store.release_submission("c")
+    assert store.claim_submission("c", store.get_campaign("c").version)
+
+def test_empty_job_id_is_rejected(store):
+    with pytest.raises(ValueError):
+        store.record_submission("c", "")
+    assert store.get_campaign("c").latest_job_id == "1000"
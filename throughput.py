@@ -0,0 +1,241 @@
+"""
+Step throughput model of (nodes x gpus per node) shapes, the planner picks the shape with the best predicted samples per second
+
+step seconds = compute[gpu type] + intra * 2(g-1)/g + inter * 2(m-1)/m + latency * 2(mg-1)
+for m nodes with g gpus each: per-gpu compute, then a hierarchical ring allreduce of the gradients,
+intra / inter are the seconds to move the gradients once over a node's local / network links
+(Ethernet only with NCCL_P2P_DISABLE=1 makes inter large), latency is paid on every ring step
+
+the coefficients are linear, so they are calibrated from step times of past jobs with a least squares fit,
+regularized towards the current values so a few jobs on one shape do not throw the rest off
+
+python throughput.py --calibrate --campaign default
+python throughput.py --calibrate --bash_file train.sh --job_ids 660060 660061
+python throughput.py --predict --gpu_type rtx3090 --shapes 2x4 6x2
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+
+import slurm_cache
+
+MODEL_FILE = os.environ.get("THROUGHPUT_MODEL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "throughput_model.json"))
+# samples per second of one gpu, prior for the compute term
+GPU_SPEED = {"a100": 6.0, "rtx4090": 4.5, "a6000": 3.0, "rtx3090": 2.5}
+DEFAULT_GPU_SPEED = 2.5
+PER_GPU_BATCH = 12
+GRADIENT_BYTES = 400 * 1024 * 1024
+INTRA_BANDWIDTH = 8e9 # bytes/s over PCIe through the host without P2P
+INTER_BANDWIDTH = 1.25e9 # bytes/s, 10GbE
+LATENCY = 1e-3 # seconds per ring step, all buckets
+STEP_TIME_PATTERN = re.compile(rb'(\d+(?:\.\d+)?)(s/it|it/s)')
+
+def gpu_type_of(gres, partition=""):
+    """
+    gpu:rtx3090:8(S:0-1) -> rtx3090, the known type in the partition name when the gres has no type
+    """
+    parts = gres.split("(")[0].split(":") if gres else []
+    if len(parts) >= 3:
+        return parts[1]
+    for name in GPU_SPEED:
+        if name.replace("rtx", "") in partition:
+            return name
+    return None
+
+def ring_terms(nodes, gpus_per_node):
+    # (intra, inter, latency) factors of the allreduce cost
+    world_size = nodes * gpus_per_node
+    return (2 * (gpus_per_node - 1) / gpus_per_node if gpus_per_node else 0.0,
+            2 * (nodes - 1) / nodes if nodes else 0.0,
+            2 * (world_size - 1))
+
+class ThroughputModel:
+    def __init__(self, compute=None, intra=None, inter=None, latency=LATENCY, per_gpu_batch=PER_GPU_BATCH):
+        self.per_gpu_batch = per_gpu_batch
+        # seconds of forward / backward per step for each gpu type
+        self.compute = compute if compute is not None else {name: per_gpu_batch / speed for name, speed in GPU_SPEED.items()}
+        self.intra = intra if intra is not None else GRADIENT_BYTES / INTRA_BANDWIDTH
+        self.inter = inter if inter is not None else GRADIENT_BYTES / INTER_BANDWIDTH
+        self.latency = latency
+
+    @classmethod
+    def from_hardware(cls, gpu_speed=None, gradient_bytes=GRADIENT_BYTES, intra_bandwidth=INTRA_BANDWIDTH, inter_bandwidth=INTER_BANDWIDTH,
+                      latency=LATENCY, per_gpu_batch=PER_GPU_BATCH):
+        speeds = gpu_speed or GPU_SPEED
+        return cls({name: per_gpu_batch / speed for name, speed in speeds.items()},
+                   gradient_bytes / intra_bandwidth, gradient_bytes / inter_bandwidth, latency, per_gpu_batch)
+
+    @classmethod
+    def load(cls, path=MODEL_FILE):
+        """
+        The calibrated model in path, the default (uncalibrated) model if there is none
+        """
+        try:
+            with open(path, "r") as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self, path=MODEL_FILE):
+        slurm_cache.atomic_write_json(path, {"compute": self.compute, "intra": self.intra, "inter": self.inter, "latency": self.latency,
+                                             "per_gpu_batch": self.per_gpu_batch}, indent=4)
+
+    def compute_seconds(self, gpu_type):
+        return self.compute.get(gpu_type, self.per_gpu_batch / DEFAULT_GPU_SPEED)
+
+    def step_seconds(self, gpu_type, nodes, gpus_per_node):
+        intra, inter, latency = ring_terms(nodes, gpus_per_node)
+        return self.compute_seconds(gpu_type) + self.intra * intra + self.inter * inter + self.latency * latency
+
+    def samples_per_second(self, gpu_type, nodes, gpus_per_node):
+        if nodes <= 0 or gpus_per_node <= 0:
+            return 0.0
+        return nodes * gpus_per_node * self.per_gpu_batch / self.step_seconds(gpu_type, nodes, gpus_per_node)
+
+    def calibrate(self, observations, regularization=0.1):
+        """
+        observations are [(gpu type, nodes, gpus per node, step seconds)]
+        fits the compute seconds of the observed types and the intra / inter / latency coefficients,
+        each pulled towards its current value relative to its size
+        """
+        types = sorted({gpu_type for gpu_type, _, _, _ in observations})
+        names = [("compute", gpu_type) for gpu_type in types] + [("intra", None), ("inter", None), ("latency", None)]
+        prior = [self.compute_seconds(gpu_type) for gpu_type in types] + [self.intra, self.inter, self.latency]
+        size = len(names)
+        # normal equations (A^T A + r D) x = A^T b + r D x0, D = diag(1 / x0^2)
+        matrix = [[0.0] * size for _ in range(size)]
+        vector = [0.0] * size
+        for gpu_type, nodes, gpus_per_node, seconds in observations:
+            row = [1.0 if gpu_type == t else 0.0 for t in types] + list(ring_terms(nodes, gpus_per_node))
+            for i in range(size):
+                vector[i] += row[i] * seconds
+                for j in range(size):
+                    matrix[i][j] += row[i] * row[j]
+        for i in range(size):
+            weight = regularization / max(prior[i], 1e-9) ** 2
+            matrix[i][i] += weight
+            vector[i] += weight * prior[i]
+        solution = [max(value, 0.0) for value in solve(matrix, vector)]
+        for (kind, gpu_type), value in zip(names, solution):
+            if kind == "compute":
+                self.compute[gpu_type] = value
+            else:
+                setattr(self, kind, value)
+        return self
+
+def solve(matrix, vector):
+    # gaussian elimination with partial pivoting, the systems are a handful of unknowns
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(rows[r][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        if abs(rows[column][column]) < 1e-15:
+            continue
+        for r in range(column + 1, size):
+            factor = rows[r][column] / rows[column][column]
+            for c in range(column, size + 1):
+                rows[r][c] -= factor * rows[column][c]
+    solution = [0.0] * size
+    for r in reversed(range(size)):
+        if abs(rows[r][r]) < 1e-15:
+            continue
+        solution[r] = (rows[r][size] - sum(rows[r][c] * solution[c] for c in range(r + 1, size))) / rows[r][r]
+    return solution
+
+def parse_step_seconds(path, tail_bytes=1024 * 1024, last=20):
+    """
+    Median seconds per step of the last progress bar updates (tqdm "3.02s/it" or "1.50it/s") in the tail of a log
+    None if there are none
+    """
+    with open(path, "rb") as f:
+        f.seek(max(os.path.getsize(path) - tail_bytes, 0))
+        data = f.read()
+    values = []
+    for number, unit in STEP_TIME_PATTERN.findall(data):
+        value = float(number)
+        if value > 0:
+            values.append(value if unit == b"s/it" else 1 / value)
+    return statistics.median(values[-last:]) if values else None
+
+def job_shapes(job_ids):
+    """
+    {job_id : (gpu type, nodes, gpus per node)} from one sacct call
+    """
+    output = slurm_cache.run_cached(["sacct", "-n", "-X", "-P", "-o", "JobID,Partition,NNodes,AllocTRES", "-j", ",".join(job_ids)], check=False)
+    shapes = {}
+    for line in output.splitlines():
+        parts = line.split("|")
+        if len(parts) < 4 or not parts[2].isdigit():
+            continue
+        job_id, partition, nodes, alloc_tres = parts[0], parts[1], int(parts[2]), parts[3]
+        gpus, gpu_type = 0, None
+        for tres in alloc_tres.split(","):
+            key, _, value = tres.partition("=")
+            if key == "gres/gpu":
+                gpus = int(value)
+            elif key.startswith("gres/gpu:"):
+                gpu_type = key.split(":", 1)[1]
+        if nodes and gpus:
+            shapes[job_id] = (gpu_type or gpu_type_of("", partition), nodes, gpus // nodes)
+    return shapes
+
+def collect_observations(job_ids, bash_file=None):
+    """
+    [(gpu type, nodes, gpus per node, step seconds)] of the jobs whose logs show progress bars
+    """
+    from job_logs import JobLogClassifier
+    classifier = JobLogClassifier(bash_file)
+    shapes = job_shapes(job_ids)
+    observations = []
+    for job_id, shape in shapes.items():
+        step_times = [seconds for seconds in map(parse_step_seconds, classifier.log_files(job_id)) if seconds]
+        if step_times:
+            observations.append(shape + (min(step_times),)) # stdout and stderr may both hold the bar
+    return observations
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate / query the step throughput model")
+    parser.add_argument("--model_file", type=str, default=MODEL_FILE)
+    parser.add_argument("--calibrate", action="store_true", help="Fit the model to the step times in the logs of past jobs")
+    parser.add_argument("--job_ids", type=str, nargs="+", default=[])
+    parser.add_argument("--bash_file", type=str, default=None, help="sbatch file whose --output / --error patterns locate the logs")
+    parser.add_argument("--campaign", type=str, default=None, help="Use the jobs, directory and bash file of an auto_rerun campaign")
+    parser.add_argument("--state_db", type=str, default=None)
+    parser.add_argument("--regularization", type=float, default=0.1)
+    parser.add_argument("--predict", action="store_true", help="Print the predicted samples per second of --shapes")
+    parser.add_argument("--gpu_type", type=str, default="rtx3090")
+    parser.add_argument("--shapes", type=str, nargs="+", default=["1x8", "2x4", "6x2"], help="<nodes>x<gpus per node>")
+    args = parser.parse_args()
+    model = ThroughputModel.load(args.model_file)
+    if args.calibrate:
+        job_ids, bash_file, workdir = list(args.job_ids), args.bash_file, os.getcwd()
+        if args.campaign:
+            from rerun_state import StateStore, STATE_DB
+            store = StateStore(args.state_db or STATE_DB)
+            campaign = store.get_campaign(args.campaign)
+            job_ids += [job.job_id for job in store.history(args.campaign)]
+            bash_file, workdir = bash_file or campaign.bash_file, campaign.workdir
+        previous = os.getcwd()
+        os.chdir(workdir)
+        try:
+            observations = collect_observations(job_ids, bash_file)
+        finally:
+            os.chdir(previous)
+        if not observations:
+            print("No step times found in the job logs")
+            return
+        for gpu_type, nodes, gpus_per_node, seconds in observations:
+            print(f"{gpu_type} {nodes}x{gpus_per_node}: {seconds:.3f}s/step")
+        model.calibrate(observations, args.regularization).save(args.model_file)
+        print(f"Saved the calibrated model to {args.model_file}")
+    if args.predict:
+        for shape in args.shapes:
+            nodes, gpus_per_node = map(int, shape.split("x"))
+            print(f"{args.gpu_type} {shape}: {model.step_seconds(args.gpu_type, nodes, gpus_per_node):.3f}s/step, "
+                  f"{model.samples_per_second(args.gpu_type, nodes, gpus_per_node):.2f} samples/s")
+
+if __name__ == "__main__":
+    main()